@@ -2,17 +2,23 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from datetime import datetime, timedelta, timezone
+from typing import Dict
 import pickle
 import os
+import threading
 import yaml
 from pathlib import Path
 
+# Refresh the access token this long before it expires, so no request goes out with a stale one
+REFRESH_MARGIN = timedelta(minutes=5)
+
 class GmailAuthenticator:
     def __init__(self, config_path: str = 'configs/config.yaml'):
         # Load configuration
         with open(config_path, 'r') as f:
             self.config = yaml.safe_load(f)
-        
+
         self.SCOPES = self.config['auth']['scopes']
         self.credentials_path = self.config['auth']['credentials_path']
         self.token_path = self.config['auth']['token_path']
@@ -21,21 +27,57 @@ class GmailAuthenticator:
         self.success_message = self.config['auth']['oauth']['success_message']
         self.creds = None
 
+        # Credentials are loaded once per session; services are built once per
+        # thread, since the httplib2 connection behind a service isn't thread-safe
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {
+            'authenticate_calls': 0,
+            'token_loads': 0,
+            'token_refreshes': 0,
+            'service_builds': 0
+        }
+
         # Create necessary directories
         Path(os.path.dirname(self.credentials_path)).mkdir(exist_ok=True)
         Path(os.path.dirname(self.token_path)).mkdir(exist_ok=True)
 
     def authenticate(self):
-        """Handles the Gmail OAuth2 authentication flow."""
-        if os.path.exists(self.token_path):
-            print("Loading existing credentials...")
-            with open(self.token_path, 'rb') as token:
-                self.creds = pickle.load(token)
-        
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
+        """
+        Handles the Gmail OAuth2 authentication flow.
+        Returns this thread's Gmail service, built on the first call only.
+        """
+        creds = self.get_credentials()
+        with self._lock:
+            self.stats['authenticate_calls'] += 1
+
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            # The discovery document bundled with googleapiclient, no network fetch
+            service = build('gmail', 'v1', credentials=creds,
+                            static_discovery=True, cache_discovery=False)
+            self._local.service = service
+            with self._lock:
+                self.stats['service_builds'] += 1
+        return service
+
+    def get_credentials(self) -> Credentials:
+        """Load, refresh or obtain OAuth2 credentials."""
+        with self._lock:
+            if self.creds is None and os.path.exists(self.token_path):
+                print("Loading existing credentials...")
+                with open(self.token_path, 'rb') as token:
+                    self.creds = pickle.load(token)
+                self.stats['token_loads'] += 1
+
+            if self.creds and self.creds.valid and not self._expires_soon():
+                return self.creds
+
+            if self.creds and self.creds.refresh_token:
                 print("Refreshing expired credentials...")
                 self.creds.refresh(Request())
+                self.stats['token_refreshes'] += 1
+                self._save_credentials()
             else:
                 print("Starting new authentication flow...")
                 if not os.path.exists(self.credentials_path):
@@ -61,8 +103,26 @@ class GmailAuthenticator:
                 )
 
                 # Save the credentials for future use
-                print("Saving credentials for future use...")
-                with open(self.token_path, 'wb') as token:
-                    pickle.dump(self.creds, token)
+                self._save_credentials()
+
+            return self.creds
+
+    def _expires_soon(self) -> bool:
+        if not self.creds.expiry:
+            return False
+        # google-auth keeps expiry as naive UTC
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return self.creds.expiry - now < REFRESH_MARGIN
+
+    def _save_credentials(self) -> None:
+        print("Saving credentials for future use...")
+        with open(self.token_path, 'wb') as token:
+            pickle.dump(self.creds, token)
 
-        return build('gmail', 'v1', credentials=self.creds)
\ No newline at end of file
+    def avoided_calls(self) -> Dict[str, int]:
+        """How many token file loads and service builds the session cache saved"""
+        calls = self.stats['authenticate_calls']
+        return {
+            'token_loads_avoided': calls - self.stats['token_loads'],
+            'service_builds_avoided': calls - self.stats['service_builds']
+        }
@@ -0,0 +1,383 @@
+"""
+An in-process stand-in for the Gmail service object googleapiclient
+builds, serving a SyntheticMailbox.
+
+It covers the users.messages (list, get, modify, batchModify),
+users.labels (list, create) and users.history (list) calls the
+application makes, plus getProfile, watch and stop, and HTTP batch
+requests. Every HTTP round trip can be delayed by a configurable latency,
+and calls fail with 429 rateLimitExceeded at a configurable rate or once
+a per-second quota is used up, so retry and backoff paths run as they
+would against Gmail.
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Set
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from benchmarks.mailbox import SyntheticMailbox
+
+# Quota units charged per call, as documented for the Gmail API
+QUOTA_COSTS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'labels.list': 1,
+    'labels.create': 5,
+    'history.list': 2,
+    'getProfile': 1,
+    'watch': 100,
+    'stop': 50
+}
+
+# Limits Gmail enforces per request
+LIST_PAGE_LIMIT = 500
+BATCH_MODIFY_LIMIT = 1000
+HTTP_BATCH_LIMIT = 100
+
+
+def http_error(status: int, reason: str, message: str) -> HttpError:
+    """An HttpError shaped like the ones googleapiclient raises for Gmail errors"""
+    content = json.dumps({'error': {
+        'code': status,
+        'message': message,
+        'errors': [{'reason': reason, 'message': message}]
+    }}).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content, uri='https://gmail.googleapis.com/fake')
+
+
+class FakeRequest:
+    """A single API call; nothing happens until execute()"""
+
+    def __init__(self, service: 'FakeGmailService', method: str, handler: Callable[[], Dict]):
+        self.service = service
+        self.method = method
+        self.handler = handler
+
+    def execute(self, num_retries: int = 0) -> Dict:
+        self.service._round_trip()
+        return self.service._call(self.method, self.handler)
+
+
+class FakeBatchRequest:
+    """An HTTP batch: one round trip, then each call succeeds or fails on its own"""
+
+    def __init__(self, service: 'FakeGmailService', callback: Optional[Callable] = None):
+        self.service = service
+        self.callback = callback
+        self.requests: List = []
+
+    def add(self, request: FakeRequest, callback: Optional[Callable] = None,
+            request_id: Optional[str] = None) -> None:
+        if len(self.requests) >= HTTP_BATCH_LIMIT:
+            raise ValueError(f"A batch request holds at most {HTTP_BATCH_LIMIT} calls")
+        request_id = request_id if request_id is not None else str(len(self.requests) + 1)
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self) -> None:
+        self.service._round_trip()
+        for request_id, request, callback in self.requests:
+            try:
+                response = self.service._call(request.method, request.handler)
+            except HttpError as e:
+                callback(request_id, None, e)
+            else:
+                callback(request_id, response, None)
+
+
+class FakeGmailService:
+    """
+    The object GmailAuthenticator.authenticate() would return, backed by
+    a SyntheticMailbox. Label changes are kept as overrides of the
+    generated labels and recorded in the history, so a sync after a rule
+    run sees them. Safe to share between threads.
+
+    latency/jitter: seconds added to every HTTP round trip (uniform jitter)
+    error_rate: share of calls failing with 429 rateLimitExceeded
+    quota_units_per_second: 429 once the calls of the current second cost
+    more than this (see QUOTA_COSTS), 0 for no quota
+    """
+
+    def __init__(self, mailbox: SyntheticMailbox, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, quota_units_per_second: int = 0, seed: int = 1):
+        self.mailbox = mailbox
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_units_per_second = quota_units_per_second
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self._labels: Dict[str, Dict] = {label['id']: label for label in mailbox.label_list()}
+        self._label_overrides: Dict[str, List[str]] = {}
+        self._deleted: Set[str] = set()
+
+        self.history_id = 1000 + mailbox.count
+        self.oldest_history_id = self.history_id
+        self._history: List[Dict] = []
+
+        self._quota_second = 0
+        self._quota_used = 0
+
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.round_trips = 0
+
+    # Resources, in the shape of service.users().messages().get(...)
+
+    def users(self) -> '_Users':
+        return _Users(self)
+
+    def new_batch_http_request(self, callback: Optional[Callable] = None) -> FakeBatchRequest:
+        return FakeBatchRequest(self, callback)
+
+    def stats(self) -> Dict:
+        """Calls made per method, 429s returned and HTTP round trips"""
+        with self._lock:
+            return {
+                'calls': dict(self.calls),
+                'rate_limited': dict(self.errors),
+                'round_trips': self.round_trips
+            }
+
+    # Mailbox changes made outside the API, as new mail arriving would
+
+    def deliver(self, count: int) -> List[str]:
+        """Add count new messages to the mailbox and history, returns their IDs"""
+        with self._lock:
+            first = self.mailbox.count
+            self.mailbox.count += count
+            message_ids = [self.mailbox.message_id(index) for index in range(first, first + count)]
+            for message_id in message_ids:
+                message = {'id': message_id, 'threadId': message_id,
+                           'labelIds': self._current_labels(message_id)}
+                self._record({'messagesAdded': [{'message': message}]}, [message])
+            return message_ids
+
+    def expire_history(self) -> None:
+        """Make every historyId handed out so far too old for history.list"""
+        with self._lock:
+            self.history_id += 1
+            self.oldest_history_id = self.history_id
+
+    # Request execution
+
+    def _round_trip(self) -> None:
+        with self._lock:
+            self.round_trips += 1
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _call(self, method: str, handler: Callable[[], Dict]):
+        with self._lock:
+            self.calls[method] += 1
+            limited = self._rate_limited(QUOTA_COSTS.get(method, 1))
+            if limited:
+                self.errors[method] += 1
+                raise http_error(429, 'rateLimitExceeded', 'Rate Limit Exceeded')
+            return handler()
+
+    def _rate_limited(self, cost: int) -> bool:
+        if self.error_rate and self._rng.random() < self.error_rate:
+            return True
+        if not self.quota_units_per_second:
+            return False
+        second = int(time.monotonic())
+        if second != self._quota_second:
+            self._quota_second, self._quota_used = second, 0
+        if self._quota_used + cost > self.quota_units_per_second:
+            return True
+        self._quota_used += cost
+        return False
+
+    # Handlers, run under the lock
+
+    def _index(self, message_id: str) -> int:
+        try:
+            index = self.mailbox.index_of(message_id)
+        except ValueError:
+            index = -1
+        if not 0 <= index < self.mailbox.count or message_id in self._deleted:
+            raise http_error(404, 'notFound', 'Requested entity was not found.')
+        return index
+
+    def _current_labels(self, message_id: str) -> List[str]:
+        labels = self._label_overrides.get(message_id)
+        if labels is None:
+            labels = self.mailbox.labels(self.mailbox.index_of(message_id))
+        return list(labels)
+
+    def _record(self, record: Dict, messages: List[Dict]) -> None:
+        self.history_id += 1
+        record['id'] = str(self.history_id)
+        record['messages'] = [{'id': m['id'], 'threadId': m['threadId']} for m in messages]
+        self._history.append(record)
+
+    def _list_messages(self, max_results: int, page_token: Optional[str]) -> Dict:
+        start = int(page_token or 0)
+        max_results = max(1, min(max_results, LIST_PAGE_LIMIT))
+        messages = []
+        index = self.mailbox.count - 1 - start
+        while index >= 0 and len(messages) < max_results:
+            message_id = self.mailbox.message_id(index)
+            if message_id not in self._deleted:
+                messages.append({'id': message_id, 'threadId': self.mailbox.message_id(index - index % 3)})
+            index -= 1
+            start += 1
+        result = {'messages': messages, 'resultSizeEstimate': self.mailbox.count - len(self._deleted)}
+        if index >= 0:
+            result['nextPageToken'] = str(start)
+        return result
+
+    def _get_message(self, message_id: str, format: str, metadata_headers: Optional[List[str]]) -> Dict:
+        message = self.mailbox.message(self._index(message_id), format)
+        message['labelIds'] = self._current_labels(message_id)
+        if format == 'metadata' and metadata_headers:
+            wanted = {name.lower() for name in metadata_headers}
+            message['payload']['headers'] = [
+                header for header in message['payload']['headers'] if header['name'].lower() in wanted
+            ]
+        return message
+
+    def _modify(self, message_ids: List[str], add: List[str], remove: List[str]) -> None:
+        if len(message_ids) > BATCH_MODIFY_LIMIT:
+            raise http_error(400, 'invalidArgument', f'Too many ids, at most {BATCH_MODIFY_LIMIT}')
+        unknown = [label for label in add + remove if label not in self._labels]
+        if unknown:
+            raise http_error(400, 'invalidArgument', f'Invalid label: {unknown[0]}')
+
+        added_items, removed_items, messages = [], [], []
+        for message_id in message_ids:
+            self._index(message_id)
+            before = self._current_labels(message_id)
+            after = [label for label in before if label not in remove]
+            after += [label for label in add if label not in after]
+            self._label_overrides[message_id] = after
+            message = {'id': message_id, 'threadId': message_id, 'labelIds': after}
+            added = [label for label in after if label not in before]
+            removed = [label for label in before if label not in after]
+            if added:
+                added_items.append({'message': message, 'labelIds': added})
+            if removed:
+                removed_items.append({'message': message, 'labelIds': removed})
+            if added or removed:
+                messages.append(message)
+
+        if messages:
+            record = {}
+            if added_items:
+                record['labelsAdded'] = added_items
+            if removed_items:
+                record['labelsRemoved'] = removed_items
+            self._record(record, messages)
+
+    def _create_label(self, body: Dict) -> Dict:
+        name = body.get('name', '')
+        if any(label['name'].upper() == name.upper() for label in self._labels.values()):
+            raise http_error(409, 'alreadyExists', 'Label name exists or conflicts')
+        label = {'id': f'Label_{len(self._labels) + 1}', 'name': name, 'type': 'user'}
+        self._labels[label['id']] = label
+        return dict(label)
+
+    def _list_history(self, start_history_id: str, max_results: int, page_token: Optional[str]) -> Dict:
+        start = int(start_history_id)
+        if start < self.oldest_history_id:
+            raise http_error(404, 'notFound', 'Requested entity was not found.')
+        records = [record for record in self._history if int(record['id']) > start]
+        offset = int(page_token or 0)
+        page = records[offset:offset + max(1, min(max_results, LIST_PAGE_LIMIT))]
+        result = {'history': page, 'historyId': str(self.history_id)}
+        if offset + len(page) < len(records):
+            result['nextPageToken'] = str(offset + len(page))
+        return result
+
+
+class _Users:
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def messages(self) -> '_Messages':
+        return _Messages(self.service)
+
+    def labels(self) -> '_Labels':
+        return _Labels(self.service)
+
+    def history(self) -> '_History':
+        return _History(self.service)
+
+    def getProfile(self, userId: str) -> FakeRequest:
+        service = self.service
+        return FakeRequest(service, 'getProfile', lambda: {
+            'emailAddress': 'me@example.com',
+            'messagesTotal': service.mailbox.count - len(service._deleted),
+            'historyId': str(service.history_id)
+        })
+
+    def watch(self, userId: str, body: Dict) -> FakeRequest:
+        service = self.service
+        return FakeRequest(service, 'watch', lambda: {
+            'historyId': str(service.history_id),
+            'expiration': str(int((time.time() + 7 * 24 * 3600) * 1000))
+        })
+
+    def stop(self, userId: str) -> FakeRequest:
+        return FakeRequest(self.service, 'stop', lambda: '')
+
+
+class _Messages:
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def list(self, userId: str, maxResults: int = 100, q: str = '', pageToken: Optional[str] = None,
+             **kwargs) -> FakeRequest:
+        # q is accepted but not applied: every message matches
+        return FakeRequest(self.service, 'messages.list',
+                           lambda: self.service._list_messages(maxResults, pageToken))
+
+    def get(self, userId: str, id: str, format: str = 'full',
+            metadataHeaders: Optional[List[str]] = None) -> FakeRequest:
+        return FakeRequest(self.service, 'messages.get',
+                           lambda: self.service._get_message(id, format, metadataHeaders))
+
+    def modify(self, userId: str, id: str, body: Dict) -> FakeRequest:
+        def handler():
+            self.service._modify([id], body.get('addLabelIds', []), body.get('removeLabelIds', []))
+            return self.service._get_message(id, 'minimal', None)
+        return FakeRequest(self.service, 'messages.modify', handler)
+
+    def batchModify(self, userId: str, body: Dict) -> FakeRequest:
+        def handler():
+            self.service._modify(body.get('ids', []), body.get('addLabelIds', []),
+                                 body.get('removeLabelIds', []))
+            return ''
+        return FakeRequest(self.service, 'messages.batchModify', handler)
+
+
+class _Labels:
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def list(self, userId: str) -> FakeRequest:
+        return FakeRequest(self.service, 'labels.list', lambda: {
+            'labels': [dict(label) for label in self.service._labels.values()]
+        })
+
+    def create(self, userId: str, body: Dict) -> FakeRequest:
+        return FakeRequest(self.service, 'labels.create', lambda: self.service._create_label(body))
+
+
+class _History:
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def list(self, userId: str, startHistoryId: str, maxResults: int = 100,
+             pageToken: Optional[str] = None, **kwargs) -> FakeRequest:
+        return FakeRequest(self.service, 'history.list',
+                           lambda: self.service._list_history(startHistoryId, maxResults, pageToken))
@@ -0,0 +1,237 @@
+"""
+Deterministic synthetic mailboxes in the Gmail API message format.
+
+Message i is generated from (seed, i) alone, so a mailbox of a million
+messages costs no memory until its messages are asked for, and two runs
+with the same seed see the same mail.
+"""
+import base64
+import math
+import random
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from benchmarks.rule_engine import DOMAINS, WORDS
+
+SYSTEM_LABELS = ['INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'SPAM', 'TRASH',
+                 'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS',
+                 'CATEGORY_UPDATES', 'CATEGORY_FORUMS']
+USER_LABELS = ['Receipts', 'Travel', 'Work', 'Family', 'Newsletters', 'Banking']
+
+# MIME layout -> share of messages
+LAYOUTS = (
+    ('text/plain', 0.35),
+    ('multipart/alternative', 0.40),
+    ('text/html', 0.10),
+    ('multipart/mixed', 0.15)
+)
+
+# Decoded body text size: log-normal with a ~3 KB median and a long tail
+BODY_MEDIAN_BYTES = 3000
+BODY_SIGMA = 1.0
+BODY_MAX_BYTES = 2 * 1024 * 1024
+
+# Attachments are listed with an attachmentId, only their size is simulated
+ATTACHMENT_MEDIAN_BYTES = 150 * 1024
+ATTACHMENT_SIGMA = 1.5
+
+SENDER_NAMES = ['Alice', 'Bob', 'Carol', 'Dave', 'Erin', 'Frank', 'Grace', 'Heidi',
+                'Support', 'Billing', 'No Reply', 'Team']
+LATIN1_WORDS = ['café', 'résumé', 'naïve', 'über', 'façade', 'señor']
+
+
+class SyntheticMailbox:
+    """
+    A mailbox of count messages received over span_days up to end.
+
+    Message IDs are 16 hex digits like Gmail's; the newest message has the
+    highest index. messages.list order (newest first) is index order reversed.
+    """
+
+    def __init__(self, count: int, seed: int = 1, end: Optional[datetime] = None,
+                 span_days: int = 730):
+        self.count = count
+        self.seed = seed
+        # Midnight today by default, so runs on the same day get the same dates
+        end = end or datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        # Evenly spaced, so messages added later by growing count arrive after end
+        self.interval_ms = max(1, span_days * 24 * 3600 * 1000 // max(count, 1))
+        self.start_ms = int(end.timestamp() * 1000) - self.interval_ms * count
+        # Bodies are cut from a corpus generated once, drawing words per message is too slow at 1M
+        self._corpus: Dict[str, str] = {}
+
+    @staticmethod
+    def message_id(index: int) -> str:
+        return f'{0x18c0000000000000 + index:016x}'
+
+    @staticmethod
+    def index_of(message_id: str) -> int:
+        return int(message_id, 16) - 0x18c0000000000000
+
+    @staticmethod
+    def label_list() -> List[Dict]:
+        """labels.list resources of every label the generator assigns"""
+        labels = [{'id': name, 'name': name, 'type': 'system'} for name in SYSTEM_LABELS]
+        labels += [
+            {'id': f'Label_{number}', 'name': name, 'type': 'user'}
+            for number, name in enumerate(USER_LABELS, start=1)
+        ]
+        return labels
+
+    def ids(self) -> Iterator[str]:
+        """Message IDs newest first, the order messages.list returns them in"""
+        for index in range(self.count - 1, -1, -1):
+            yield self.message_id(index)
+
+    def _rng(self, index: int, stream: int = 0) -> random.Random:
+        return random.Random((self.seed * 1000003 + index) * 4 + stream)
+
+    def internal_date(self, index: int) -> int:
+        """Epoch milliseconds, increasing with the index"""
+        return self.start_ms + self.interval_ms * (index + 1)
+
+    def labels(self, index: int) -> List[str]:
+        rng = self._rng(index, stream=1)
+        labels = []
+        if rng.random() < 0.7:
+            labels.append('INBOX')
+        if rng.random() < 0.4:
+            labels.append('UNREAD')
+        if rng.random() < 0.05:
+            labels.append('STARRED')
+        labels.append(rng.choice(SYSTEM_LABELS[7:]))
+        if rng.random() < 0.3:
+            labels.append(f'Label_{rng.randint(1, len(USER_LABELS))}')
+        return labels
+
+    def message(self, index: int, format: str = 'full') -> Dict:
+        """The users.messages.get resource of message index in the given format"""
+        rng = self._rng(index)
+        layout = self._pick_layout(rng.random())
+        labels = self.labels(index)
+        internal_date = self.internal_date(index)
+
+        domain = rng.choice(DOMAINS)
+        sender = f'{rng.choice(SENDER_NAMES)} <user{rng.randint(1, 500)}@{domain}>'
+        subject = ' '.join(rng.choices(WORDS, k=rng.randint(2, 9))).capitalize()
+        charset = 'iso-8859-1' if rng.random() < 0.1 else 'utf-8'
+        text = self._text(rng, self._corpus_text(charset))
+
+        headers = [
+            {'name': 'Delivered-To', 'value': 'me@example.com'},
+            *({'name': 'Received', 'value': f'from mx{hop}.{domain} by mx.google.com'}
+              for hop in range(rng.randint(1, 6))),
+            {'name': 'MIME-Version', 'value': '1.0'},
+            {'name': 'From', 'value': sender},
+            {'name': 'To', 'value': 'Me <me@example.com>'},
+            {'name': 'Subject', 'value': subject},
+            {'name': 'Date', 'value': format_datetime(
+                datetime.fromtimestamp(internal_date / 1000, timezone.utc))},
+            {'name': 'Message-ID', 'value': f'<{self.message_id(index)}.{self.seed}@{domain}>'}
+        ]
+        if rng.random() < 0.3:
+            headers.append({'name': 'List-Unsubscribe', 'value': f'<https://{domain}/unsubscribe>'})
+
+        payload, size = self._payload(rng, layout, text, charset)
+        payload['headers'] = headers + payload['headers']
+
+        message = {
+            'id': self.message_id(index),
+            'threadId': self.message_id(index - index % 3),
+            'labelIds': labels,
+            'snippet': text[:100],
+            'historyId': str(1000 + index),
+            'internalDate': str(internal_date),
+            'sizeEstimate': size + sum(len(h['name']) + len(h['value']) + 4 for h in headers)
+        }
+        if format == 'minimal':
+            return message
+        if format == 'metadata':
+            payload = {'mimeType': payload['mimeType'], 'headers': headers}
+        message['payload'] = payload
+        return message
+
+    @staticmethod
+    def _pick_layout(value: float) -> str:
+        for layout, share in LAYOUTS:
+            if value < share:
+                return layout
+            value -= share
+        return LAYOUTS[-1][0]
+
+    def _corpus_text(self, charset: str) -> str:
+        """Random lines of words, twice the largest body; non-UTF-8 text gets accented words"""
+        corpus = self._corpus.get(charset)
+        if corpus is None:
+            rng = random.Random(self.seed * 2 + (charset != 'utf-8'))
+            # Words average about 7 characters with their separator
+            words = rng.choices(WORDS, k=2 * BODY_MAX_BYTES // 7)
+            if charset != 'utf-8':
+                words[::50] = rng.choices(LATIN1_WORDS, k=len(words[::50]))
+            corpus = '\n'.join(' '.join(words[start:start + 12]) for start in range(0, len(words), 12))
+            self._corpus[charset] = corpus
+        return corpus
+
+    @staticmethod
+    def _text(rng: random.Random, corpus: str) -> str:
+        size = max(40, min(BODY_MAX_BYTES, int(rng.lognormvariate(math.log(BODY_MEDIAN_BYTES), BODY_SIGMA))))
+        start = corpus.find(' ', rng.randrange(len(corpus) - size - 64)) + 1
+        end = corpus.find(' ', start + size)
+        return corpus[start:end]
+
+    @staticmethod
+    def _part(mime_type: str, text: str, charset: str) -> Tuple[Dict, int]:
+        data = text.encode(charset, errors='replace')
+        return {
+            'mimeType': mime_type,
+            'filename': '',
+            'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'}],
+            'body': {'size': len(data), 'data': base64.urlsafe_b64encode(data).decode('ascii')}
+        }, len(data)
+
+    @staticmethod
+    def _html(text: str) -> str:
+        paragraphs = ''.join(f'<p>{line}</p>' for line in text.split('\n'))
+        return ('<html><head><style>p { margin: 0 0 8px; }</style></head>'
+                f'<body><div class="content">{paragraphs}</div></body></html>')
+
+    def _payload(self, rng: random.Random, layout: str, text: str, charset: str) -> Tuple[Dict, int]:
+        """The MIME tree of a message and its size in bytes"""
+        if layout == 'text/plain':
+            return self._part('text/plain', text, charset)
+        if layout == 'text/html':
+            return self._part('text/html', self._html(text), charset)
+
+        plain, plain_size = self._part('text/plain', text, charset)
+        html, html_size = self._part('text/html', self._html(text), charset)
+        alternative = {
+            'mimeType': 'multipart/alternative',
+            'filename': '',
+            'headers': [{'name': 'Content-Type', 'value': 'multipart/alternative; boundary="alt"'}],
+            'body': {'size': 0},
+            'parts': [plain, html]
+        }
+        if layout == 'multipart/alternative':
+            return alternative, plain_size + html_size
+
+        parts = [alternative]
+        size = plain_size + html_size
+        for number in range(rng.randint(1, 3)):
+            attachment_size = int(rng.lognormvariate(math.log(ATTACHMENT_MEDIAN_BYTES), ATTACHMENT_SIGMA))
+            extension = rng.choice(['pdf', 'png', 'jpg', 'zip', 'csv'])
+            parts.append({
+                'mimeType': 'application/octet-stream',
+                'filename': f'attachment{number}.{extension}',
+                'headers': [{'name': 'Content-Disposition',
+                             'value': f'attachment; filename="attachment{number}.{extension}"'}],
+                'body': {'size': attachment_size, 'attachmentId': f'att{number}'}
+            })
+            size += attachment_size
+        return {
+            'mimeType': 'multipart/mixed',
+            'filename': '',
+            'headers': [{'name': 'Content-Type', 'value': 'multipart/mixed; boundary="mixed"'}],
+            'body': {'size': 0},
+            'parts': parts
+        }, size
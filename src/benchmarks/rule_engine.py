@@ -0,0 +1,147 @@
+"""
+Compare emails-per-second of the interpreted rule evaluation against the
+compiled rule engine.
+
+Run from the src directory:
+    python -m benchmarks.rule_engine --emails 20000 --rules 200
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+from email_manager.rule_compiler import RuleCompiler
+
+WORDS = ['invoice', 'delivery', 'order', 'shipped', 'meeting', 'report', 'newsletter',
+         'payment', 'reminder', 'update', 'security', 'account', 'weekly', 'offer']
+DOMAINS = ['jlcpcb.com', 'example.com', 'github.com', 'bank.com', 'shop.io', 'news.org']
+
+
+def generate_emails(count: int, seed: int = 1) -> List[Dict]:
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    emails = []
+    for i in range(count):
+        body_words = rng.choices(WORDS, k=rng.randint(50, 400))
+        received = now - timedelta(minutes=rng.randint(0, 60 * 24 * 90))
+        emails.append({
+            'id': i,
+            'message_id': f'msg{i}',
+            'from_address': f'user{rng.randint(1, 500)}@{rng.choice(DOMAINS)}',
+            'to_address': 'me@example.com',
+            'subject': ' '.join(rng.choices(WORDS, k=5)),
+            'message': ' '.join(body_words),
+            'received_at': int(received.timestamp()),
+            'is_read': 0,
+            'label': 'inbox'
+        })
+    return emails
+
+
+def generate_rules(count: int, seed: int = 2) -> Dict:
+    rng = random.Random(seed)
+    rules = []
+    for i in range(count):
+        conditions = [
+            {'field': 'from', 'predicate': 'contains', 'value': rng.choice(DOMAINS)},
+            {'field': 'subject', 'predicate': rng.choice(['contains', 'does_not_contain']),
+             'value': rng.choice(WORDS)},
+            {'field': 'message', 'predicate': 'contains',
+             'value': f'{rng.choice(WORDS)} {rng.choice(WORDS)}'},
+            {'field': 'received', 'predicate': 'less_than',
+             'value': f'{rng.randint(1, 60)}_day'}
+        ]
+        rules.append({
+            'name': f'rule {i}',
+            'match_type': rng.choice(['all', 'any']),
+            'conditions': rng.sample(conditions, k=rng.randint(1, len(conditions))),
+            'actions': [{'type': 'mark_as', 'value': 'read'}]
+        })
+    return {'rules': rules}
+
+
+def interpret_condition(email: Dict, condition: Dict) -> bool:
+    """The per-email dict interpretation used before rules were compiled"""
+    field_value = {
+        'from': email['from_address'],
+        'to': email['to_address'],
+        'subject': email['subject'],
+        'message': email['message'],
+        'received': email['received_at']
+    }.get(condition['field'])
+    if not field_value:
+        return False
+
+    if condition['field'] == 'received':
+        email_date = datetime.fromtimestamp(field_value, timezone.utc)
+        current_time = datetime.now(timezone.utc)
+        number, unit = condition['value'].split('_')
+        delta = timedelta(days=int(number)) if unit == 'day' else timedelta(days=int(number) * 30)
+        if condition['predicate'] == 'less_than':
+            return (current_time - email_date) < delta
+        return (current_time - email_date) > delta
+
+    if condition['predicate'] == 'contains':
+        return condition['value'].lower() in field_value.lower()
+    elif condition['predicate'] == 'does_not_contain':
+        return condition['value'].lower() not in field_value.lower()
+    elif condition['predicate'] == 'equals':
+        return condition['value'].lower() == field_value.lower()
+    elif condition['predicate'] == 'does_not_equal':
+        return condition['value'].lower() != field_value.lower()
+    return False
+
+
+def interpret_rule(email: Dict, rule: Dict) -> bool:
+    results = [interpret_condition(email, condition) for condition in rule['conditions']]
+    if rule['match_type'] == 'all':
+        return all(results)
+    return any(results)
+
+
+def run_interpreted(emails: List[Dict], rules: Dict) -> int:
+    matches = 0
+    for email in emails:
+        for rule in rules['rules']:
+            if interpret_rule(email, rule):
+                matches += 1
+    return matches
+
+
+def run_compiled(emails: List[Dict], rules: Dict) -> int:
+    compiled = RuleCompiler().compile(rules)
+    now = datetime.now(timezone.utc)
+    matches = 0
+    for email in emails:
+        matches += len(compiled.matching_rules(email, now))
+    return matches
+
+
+def measure(label: str, func, emails: List[Dict], rules: Dict) -> float:
+    start = time.perf_counter()
+    matches = func(emails, rules)
+    elapsed = time.perf_counter() - start
+    rate = len(emails) / elapsed
+    print(f"{label:<12} {elapsed:8.3f}s  {rate:12.1f} emails/s  ({matches} matches)")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--emails', type=int, default=5000)
+    parser.add_argument('--rules', type=int, default=100)
+    args = parser.parse_args()
+
+    emails = generate_emails(args.emails)
+    rules = generate_rules(args.rules)
+    print(f"{args.emails} emails x {args.rules} rules")
+
+    before = measure('interpreted', run_interpreted, emails, rules)
+    after = measure('compiled', run_compiled, emails, rules)
+    print(f"speedup: {after / before:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
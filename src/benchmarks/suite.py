@@ -0,0 +1,303 @@
+"""
+Benchmark fetching, parsing, storing and rule processing against a
+synthetic mailbox served by an in-process fake of the Gmail API, and
+write the results as JSON so runs can be compared.
+
+Run from the src directory:
+    python -m benchmarks.suite --messages 10000 --output results.json
+    python -m benchmarks.suite --messages 10000 --latency-ms 50 --error-rate 0.02 \\
+        --compare results.json
+
+Benchmarks:
+    get_messages   GmailManager.get_messages over --fetch-messages messages
+    parse_message  EmailParser.parse_message over the whole mailbox
+    insert_emails  EmailDatabase.insert_emails of the whole mailbox, in chunks
+    process_emails EmailRuleExecutor.process_emails over the stored emails
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional
+
+import yaml
+
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.mailbox import SyntheticMailbox
+from benchmarks.rule_engine import generate_rules
+from database.email_repository import EmailDatabase
+from database.migration import create_email_schema
+from email_manager.email_rule_executor import EmailRuleExecutor
+from gmail.gmail_manager import GmailManager
+from utils.chunking import chunked
+from utils.email_parser import EmailParser
+
+BENCHMARKS = ('get_messages', 'parse_message', 'insert_emails', 'process_emails')
+
+# Version of the results file layout
+RESULTS_FORMAT = 1
+
+# Messages generated at a time when the mailbox is streamed through a benchmark
+GENERATE_CHUNK = 1000
+
+CONFIG_PATH = 'configs/config.yaml'
+
+
+def write_config(workdir: str) -> str:
+    """
+    Copy config.yaml into workdir with the label cache turned off, so a
+    benchmark run never opens the repository's database
+    Returns the path of the copy
+    """
+    with open(CONFIG_PATH, 'r') as f:
+        config = yaml.safe_load(f)
+    config.setdefault('gmail', {}).setdefault('label_cache', {})['persist'] = False
+    path = os.path.join(workdir, 'config.yaml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+def fake_gmail_manager(service: FakeGmailService, config_path: str,
+                       fetch_mode: Optional[str] = None) -> GmailManager:
+    """A blocking-client GmailManager whose every call goes to the fake service"""
+    gmail = GmailManager(config_path, client='blocking')
+    gmail.authenticator.authenticate = lambda: service
+    if fetch_mode:
+        gmail.fetch_config = dict(gmail.fetch_config, mode=fetch_mode)
+    return gmail
+
+
+def result(items: int, seconds: float, **extra) -> Dict:
+    return {
+        'items': items,
+        'seconds': round(seconds, 4),
+        'items_per_second': round(items / seconds, 1) if seconds else 0.0,
+        **extra
+    }
+
+
+def text_bytes(part: Dict) -> int:
+    """Encoded size of the text parts of a message payload, attachments excluded"""
+    body = part.get('body', {})
+    size = body.get('size', 0) if 'data' in body else 0
+    return size + sum(text_bytes(child) for child in part.get('parts', []))
+
+
+def iter_messages(mailbox: SyntheticMailbox) -> Iterator[List[Dict]]:
+    for start in range(0, mailbox.count, GENERATE_CHUNK):
+        yield [mailbox.message(index) for index in range(start, min(start + GENERATE_CHUNK, mailbox.count))]
+
+
+def bench_get_messages(args, mailbox: SyntheticMailbox, config_path: str) -> Dict:
+    service = FakeGmailService(
+        mailbox,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        quota_units_per_second=args.quota,
+        seed=args.seed
+    )
+    gmail = fake_gmail_manager(service, config_path, args.fetch_mode)
+    count = min(args.fetch_messages, mailbox.count)
+
+    start = time.perf_counter()
+    emails = gmail.get_messages(max_results=count)
+    elapsed = time.perf_counter() - start
+    gmail.close()
+
+    stats = service.stats()
+    return result(len(emails), elapsed, requested=count, mode=gmail.fetch_config.get('mode', 'batch'), **stats)
+
+
+def bench_parse_message(args, mailbox: SyntheticMailbox) -> Dict:
+    parser = EmailParser()
+    parsed = 0
+    size = 0
+    elapsed = 0.0
+    # Only parsing is timed, generating the messages is not
+    for messages in iter_messages(mailbox):
+        start = time.perf_counter()
+        for message in messages:
+            parser.parse_message(message)
+        elapsed += time.perf_counter() - start
+        parsed += len(messages)
+        size += sum(text_bytes(message['payload']) for message in messages)
+    return result(parsed, elapsed, text_megabytes=round(size / 2 ** 20, 1),
+                  megabytes_per_second=round(size / 2 ** 20 / elapsed, 1) if elapsed else 0.0)
+
+
+def bench_insert_emails(args, mailbox: SyntheticMailbox, db_path: str) -> Dict:
+    parser = EmailParser()
+    database = EmailDatabase(db_path)
+    totals = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    elapsed = 0.0
+    for messages in iter_messages(mailbox):
+        emails = [parser.parse_message(message) for message in messages]
+        for chunk in chunked(emails, args.chunk_size):
+            start = time.perf_counter()
+            counts = database.insert_emails(chunk)
+            elapsed += time.perf_counter() - start
+            for key, count in counts.items():
+                totals[key] += count
+    return result(sum(totals.values()), elapsed, chunk_size=args.chunk_size,
+                  database_megabytes=round(os.path.getsize(db_path) / 2 ** 20, 1), **totals)
+
+
+def bench_process_emails(args, mailbox: SyntheticMailbox, db_path: str, rules_path: str,
+                         config_path: str) -> Dict:
+    service = FakeGmailService(
+        mailbox,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        quota_units_per_second=args.quota,
+        seed=args.seed
+    )
+    gmail = fake_gmail_manager(service, config_path)
+    executor = EmailRuleExecutor(db_path=db_path, rules_path=rules_path, gmail=gmail)
+
+    start = time.perf_counter()
+    processed = executor.process_emails(batch_size=args.batch_size, workers=args.workers)
+    elapsed = time.perf_counter() - start
+    gmail.close()
+
+    return result(processed, elapsed, rules=args.rules, workers=args.workers,
+                  batch_size=args.batch_size, **service.stats())
+
+
+def run(args) -> Dict:
+    mailbox = SyntheticMailbox(args.messages, seed=args.seed)
+    selected = args.only or list(BENCHMARKS)
+    results: Dict[str, Dict] = {}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, 'email.db')
+        rules_path = os.path.join(workdir, 'rules.json')
+        config_path = write_config(workdir)
+        create_email_schema(db_path)
+        with open(rules_path, 'w') as f:
+            json.dump(generate_rules(args.rules, seed=args.seed + 1), f)
+
+        for name in BENCHMARKS:
+            # process_emails needs the emails insert_emails stores
+            if name not in selected and not (name == 'insert_emails' and 'process_emails' in selected):
+                continue
+            print(f"{name}...", file=sys.stderr)
+            if name == 'get_messages':
+                outcome = bench_get_messages(args, mailbox, config_path)
+            elif name == 'parse_message':
+                outcome = bench_parse_message(args, mailbox)
+            elif name == 'insert_emails':
+                outcome = bench_insert_emails(args, mailbox, db_path)
+            else:
+                outcome = bench_process_emails(args, mailbox, db_path, rules_path, config_path)
+            if name in selected:
+                results[name] = outcome
+
+    return {
+        'format': RESULTS_FORMAT,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'compare', 'threshold', 'verbose')},
+        'results': results
+    }
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """
+    Print the items/s change of every benchmark found in both runs
+    Returns the benchmarks that got slower by more than threshold
+    """
+    if current['parameters'] != baseline.get('parameters'):
+        print("warning: the runs used different parameters, rates may not be comparable")
+
+    regressions = []
+    for name, outcome in current['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before or not before.get('items_per_second'):
+            continue
+        change = outcome['items_per_second'] / before['items_per_second'] - 1
+        slower = change < -threshold
+        if slower:
+            regressions.append(name)
+        print(f"{name:<15} {before['items_per_second']:>12.1f} -> {outcome['items_per_second']:>12.1f}/s "
+              f"{change:+8.1%}{'  REGRESSION' if slower else ''}")
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=10000,
+                        help='messages in the synthetic mailbox, 1k to 1M')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='same seed, same mailbox and rules')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS,
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--fetch-messages', type=int, default=5000,
+                        help='messages get_messages fetches, at most the mailbox size')
+    parser.add_argument('--fetch-mode', choices=('batch', 'threads', 'serial'),
+                        help='MessageFetcher mode (default: gmail.fetch.mode in config.yaml)')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='simulated latency of every Gmail HTTP round trip')
+    parser.add_argument('--jitter-ms', type=float, default=0.0,
+                        help='random extra latency, up to this much')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of Gmail calls failing with 429 rateLimitExceeded')
+    parser.add_argument('--quota', type=int, default=0,
+                        help='Gmail quota units per second before calls fail with 429, 0 for none')
+    parser.add_argument('--chunk-size', type=int, default=500,
+                        help='emails per insert_emails call')
+    parser.add_argument('--rules', type=int, default=50,
+                        help='generated rules process_emails evaluates')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='process_emails batch size')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='process_emails worker processes')
+    parser.add_argument('--output', metavar='PATH',
+                        help='write the results as JSON to this file')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare with the results of an earlier run, exit 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown counted as a regression by --compare (default: 0.1 = 10%%)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='keep the application log output')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    report = run(args)
+    for name, outcome in report['results'].items():
+        print(f"{name:<15} {outcome['items']:>9} items  {outcome['seconds']:>9.3f}s  "
+              f"{outcome['items_per_second']:>12.1f}/s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import sqlite3
+import zlib
+from typing import Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# A message body stored in email_bodies, decompressed inside SQL by body_text()
+MESSAGE_SQL = '(SELECT body_text(codec, body) FROM email_bodies WHERE email_id = emails.id)'
+
+# Columns of the emails table that now live elsewhere, as SQL expressions over emails
+COLUMN_SQL = {'message': MESSAGE_SQL}
+
+# The only non-ASCII characters Python's lower() turns into ASCII ones (KELVIN SIGN and
+# LATIN CAPITAL LETTER I WITH DOT ABOVE); SQLite's LIKE and lower() leave them as they are
+ASCII_LOWERINGS = {'\u212a': 'k', '\u0130': 'i\u0307'}
+
+if zstandard is not None:
+    _zstd_compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    _zstd_decompressor = zstandard.ZstdDecompressor()
+
+
+def column_sql(column: str) -> str:
+    """The SQL expression reading a logical email column"""
+    return COLUMN_SQL.get(column, column)
+
+
+def compress_body(text: str) -> Tuple[str, bytes]:
+    """
+    Compress a message body with zstd when installed, zlib otherwise
+    Returns (codec, blob); bodies compression doesn't shrink stay 'raw'
+    """
+    raw = text.encode('utf-8')
+    if zstandard is not None:
+        codec, blob = 'zstd', _zstd_compressor.compress(raw)
+    else:
+        codec, blob = 'zlib', zlib.compress(raw, ZLIB_LEVEL)
+    if len(blob) >= len(raw):
+        return 'raw', raw
+    return codec, blob
+
+
+def decompress_body(codec: Optional[str], blob: Optional[bytes]) -> str:
+    """Inverse of compress_body; a missing body reads as ''"""
+    if blob is None:
+        return ''
+    if codec == 'zlib':
+        raw = zlib.decompress(blob)
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Body is zstd-compressed but the zstandard package is not installed")
+        raw = _zstd_decompressor.decompress(blob)
+    else:
+        raw = blob
+    return raw.decode('utf-8')
+
+
+def fold_lowerings(text: Optional[str]) -> Optional[str]:
+    """text with the characters of ASCII_LOWERINGS lowercased as Python would"""
+    if not text:
+        return text
+    for char, lowered in ASCII_LOWERINGS.items():
+        if char in text:
+            text = text.replace(char, lowered)
+    return text
+
+
+def register_functions(conn: sqlite3.Connection) -> None:
+    """
+    Make body_text(codec, body) available to SQL on this connection, used
+    by rule push-down, search and the triggers keeping emails_fts in sync,
+    and fold_lowerings(text), used by rule push-down
+    """
+    conn.create_function('body_text', 2, decompress_body, deterministic=True)
+    conn.create_function('fold_lowerings', 1, fold_lowerings, deterministic=True)
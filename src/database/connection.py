@@ -0,0 +1,126 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Tuple
+import logging
+from database.body_store import register_functions
+
+# Applied to every connection when it is opened
+PRAGMAS = {
+    'journal_mode': 'WAL',        # readers don't block the writer
+    'synchronous': 'NORMAL',      # safe with WAL, fsync only at checkpoints
+    'cache_size': -65536,         # 64 MB page cache
+    'mmap_size': 268435456,       # 256 MB memory-mapped I/O
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000
+}
+
+# Prepared statements kept per connection, keyed by SQL text
+STATEMENT_CACHE_SIZE = 256
+
+class Database:
+    """
+    A long-lived, tuned SQLite connection shared by the repository, the
+    email manager and the rule executor.
+
+    Use Database.shared(db_path) to get the process-wide instance for a
+    file. Writes go through transaction(), which opens one explicit
+    transaction (nested scopes become savepoints), so a whole run can
+    commit a handful of times instead of once per statement.
+    """
+
+    _instances: Dict[str, 'Database'] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # isolation_level=None: no implicit transactions, transaction() controls them
+        self.conn = sqlite3.connect(
+            db_path,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        self._lock = threading.RLock()
+        self._depth = 0
+        for name, value in PRAGMAS.items():
+            self.conn.execute(f'PRAGMA {name} = {value}')
+        register_functions(self.conn)
+
+    @classmethod
+    def shared(cls, db_path: str = 'database/email.db') -> 'Database':
+        """Get the connection shared by everything in this process using db_path"""
+        with cls._instances_lock:
+            if db_path not in cls._instances:
+                cls._instances[db_path] = cls(db_path)
+            return cls._instances[db_path]
+
+    @contextmanager
+    def transaction(self, rollback_only: bool = False) -> Iterator[sqlite3.Connection]:
+        """
+        Run the block in a transaction, committed on success and rolled
+        back on error. Nested blocks use savepoints.
+        With rollback_only the block's writes are always rolled back, so a
+        dry run can go through the same code without changing anything.
+        """
+        with self._lock:
+            savepoint = f'sp{self._depth}'
+            if self._depth == 0:
+                self.conn.execute('BEGIN')
+            else:
+                self.conn.execute(f'SAVEPOINT {savepoint}')
+            self._depth += 1
+
+            # The depth only drops once the transaction or savepoint has really ended
+            try:
+                yield self.conn
+            except BaseException:
+                try:
+                    if self._depth == 1:
+                        self._rollback()
+                    else:
+                        self.conn.execute(f'ROLLBACK TO {savepoint}')
+                        self.conn.execute(f'RELEASE {savepoint}')
+                finally:
+                    self._depth -= 1
+                raise
+            else:
+                try:
+                    if self._depth == 1:
+                        if rollback_only:
+                            self._rollback()
+                        else:
+                            self._commit()
+                    else:
+                        if rollback_only:
+                            self.conn.execute(f'ROLLBACK TO {savepoint}')
+                        self.conn.execute(f'RELEASE {savepoint}')
+                finally:
+                    self._depth -= 1
+
+    def _commit(self) -> None:
+        try:
+            self.conn.execute('COMMIT')
+        except sqlite3.Error:
+            # A failed COMMIT (e.g. SQLITE_BUSY) leaves the transaction open on the shared connection
+            self._rollback()
+            raise
+
+    def _rollback(self) -> None:
+        # Some errors already rolled the transaction back, ROLLBACK would fail then
+        if self.conn.in_transaction:
+            self.conn.execute('ROLLBACK')
+
+    def query(self, sql: str, params: Iterable = ()) -> List[Tuple]:
+        """Run a read query and return all rows"""
+        with self._lock:
+            return self.conn.execute(sql, tuple(params)).fetchall()
+
+    def close(self) -> None:
+        with Database._instances_lock:
+            if Database._instances.get(self.db_path) is self:
+                del Database._instances[self.db_path]
+        try:
+            self.conn.close()
+        except sqlite3.Error as e:
+            logging.error(f"Error closing database {self.db_path}: {e}")
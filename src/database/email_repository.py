@@ -1,62 +1,190 @@
 import sqlite3
-from datetime import datetime
-from typing import List, Dict
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
 import logging
+from database.connection import Database
+from database.body_store import compress_body
+from utils.dates import to_epoch
+from utils.metrics import metrics
 
 class EmailDatabase:
     def __init__(self, db_path: str = 'database/email.db'):
         self.db_path = db_path
+        self.db = Database.shared(db_path)
 
-    def insert_emails(self, emails: List[Dict]) -> int:
+    @staticmethod
+    def received_epoch(email: Dict) -> Optional[int]:
         """
-        Insert emails into the database
-        Returns the number of emails successfully inserted
+        When an email was received, as UTC epoch seconds: Gmail's internalDate
+        (milliseconds) when present, else the Date header; None if neither parses
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        inserted_count = 0
+        internal_date = to_epoch(email.get('internal_date'))
+        if internal_date is not None:
+            return internal_date // 1000
+        return to_epoch(email.get('date'))
+
+    @classmethod
+    def _email_rows(cls, emails: Iterable[Dict]) -> Iterator[Dict]:
+        """Convert the email format from Gmail to our database schema"""
+        for email in emails:
+            body_fetched = bool(email.get('body_fetched', True))
+            codec, body = compress_body(email['body']) if body_fetched else (None, None)
+            yield {
+                'message_id': email['message_id'],
+                'from_address': email['sender'],
+                'to_address': email.get('recipient', ''),  # Add default in case recipient is missing
+                'subject': email['subject'],
+                'received_at': cls.received_epoch(email),
+                'body_fetched': int(body_fetched),
+                'codec': codec,
+                'body': body
+            }
 
+    def insert_emails(self, emails: Iterable[Dict]) -> Dict[str, int]:
+        """
+        Upsert emails into the database, keyed by their unique message_id
+        Returns counts of 'inserted' new rows, 'updated' existing rows and
+        'unchanged' rows that already held the same content
+        """
         try:
-            for email in emails:
-                # Convert the email format from Gmail to our database schema
-                email_data = {
-                    'message_id': email['message_id'],
-                    'from_address': email['sender'],
-                    'to_address': email.get('recipient', ''),  # Add default in case recipient is missing
-                    'subject': email['subject'],
-                    'message': email['body'],
-                    'received_at': email['date'],
-                    'is_read': 0,  # Since query specified unread emails
-                    'label': 'inbox'
-                }
-
-                cursor.execute('''
-                INSERT INTO emails (
-                    message_id, from_address, to_address, subject, message, 
-                    received_at, is_read, label
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    email_data['message_id'],
-                    email_data['from_address'],
-                    email_data['to_address'],
-                    email_data['subject'],
-                    email_data['message'],
-                    email_data['received_at'],
-                    email_data['is_read'],
-                    email_data['label']
-                ))
-                inserted_count += 1
-
-            conn.commit()
-            return inserted_count
+            with metrics.timer('db_write_seconds', operation='insert_emails'):
+                with self.db.transaction() as conn:
+                    counts = self._upsert(conn, emails)
+            # inserted + updated over db_write_seconds is the rows written per second
+            for result, count in counts.items():
+                metrics.inc('db_rows_total', count, operation='insert_emails', result=result)
+            return counts
 
         except sqlite3.Error as e:
             logging.error(f"Database error: {e}")
-            conn.rollback()
             raise
         except Exception as e:
             logging.error(f"Error inserting emails: {e}")
-            conn.rollback()
             raise
-        finally:
-            conn.close()
+
+    def _upsert(self, conn: sqlite3.Connection, emails: Iterable[Dict]) -> Dict[str, int]:
+        cursor = conn.cursor()
+
+        # AUTOINCREMENT ids only grow, so rows above the current max are new
+        max_id = cursor.execute('SELECT COALESCE(MAX(id), 0) FROM emails').fetchone()[0]
+
+        # Converted once and kept for the chunk: both statements below read every row, the
+        # body insert needs the ids the upsert assigns, and callers pass one chunk at a time
+        rows = list(self._email_rows(emails))
+
+        # is_read and label are left alone on conflict so local rule actions survive a re-fetch,
+        # changed content (headers or compressed body) is queued for rule evaluation again.
+        # A headers-only (format=metadata) fetch keeps the body already stored.
+        cursor.executemany('''
+        INSERT INTO emails (
+            message_id, from_address, to_address, subject, received_at, body_fetched
+        ) VALUES (:message_id, :from_address, :to_address, :subject, :received_at, :body_fetched)
+        ON CONFLICT(message_id) DO UPDATE SET
+            from_address = excluded.from_address,
+            to_address = excluded.to_address,
+            subject = excluded.subject,
+            received_at = excluded.received_at,
+            body_fetched = MAX(body_fetched, excluded.body_fetched),
+            evaluated_rules_hash = NULL
+        WHERE from_address IS NOT excluded.from_address
+            OR to_address IS NOT excluded.to_address
+            OR subject IS NOT excluded.subject
+            OR received_at IS NOT excluded.received_at
+            OR body_fetched < excluded.body_fetched
+            OR (excluded.body_fetched
+                AND :body IS NOT (SELECT body FROM email_bodies WHERE email_id = emails.id))
+        ''', rows)
+        # rowcount counts the rows the upsert itself wrote, not the FTS triggers' writes
+        changed = cursor.rowcount
+        inserted = cursor.execute('SELECT COUNT(*) FROM emails WHERE id > ?', (max_id,)).fetchone()[0]
+
+        # Bodies go to their own table; the triggers there keep emails_fts in sync
+        cursor.executemany('''
+        INSERT INTO email_bodies (email_id, codec, body)
+        SELECT id, :codec, :body FROM emails WHERE message_id = :message_id
+        ON CONFLICT(email_id) DO UPDATE SET
+            codec = excluded.codec,
+            body = excluded.body
+        WHERE body IS NOT excluded.body
+        ''', (row for row in rows if row['body_fetched']))
+
+        return {
+            'inserted': inserted,
+            'updated': changed - inserted,
+            'unchanged': len(rows) - changed
+        }
+
+    def store_bodies(self, emails: Iterable[Dict]) -> int:
+        """
+        Store the bodies of emails already in the database that were
+        fetched headers-only, leaving their headers and evaluation state
+        as they are
+        Returns the number of emails whose body was stored
+        """
+        stored = 0
+        try:
+            with metrics.timer('db_write_seconds', operation='store_bodies'):
+                with self.db.transaction() as conn:
+                    for row in self._email_rows(emails):
+                        conn.execute('''
+                        INSERT INTO email_bodies (email_id, codec, body)
+                        SELECT id, :codec, :body FROM emails WHERE message_id = :message_id
+                        ON CONFLICT(email_id) DO UPDATE SET
+                            codec = excluded.codec,
+                            body = excluded.body
+                        WHERE body IS NOT excluded.body
+                        ''', row)
+                        stored += conn.execute(
+                            'UPDATE emails SET body_fetched = 1 WHERE message_id = :message_id', row
+                        ).rowcount
+            metrics.inc('db_rows_total', stored, operation='store_bodies', result='updated')
+            return stored
+        except sqlite3.Error as e:
+            logging.error(f"Database error: {e}")
+            raise
+
+    def insert_email_chunks(self, chunks: Iterable[List[Dict]]) -> Dict[str, int]:
+        """
+        Upsert emails chunk by chunk as they arrive, committing each chunk
+        Returns the summed counts of insert_emails
+        """
+        totals = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        for chunk in chunks:
+            for key, count in self.insert_emails(chunk).items():
+                totals[key] += count
+            logging.info(
+                f"Stored {totals['inserted']} new and {totals['updated']} updated emails so far"
+            )
+        return totals
+
+    def delete_emails(self, message_ids: Iterable[str]) -> int:
+        """Delete emails by Gmail message ID, returns the number of rows deleted"""
+        try:
+            with metrics.timer('db_write_seconds', operation='delete_emails'):
+                with self.db.transaction() as conn:
+                    cursor = conn.executemany(
+                        'DELETE FROM emails WHERE message_id = ?',
+                        ((message_id,) for message_id in message_ids)
+                    )
+            metrics.inc('db_rows_total', cursor.rowcount, operation='delete_emails', result='deleted')
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            logging.error(f"Database error: {e}")
+            raise
+
+    def update_label_state(self, states: Iterable[Tuple[str, int, Optional[str]]]) -> int:
+        """
+        Update is_read and label from (message_id, is_read, label) tuples
+        A label of None keeps the stored label
+        """
+        try:
+            with metrics.timer('db_write_seconds', operation='update_label_state'):
+                with self.db.transaction() as conn:
+                    cursor = conn.executemany(
+                        'UPDATE emails SET is_read = ?, label = COALESCE(?, label) WHERE message_id = ?',
+                        ((is_read, label, message_id) for message_id, is_read, label in states)
+                    )
+            metrics.inc('db_rows_total', cursor.rowcount, operation='update_label_state', result='updated')
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            logging.error(f"Database error: {e}")
+            raise
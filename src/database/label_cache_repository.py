@@ -0,0 +1,47 @@
+import sqlite3
+import time
+from typing import Dict, Optional
+import logging
+from database.connection import Database
+
+class LabelCacheRepository:
+    def __init__(self, db_path: str = 'database/email.db', ttl_seconds: int = 3600):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.db = Database.shared(db_path)
+
+    def load(self) -> Optional[Dict[str, str]]:
+        """
+        Load the cached label name -> ID mapping
+        Returns None when nothing was cached within the TTL
+        """
+        try:
+            rows = self.db.query(
+                'SELECT name, label_id FROM label_cache WHERE fetched_at >= ?',
+                (int(time.time()) - self.ttl_seconds,)
+            )
+            return dict(rows) if rows else None
+        except sqlite3.Error as e:
+            logging.error(f"Database error loading label cache: {e}")
+            return None
+
+    def save(self, labels: Dict[str, str]) -> None:
+        """Replace the cached mapping with a fresh labels.list result"""
+        self._write(labels, replace=True)
+
+    def put(self, name: str, label_id: str) -> None:
+        """Add a single label, e.g. one that was just created"""
+        self._write({name: label_id}, replace=False)
+
+    def _write(self, labels: Dict[str, str], replace: bool) -> None:
+        now = int(time.time())
+        try:
+            with self.db.transaction() as conn:
+                if replace:
+                    conn.execute('DELETE FROM label_cache')
+                conn.executemany(
+                    'INSERT OR REPLACE INTO label_cache (name, label_id, fetched_at) VALUES (?, ?, ?)',
+                    [(name, label_id, now) for name, label_id in labels.items()]
+                )
+        except sqlite3.Error as e:
+            logging.error(f"Database error saving label cache: {e}")
@@ -1,12 +1,230 @@
 import sqlite3
-from datetime import datetime
+from database.body_store import compress_body, register_functions
+from utils.dates import to_epoch
 
-def create_email_schema():
+def unique_message_id(cursor):
+    """
+    Make message_id unique so re-running a fetch upserts instead of duplicating
+    Keeps the most recently stored row of each message
+    """
+    cursor.execute('''
+    DELETE FROM emails
+    WHERE id NOT IN (SELECT MAX(id) FROM emails GROUP BY message_id)
+    ''')
+    cursor.execute('DROP INDEX IF EXISTS idx_message_id')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_message_id_unique ON emails(message_id)')
+
+def full_text_index(cursor):
+    """
+    FTS5 index over subject, sender and body, kept in sync with the
+    emails table by triggers
+    """
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+        subject,
+        from_address,
+        message,
+        content='emails',
+        content_rowid='id',
+        prefix='2 3'
+    )
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN
+        INSERT INTO emails_fts (rowid, subject, from_address, message)
+        VALUES (new.id, new.subject, new.from_address, new.message);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, from_address, message)
+        VALUES ('delete', old.id, old.subject, old.from_address, old.message);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS emails_fts_update
+    AFTER UPDATE OF subject, from_address, message ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, from_address, message)
+        VALUES ('delete', old.id, old.subject, old.from_address, old.message);
+        INSERT INTO emails_fts (rowid, subject, from_address, message)
+        VALUES (new.id, new.subject, new.from_address, new.message);
+    END
+    ''')
+    # Index the rows that existed before the triggers
+    cursor.execute("INSERT INTO emails_fts (emails_fts) VALUES ('rebuild')")
+
+def rule_evaluation_watermark(cursor):
+    """
+    Record which rule set version each email was last evaluated under
+    NULL means the email still has to be evaluated
+    """
+    cursor.execute('ALTER TABLE emails ADD COLUMN evaluated_rules_hash TEXT')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_unevaluated ON emails(id)
+    WHERE evaluated_rules_hash IS NULL
+    ''')
+
+def on_demand_bodies(cursor):
+    """
+    Emails fetched with format=metadata have no body (body_fetched = 0)
+    until a rule that reads the message text needs it
+    """
+    cursor.execute('ALTER TABLE emails ADD COLUMN body_fetched INTEGER NOT NULL DEFAULT 1')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_body_missing ON emails(id)
+    WHERE body_fetched = 0
+    ''')
+
+def compressed_bodies(cursor):
+    """
+    Move message bodies out of the emails table into email_bodies,
+    compressed, so scans of the metadata columns don't read them.
+    emails_fts becomes contentless, kept in sync by triggers that read
+    bodies through body_text()
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS email_bodies (
+        email_id INTEGER PRIMARY KEY,
+        codec TEXT NOT NULL,
+        body BLOB NOT NULL
+    )
+    ''')
+    rows = cursor.connection.execute('SELECT id, message FROM emails WHERE body_fetched = 1')
+    cursor.executemany(
+        'INSERT INTO email_bodies (email_id, codec, body) VALUES (?, ?, ?)',
+        ((email_id, *compress_body(message)) for email_id, message in rows)
+    )
+
+    for trigger in ('emails_fts_insert', 'emails_fts_delete', 'emails_fts_update'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    cursor.execute('DROP TABLE IF EXISTS emails_fts')
+    cursor.execute('ALTER TABLE emails DROP COLUMN message')
+
+    cursor.execute('''
+    CREATE VIRTUAL TABLE emails_fts USING fts5(
+        subject,
+        from_address,
+        message,
+        content='',
+        prefix='2 3'
+    )
+    ''')
+    # A contentless index can only delete the exact values it was given,
+    # so every trigger removes what is currently indexed before re-adding
+    body = "COALESCE((SELECT body_text(codec, body) FROM email_bodies WHERE email_id = {id}), '')"
+    cursor.execute('''
+    CREATE TRIGGER emails_fts_insert AFTER INSERT ON emails BEGIN
+        INSERT INTO emails_fts (rowid, subject, from_address, message)
+        VALUES (new.id, new.subject, new.from_address, '');
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER emails_fts_delete AFTER DELETE ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, from_address, message)
+        VALUES ('delete', old.id, old.subject, old.from_address, {body.format(id='old.id')});
+        DELETE FROM email_bodies WHERE email_id = old.id;
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER emails_fts_update
+    AFTER UPDATE OF subject, from_address ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, from_address, message)
+        VALUES ('delete', old.id, old.subject, old.from_address, {body.format(id='old.id')});
+        INSERT INTO emails_fts (rowid, subject, from_address, message)
+        VALUES (new.id, new.subject, new.from_address, {body.format(id='new.id')});
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER email_bodies_fts_insert AFTER INSERT ON email_bodies BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, from_address, message)
+        SELECT 'delete', id, subject, from_address, '' FROM emails WHERE id = new.email_id;
+        INSERT INTO emails_fts (rowid, subject, from_address, message)
+        SELECT id, subject, from_address, body_text(new.codec, new.body)
+        FROM emails WHERE id = new.email_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER email_bodies_fts_update AFTER UPDATE ON email_bodies BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, from_address, message)
+        SELECT 'delete', id, subject, from_address, body_text(old.codec, old.body)
+        FROM emails WHERE id = old.email_id;
+        INSERT INTO emails_fts (rowid, subject, from_address, message)
+        SELECT id, subject, from_address, body_text(new.codec, new.body)
+        FROM emails WHERE id = new.email_id;
+    END
+    ''')
+    cursor.execute(f'''
+    INSERT INTO emails_fts (rowid, subject, from_address, message)
+    SELECT id, subject, from_address, {body.format(id='emails.id')} FROM emails
+    ''')
+
+def epoch_received_at(cursor):
+    """
+    Store received_at as UTC epoch seconds instead of the raw Date header,
+    so date rules compare integers and range-scan idx_received_at.
+    Dates that don't parse become NULL, which no received rule matches.
+    """
+    rows = cursor.execute(
+        "SELECT id, received_at FROM emails WHERE typeof(received_at) != 'integer'"
+    ).fetchall()
+    cursor.executemany(
+        'UPDATE emails SET received_at = ? WHERE id = ?',
+        ((to_epoch(received_at), email_id) for email_id, received_at in rows)
+    )
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_received_at ON emails(received_at)')
+
+def rule_versions(cursor):
+    """
+    Number each rules.json content and keep its per-rule hashes, so a
+    rule edit only re-checks emails against the rules that changed
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS rule_versions (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        rules_hash TEXT NOT NULL UNIQUE,
+        rule_hashes TEXT NOT NULL,
+        created_at INTEGER NOT NULL
+    )
+    ''')
+    # Finds the rule versions emails were last evaluated under without a table scan
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_evaluated_rules_hash ON emails(evaluated_rules_hash)'
+    )
+
+# Applied in order to existing databases, tracked by PRAGMA user_version
+MIGRATIONS = [
+    unique_message_id,
+    full_text_index,
+    rule_evaluation_watermark,
+    on_demand_bodies,
+    compressed_bodies,
+    epoch_received_at,
+    rule_versions,
+]
+
+# Migrations that free a lot of pages, followed by a VACUUM to shrink the file
+VACUUM_AFTER = {compressed_bodies}
+
+def run_migrations(conn):
+    """Apply the migrations a database hasn't had yet"""
+    cursor = conn.cursor()
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    vacuum = False
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(cursor)
+        cursor.execute(f'PRAGMA user_version = {number}')
+        conn.commit()
+        vacuum = vacuum or migration in VACUUM_AFTER
+    if vacuum:
+        cursor.execute('VACUUM')
+
+def create_email_schema(db_path: str = 'email.db'):
     """
     Creates the email messages table in SQLite database
     """
     # Connect to SQLite database (creates file if it doesn't exist)
-    conn = sqlite3.connect('email.db')
+    conn = sqlite3.connect(db_path)
+    register_functions(conn)
     cursor = conn.cursor()
 
     # Create the emails table
@@ -26,14 +244,33 @@ def create_email_schema():
 
     # Create indexes for common query patterns
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_from_address ON emails(from_address)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_message_id ON emails(message_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_to_address ON emails(to_address)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_label ON emails(label)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_received_at ON emails(received_at)')
 
+    # Gmail label name -> ID cache, so short runs can skip labels.list
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS label_cache (
+        name TEXT PRIMARY KEY,
+        label_id TEXT NOT NULL,
+        fetched_at INTEGER NOT NULL
+    )
+    ''')
+
+    # Sync checkpoints such as the last Gmail historyId
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sync_state (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        updated_at INTEGER NOT NULL
+    )
+    ''')
+
     # Commit the changes and close the connection
     conn.commit()
+    run_migrations(conn)
     conn.close()
 
 if __name__ == '__main__':
-    create_email_schema()
\ No newline at end of file
+    # Run from src as `python -m database.migration`, the path the scripts use
+    create_email_schema('database/email.db')
\ No newline at end of file
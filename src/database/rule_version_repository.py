@@ -0,0 +1,34 @@
+import json
+import sqlite3
+import time
+from typing import List, Optional
+import logging
+from database.connection import Database
+
+class RuleVersionRepository:
+    """Every distinct rules.json content seen, numbered in the order it was first loaded"""
+
+    def __init__(self, db_path: str = 'database/email.db'):
+        self.db_path = db_path
+        self.db = Database.shared(db_path)
+
+    def register(self, rules_hash: str, rule_hashes: List[str]) -> int:
+        """Record a rule set version if it is new, returns its version number"""
+        try:
+            with self.db.transaction() as conn:
+                conn.execute(
+                    'INSERT OR IGNORE INTO rule_versions (rules_hash, rule_hashes, created_at) '
+                    'VALUES (?, ?, ?)',
+                    (rules_hash, json.dumps(rule_hashes), int(time.time()))
+                )
+                return conn.execute(
+                    'SELECT version FROM rule_versions WHERE rules_hash = ?', (rules_hash,)
+                ).fetchone()[0]
+        except sqlite3.Error as e:
+            logging.error(f"Database error registering rule version: {e}")
+            raise
+
+    def rule_hashes(self, rules_hash: str) -> Optional[List[str]]:
+        """The per-rule hashes of a registered version, None for an unknown version"""
+        rows = self.db.query('SELECT rule_hashes FROM rule_versions WHERE rules_hash = ?', (rules_hash,))
+        return json.loads(rows[0][0]) if rows else None
@@ -0,0 +1,31 @@
+import sqlite3
+import time
+from typing import Optional
+import logging
+from database.connection import Database
+
+class SyncStateRepository:
+    def __init__(self, db_path: str = 'database/email.db'):
+        self.db_path = db_path
+        self.db = Database.shared(db_path)
+
+    def get(self, key: str) -> Optional[str]:
+        """Get a stored checkpoint value, or None if it was never saved"""
+        try:
+            rows = self.db.query('SELECT value FROM sync_state WHERE key = ?', (key,))
+            return rows[0][0] if rows else None
+        except sqlite3.Error as e:
+            logging.error(f"Database error reading sync state: {e}")
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        """Store a checkpoint value"""
+        try:
+            with self.db.transaction() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO sync_state (key, value, updated_at) VALUES (?, ?, ?)',
+                    (key, str(value), int(time.time()))
+                )
+        except sqlite3.Error as e:
+            logging.error(f"Database error saving sync state: {e}")
+            raise
@@ -0,0 +1,88 @@
+import logging
+from typing import Dict, List, Tuple
+from email_manager.rule_compiler import CompiledRule
+
+# (labels to add, labels to remove, local column updates), all sorted
+Delta = Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[Tuple[str, object], ...]]
+
+
+def action_changes(action: Dict) -> Tuple[Tuple[str, ...], Tuple[str, ...], Dict]:
+    """Translate a rule action into Gmail labels to add/remove and local DB updates"""
+    if action['type'] == 'move':
+        label = action['value'].upper()
+        # Moving to the inbox only adds INBOX, removing it as well would cancel the move
+        remove = () if label == 'INBOX' else ('INBOX',)
+        return (label,), remove, {'label': action['value'].lower()}
+    if action['type'] == 'mark_as':
+        if action['value'] == 'read':
+            return (), ('UNREAD',), {'is_read': 1}
+        if action['value'] == 'unread':
+            return ('UNREAD',), (), {'is_read': 0}
+    raise ValueError(f"Unknown action {action}")
+
+
+class ActionPlanner:
+    """
+    Merges the actions of every rule matching an email into one net
+    change per email, then groups emails with the same change so each
+    group is a single Gmail batchModify and a single SQL UPDATE.
+
+    Conflicts are settled by rule order: an email gets at most one action
+    of each type (one move, one mark_as), taken from the earliest matching
+    rule in rules.json, and when the chosen actions add and remove the
+    same label the earlier rule wins too.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        # message_id -> action type -> (rule position, action_changes of the action)
+        self._chosen: Dict[str, Dict[str, Tuple[int, Tuple]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._chosen)
+
+    def add(self, message_id: str, rule: CompiledRule) -> None:
+        """Record that rule matched the email"""
+        chosen = self._chosen.setdefault(message_id, {})
+        for action in rule.actions:
+            try:
+                changes = action_changes(action)
+            except (KeyError, AttributeError, ValueError) as e:
+                self.logger.error(f"Error applying action {action}: {e}")
+                continue
+            kind = action['type']
+            if kind not in chosen or rule.position < chosen[kind][0]:
+                chosen[kind] = (rule.position, changes)
+
+    @staticmethod
+    def _delta(chosen: Dict[str, Tuple[int, Tuple]]) -> Delta:
+        add, remove, updates = set(), set(), {}
+        # Apply the latest rule first so earlier rules overwrite its changes
+        for _, (add_labels, remove_labels, column_updates) in sorted(
+                chosen.values(), key=lambda item: -item[0]):
+            add.difference_update(remove_labels)
+            remove.difference_update(add_labels)
+            add.update(add_labels)
+            remove.update(remove_labels)
+            updates.update(column_updates)
+        return tuple(sorted(add)), tuple(sorted(remove)), tuple(sorted(updates.items()))
+
+    def plan(self) -> Dict[Delta, List[str]]:
+        """Group the emails by their net change, dropping emails left with nothing to do"""
+        groups: Dict[Delta, List[str]] = {}
+        for message_id, chosen in self._chosen.items():
+            delta = self._delta(chosen)
+            if any(delta):
+                groups.setdefault(delta, []).append(message_id)
+        return groups
+
+    @staticmethod
+    def describe(plan: Dict[Delta, List[str]]) -> List[str]:
+        """One readable line per group, for dry runs"""
+        lines = []
+        for (add_labels, remove_labels, updates), message_ids in plan.items():
+            lines.append(
+                f"{len(message_ids)} emails: add {list(add_labels)}, remove {list(remove_labels)}, "
+                f"set {dict(updates)} -> {', '.join(message_ids)}"
+            )
+        return lines
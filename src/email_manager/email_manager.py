@@ -1,12 +1,23 @@
 import sqlite3
-from typing import List, Union
+import json
+from typing import Dict, List, Optional, Union
 from gmail.gmail_manager import GmailManager
+from database.connection import Database
 import logging
 
+# Searchable fields -> columns of the emails_fts index
+SEARCH_COLUMNS = {
+    'subject': 'subject',
+    'from': 'from_address',
+    'message': 'message'
+}
+
 class EmailManager:
-    def __init__(self, db_path: str = 'database/email.db'):
+    def __init__(self, db_path: str = 'database/email.db',
+                 gmail: Optional[GmailManager] = None):
         self.db_path = db_path
-        self.gmail = GmailManager()
+        self.db = Database.shared(db_path)
+        self.gmail = gmail or GmailManager()
         self._setup_logging()
 
     def _setup_logging(self):
@@ -18,47 +29,63 @@ class EmailManager:
 
     def _update_local_db(self, email_ids: Union[str, List[str]], 
                         updates: dict) -> bool:
-        """Update email records in local database"""
+        """Update email records, identified by Gmail message ID, in local database"""
         if isinstance(email_ids, str):
             email_ids = [email_ids]
+        if not email_ids:
+            return True
 
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         try:
             # Build the UPDATE query dynamically based on provided updates
             set_clause = ', '.join([f"{k} = ?" for k in updates.keys()])
-            placeholders = list(updates.values()) + email_ids
-            
-            cursor.execute(f"""
-                UPDATE emails 
-                SET {set_clause}
-                WHERE id IN ({','.join(['?'] * len(email_ids))})
-            """, placeholders)
-            
-            conn.commit()
+            values = list(updates.values())
+
+            # A single UPDATE for all the emails, their IDs passed as one JSON array
+            with self.db.transaction() as conn:
+                conn.execute(f"""
+                    UPDATE emails 
+                    SET {set_clause}
+                    WHERE message_id IN (SELECT value FROM json_each(?))
+                """, values + [json.dumps(list(email_ids))])
             return True
         except sqlite3.Error as e:
             self.logger.error(f"Database error: {e}")
-            conn.rollback()
             return False
-        finally:
-            conn.close()
+
+    def apply_label_changes(self, email_ids: Union[str, List[str]],
+                            add_labels: List[str],
+                            remove_labels: List[str],
+                            updates: dict) -> Dict[str, List[str]]:
+        """
+        Apply one label change to many emails in Gmail, then update only the
+        emails Gmail actually modified in the local database
+        """
+        if isinstance(email_ids, str):
+            email_ids = [email_ids]
+
+        result = self.gmail.batch_modify_messages(
+            message_ids=email_ids,
+            add_labels=add_labels,
+            remove_labels=remove_labels
+        )
+
+        if result['succeeded'] and not self._update_local_db(result['succeeded'], updates):
+            self.logger.error(
+                f"Gmail was updated but the local database was not for "
+                f"{len(result['succeeded'])} emails"
+            )
+        return result
 
     def mark_as_read(self, email_ids: Union[str, List[str]]) -> bool:
         """Mark emails as read in both Gmail and local database"""
         try:
-            # Mark as read in Gmail
-            success = self.gmail.modify_messages(
-                message_ids=email_ids,
-                add_labels=['UNREAD'],
-                remove_labels=[]
+            result = self.apply_label_changes(
+                email_ids,
+                add_labels=[],
+                remove_labels=['UNREAD'],
+                updates={'is_read': 1}
             )
-            
-            if success:
-                # Update local database
-                return self._update_local_db(email_ids, {'is_read': 1})
-            return False
+            return not result['failed']
             
         except Exception as e:
             self.logger.error(f"Error marking emails as read: {e}")
@@ -67,17 +94,13 @@ class EmailManager:
     def mark_as_unread(self, email_ids: Union[str, List[str]]) -> bool:
         """Mark emails as unread in both Gmail and local database"""
         try:
-            # Mark as unread in Gmail
-            success = self.gmail.modify_messages(
-                message_ids=email_ids,
+            result = self.apply_label_changes(
+                email_ids,
                 add_labels=['UNREAD'],
-                remove_labels=[]
+                remove_labels=[],
+                updates={'is_read': 0}
             )
-            
-            if success:
-                # Update local database
-                return self._update_local_db(email_ids, {'is_read': 0})
-            return False
+            return not result['failed']
             
         except Exception as e:
             self.logger.error(f"Error marking emails as unread: {e}")
@@ -92,38 +115,86 @@ class EmailManager:
             gmail_label = new_label.upper()
             
             # Prepare labels to remove if requested
-            remove_labels = ['INBOX'] if remove_current else []
+            remove_labels = ['INBOX'] if remove_current and gmail_label != 'INBOX' else []
             
-            # Move in Gmail
-            success = self.gmail.modify_messages(
-                message_ids=email_ids,
+            result = self.apply_label_changes(
+                email_ids,
                 add_labels=[gmail_label],
-                remove_labels=remove_labels
+                remove_labels=remove_labels,
+                updates={'label': new_label.lower()}
             )
-            
-            if success:
-                # Update local database
-                return self._update_local_db(email_ids, {'label': new_label.lower()})
-            return False
+            return not result['failed']
             
         except Exception as e:
             self.logger.error(f"Error moving emails to label {new_label}: {e}")
             return False
 
-    def get_email_ids_by_query(self, query: str) -> List[str]:
-        """Get email IDs from local database based on a query"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    @staticmethod
+    def _fts_match_expression(query: str, fields: Optional[List[str]] = None,
+                              prefix: bool = False) -> str:
+        """
+        Build an FTS5 MATCH expression: every word must appear, quoted so
+        user input can't inject FTS syntax, optionally as a prefix and
+        limited to some columns
+        """
+        terms = ['"' + term.replace('"', '""') + '"' + ('*' if prefix else '')
+                 for term in query.split()]
+        expression = ' '.join(terms)
+
+        if fields:
+            columns = []
+            for field in fields:
+                if field not in SEARCH_COLUMNS:
+                    raise ValueError(f"Cannot search field '{field}'")
+                columns.append(SEARCH_COLUMNS[field])
+            expression = '{' + ' '.join(columns) + '} : (' + expression + ')'
+        return expression
+
+    def get_email_ids_by_query(self, query: str,
+                               fields: Optional[List[str]] = None,
+                               prefix: bool = False,
+                               limit: Optional[int] = None) -> List[str]:
+        """
+        Get email IDs from local database based on a query, best match first
         
+        Args:
+            query: Words that must all appear
+            fields: Restrict the search to some of 'subject', 'from' and 'message'
+            prefix: Match words starting with each query word
+            limit: Maximum number of IDs to return
+        """
+        if not query.strip():
+            return []
+
+        try:
+            rows = self.db.query("""
+                SELECT rowid FROM emails_fts
+                WHERE emails_fts MATCH ?
+                ORDER BY bm25(emails_fts)
+                LIMIT ?
+            """, (self._fts_match_expression(query, fields, prefix), limit or -1))
+            
+            return [str(row[0]) for row in rows]
+        except sqlite3.OperationalError as e:
+            # Databases without the FTS migration fall back to a table scan
+            self.logger.warning(f"Full-text search unavailable ({e}), scanning emails")
+            return self._get_email_ids_by_like(query, fields, limit)
+
+    def _get_email_ids_by_like(self, query: str, fields: Optional[List[str]] = None,
+                               limit: Optional[int] = None) -> List[str]:
+        # Only databases from before the FTS migration get here; bodies are
+        # still in emails.message then, email_bodies doesn't exist yet
+        columns = [SEARCH_COLUMNS[field] for field in fields] if fields else list(SEARCH_COLUMNS.values())
+        where = ' OR '.join(f"{column} LIKE ?" for column in columns)
+
         try:
-            cursor.execute("""
+            rows = self.db.query(f"""
                 SELECT id FROM emails 
-                WHERE subject LIKE ? OR from_address LIKE ? OR message LIKE ?
-            """, (f"%{query}%", f"%{query}%", f"%{query}%"))
+                WHERE {where}
+                LIMIT ?
+            """, [f"%{query}%"] * len(columns) + [limit or -1])
             
-            return [str(row[0]) for row in cursor.fetchall()]
+            return [str(row[0]) for row in rows]
         except sqlite3.Error as e:
             self.logger.error(f"Database error: {e}")
             return []
-        finally:
-            conn.close()
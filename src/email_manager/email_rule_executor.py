@@ -1,16 +1,44 @@
 import sqlite3
-from typing import List, Dict
+from typing import Iterator, List, Dict, Optional, Set, Tuple
 import json
 from email_manager.email_manager import EmailManager
-from datetime import datetime, timedelta
+from gmail.gmail_manager import GmailManager
+from database.connection import Database
+from database.sync_state_repository import SyncStateRepository
+from database.email_repository import EmailDatabase
+from database.body_store import column_sql
+from database.rule_version_repository import RuleVersionRepository
+from email_manager.rule_compiler import CompiledRule, CompiledRuleSet
+from email_manager.rule_evaluator import RuleEvaluator, BATCH_SCOPE, ID_SCOPE, VERSION_SCOPE
+from email_manager.rule_schema import RuleValidationError
+from email_manager.rule_set import RuleSet, file_stamp
+from email_manager.parallel_evaluator import ParallelRuleEvaluation
+from email_manager.action_planner import ActionPlanner, Delta
+from utils.chunking import chunked
+from utils.metrics import metrics
+from datetime import datetime, timezone
 import logging
 
+# Bodies downloaded per messages.get batch when a rule starts reading message text
+BODY_FETCH_CHUNK = 100
+
+# Bodies live in email_bodies and are only read when 'message' is asked for
+EMAIL_COLUMNS = ['id', 'message_id', 'from_address', 'to_address', 'subject',
+                 'received_at', 'is_read', 'label']
+
 class EmailRuleExecutor:
-    def __init__(self, db_path: str = 'database/email.db', rules_path: str = 'rules.json'):
+    def __init__(self, db_path: str = 'database/email.db', rules_path: str = 'rules.json',
+                 gmail: Optional[GmailManager] = None):
         self.db_path = db_path
-        self.manager = EmailManager()
-        self.rules = self._load_rules(rules_path)
+        self.db = Database.shared(db_path)
+        self.manager = EmailManager(db_path, gmail)
         self._setup_logging()
+        self.rules_path = rules_path
+        # Replaced as a whole by reload_rules; an invalid rules file at startup is an error
+        self.rule_set = RuleSet.load(rules_path)
+        self._rejected_stamp = None
+        self.versions = RuleVersionRepository(db_path)
+        self.state = SyncStateRepository(db_path)
 
     def _setup_logging(self):
         logging.basicConfig(
@@ -19,152 +47,309 @@ class EmailRuleExecutor:
         )
         self.logger = logging.getLogger(__name__)
 
-    def _load_rules(self, rules_path: str) -> Dict:
-        """Load rules from JSON file"""
+    # The current rule set's parts, read through self.rule_set so a reload swaps them together
+    @property
+    def rules(self) -> Dict:
+        return self.rule_set.document
+
+    @property
+    def compiled_rules(self) -> CompiledRuleSet:
+        return self.rule_set.compiled
+
+    @property
+    def rules_by_position(self) -> Dict[int, CompiledRule]:
+        return self.rule_set.by_position
+
+    @property
+    def rules_hash(self) -> str:
+        return self.rule_set.rules_hash
+
+    @property
+    def evaluator(self) -> RuleEvaluator:
+        return RuleEvaluator(self.db.query, self.rule_set.compiled)
+
+    def reload_rules(self) -> bool:
+        """
+        Swap in rules.json if it changed on disk and passes validation.
+        An invalid file is logged and the current rules stay in use.
+        Returns whether the rules changed
+        """
+        stamp = file_stamp(self.rules_path)
+        if stamp is None or stamp in (self.rule_set.stamp, self._rejected_stamp):
+            return False
+
         try:
-            with open(rules_path, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            self.logger.error(f"Error loading rules: {e}")
-            return {"rules": []}
-
-    def get_recent_emails(self, limit: int = 5) -> List[Dict]:
-        """Get the most recent emails from SQLite database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+            rule_set = RuleSet.load(self.rules_path)
+        except (OSError, ValueError) as e:
+            # RuleValidationError is a ValueError, as are JSON syntax errors
+            self._rejected_stamp = stamp
+            errors = e.errors if isinstance(e, RuleValidationError) else [str(e)]
+            self.logger.error(
+                f"Keeping the current rules, {self.rules_path} is invalid: " + '; '.join(errors)
+            )
+            return False
+
+        if rule_set.rules_hash == self.rule_set.rules_hash:
+            self.rule_set = rule_set
+            return False
+
+        changed = rule_set.added_since(self.rule_set.rule_hashes)
+        self.rule_set = rule_set
+        self.logger.info(
+            f"Reloaded {self.rules_path}: {len(rule_set.compiled)} rules, "
+            f"{len(changed)} new or changed: {[rule.name for rule in changed]}"
+        )
+        return True
+
+    def get_recent_emails(self, limit: int = 5,
+                          columns: Optional[List[str]] = None) -> List[Dict]:
+        """
+        Get the most recent emails from SQLite database
+        Only the given columns are read when columns is set; include
+        'message' to load the bodies
+        """
+        columns = columns or EMAIL_COLUMNS
         try:
-            cursor.execute("""
-                SELECT 
-                    id,
-                    message_id,
-                    from_address,
-                    to_address,
-                    subject,
-                    message,
-                    received_at,
-                    is_read,
-                    label
+            rows = self.db.query(f"""
+                SELECT {', '.join(column_sql(c) for c in columns)}
                 FROM emails 
                 ORDER BY id DESC 
                 LIMIT ?
             """, (limit,))
-            
-            columns = ['id', 'message_id', 'from_address', 'to_address', 'subject', 
-                      'message', 'received_at', 'is_read', 'label']
-            emails = []
-            
-            for row in cursor.fetchall():
-                email_dict = dict(zip(columns, row))
-                emails.append(email_dict)
-                
-            return emails
+
+            return [dict(zip(columns, row)) for row in rows]
             
         except sqlite3.Error as e:
             self.logger.error(f"Database error: {e}")
             return []
-        finally:
-            conn.close()
-
-    def _evaluate_condition(self, email: Dict, condition: Dict) -> bool:
-        """Evaluate a single condition against an email"""
-        field_value = {
-            'from': email['from_address'],
-            'to': email['to_address'],
-            'subject': email['subject'],
-            'message': email['message'],
-            'received': email['received_at']
-        }.get(condition['field'])
-        print(field_value)
-        if not field_value:
-            return False
 
-        if condition['field'] == 'received':
-            email_date = datetime.strptime(field_value, '%Y-%m-%d %H:%M:%S')
-            current_time = datetime.now()
-            
-            value_parts = condition['value'].split('_')
-            number = int(value_parts[0])
-            unit = value_parts[1]
-            
-            if unit == 'day':
-                delta = timedelta(days=number)
-            elif unit == 'month':
-                delta = timedelta(days=number * 30)
-            
-            if condition['predicate'] == 'less_than':
-                return (current_time - email_date) < delta
-            elif condition['predicate'] == 'greater_than':
-                return (current_time - email_date) > delta
-        else:
-            if condition['predicate'] == 'contains':
-                return condition['value'].lower() in field_value.lower()
-            elif condition['predicate'] == 'does_not_contain':
-                return condition['value'].lower() not in field_value.lower()
-            elif condition['predicate'] == 'equals':
-                return condition['value'].lower() == field_value.lower()
-            elif condition['predicate'] == 'does_not_equal':
-                return condition['value'].lower() != field_value.lower()
-
-        return False
-
-    def _evaluate_rule(self, email: Dict, rule: Dict) -> bool:
-        """Evaluate all conditions in a rule against an email"""
-        results = [
-            self._evaluate_condition(email, condition)
-            for condition in rule['conditions']
-        ]
-        
-        if rule['match_type'] == 'all':
-            return all(results)
-        return any(results)
-
-    def _apply_actions(self, email_id: str, actions: List[Dict]) -> None:
-        """Apply all actions for a matching rule"""
-        for action in actions:
+    def _fetch_missing_bodies(self, scope: str = 'evaluated_rules_hash IS NULL',
+                              scope_params: Tuple = ()) -> int:
+        """
+        Download the bodies of the emails in scope that were fetched
+        headers-only, when the rules read the message text; pending emails
+        by default. Their evaluation state is left as it is
+        Returns the number of bodies stored
+        """
+        if not self.compiled_rules.needs_body:
+            return 0
+
+        rows = self.db.query(f'''
+            SELECT message_id FROM emails
+            WHERE body_fetched = 0 AND {scope}
+            ORDER BY id
+        ''', scope_params)
+        if not rows:
+            return 0
+
+        self.logger.info(f"Rules read message bodies, fetching {len(rows)} missing bodies")
+        emails = self.manager.gmail.fetch_messages(row[0] for row in rows)
+        database = EmailDatabase(self.db_path)
+        fetched = sum(database.store_bodies(chunk) for chunk in chunked(emails, BODY_FETCH_CHUNK))
+        if fetched < len(rows):
+            self.logger.warning(
+                f"{len(rows) - fetched} bodies could not be fetched, "
+                f"those emails are evaluated without their message text"
+            )
+        return fetched
+
+    def _apply_pending(self, pending: Dict[Delta, List[str]]) -> Set[str]:
+        """
+        Apply each planned label change once for all the emails it covers
+        Returns the message IDs where a change failed
+        """
+        failed = set()
+        for (add_labels, remove_labels, updates), email_ids in pending.items():
             try:
-                if action['type'] == 'move':
-                    success = self.manager.move_to_label(email_id, action['value'])
-                    self.logger.info(
-                        f"Moved email {email_id} to {action['value']}: "
-                        f"{'Success' if success else 'Failed'}"
+                with metrics.timer('action_apply_seconds'):
+                    result = self.manager.apply_label_changes(
+                        email_ids,
+                        add_labels=list(add_labels),
+                        remove_labels=list(remove_labels),
+                        updates=dict(updates)
                     )
-                    
-                elif action['type'] == 'mark_as':
-                    if action['value'] == 'read':
-                        success = self.manager.mark_as_read(email_id)
-                        self.logger.info(
-                            f"Marked email {email_id} as read: "
-                            f"{'Success' if success else 'Failed'}"
-                        )
-                    elif action['value'] == 'unread':
-                        success = self.manager.mark_as_unread(email_id)
-                        self.logger.info(
-                            f"Marked email {email_id} as unread: "
-                            f"{'Success' if success else 'Failed'}"
-                        )
-                        
+                metrics.inc('actions_applied_total', len(result['succeeded']), result='succeeded')
+                metrics.inc('actions_applied_total', len(result['failed']), result='failed')
+                failed.update(result['failed'])
+                self.logger.info(
+                    f"Added {list(add_labels)}, removed {list(remove_labels)} "
+                    f"on {len(result['succeeded'])} emails, "
+                    f"{len(result['failed'])} failed"
+                )
             except Exception as e:
-                self.logger.error(f"Error applying action {action}: {e}")
-
-    def process_emails(self, limit: int = 5) -> None:
-        """Process recent emails against all rules"""
-        emails = self.get_recent_emails(limit)
-        
-        self.logger.info(f"Processing {len(emails)} recent emails")
-        
-        for email in emails:
-            for rule in self.rules['rules']:
-                try:
-                    if self._evaluate_rule(email, rule):
-                        self.logger.info(
-                            f"Rule '{rule['name']}' matched for email: "
-                            f"{email['subject']}"
-                        )
-                        self._apply_actions(email['message_id'], rule['actions'])
-                except Exception as e:
-                    self.logger.error(
-                        f"Error processing rule '{rule['name']}' "
-                        f"for email {email['message_id']}: {e}"
+                failed.update(email_ids)
+                metrics.inc('actions_applied_total', len(email_ids), result='failed')
+                self.logger.error(
+                    f"Error adding {list(add_labels)}, removing {list(remove_labels)} "
+                    f"on {len(email_ids)} emails: {e}"
+                )
+        return failed
+
+    def _reconcile_rule_versions(self, planner: Optional[ActionPlanner] = None) -> None:
+        """
+        Bring emails evaluated under an earlier rule set up to the current one.
+        The unchanged rules already acted on those emails, so they are only
+        checked against the new or changed rules, and only those rules'
+        actions are applied before they are stamped with the current version.
+        Removed rules need nothing, the actions they applied stay applied,
+        and reordering rules changes no rule. Emails evaluated under a
+        version with no recorded rules are all evaluated again.
+
+        With a planner, the new rules' actions are added to it instead of
+        applied and no bodies are fetched, for plan_emails
+        """
+        current = self.rule_set
+        version = self.versions.register(current.rules_hash, current.rule_hashes)
+        stamps = [row[0] for row in self.db.query('''
+            SELECT DISTINCT evaluated_rules_hash FROM emails
+            WHERE evaluated_rules_hash IS NOT NULL AND evaluated_rules_hash != ?
+        ''', (current.rules_hash,))]
+        now = datetime.now(timezone.utc)
+
+        for stamp in stamps:
+            previous = self.versions.rule_hashes(stamp)
+            if previous is None:
+                with self.db.transaction() as conn:
+                    cursor = conn.execute(
+                        f'UPDATE emails SET evaluated_rules_hash = NULL WHERE {VERSION_SCOPE}', (stamp,)
                     )
+                self.logger.info(
+                    f"Re-evaluating {cursor.rowcount} emails last evaluated under unrecorded rules"
+                )
+                continue
+
+            added = current.added_since(previous)
+            matches = 0
+            failed: Set[str] = set()
+            if added:
+                added_rules = CompiledRuleSet(added)
+                if added_rules.needs_body and planner is None:
+                    # A headers-only email can't be checked until its body is fetched
+                    self._fetch_missing_bodies(VERSION_SCOPE, (stamp,))
+                added_planner = ActionPlanner() if planner is None else planner
+                for message_id, rule in RuleEvaluator(self.db.query, added_rules).matches_version(stamp, now):
+                    added_planner.add(message_id, rule)
+                    matches += 1
+                if planner is None:
+                    failed = self._apply_pending(added_planner.plan())
+
+            # Emails whose new actions failed keep the earlier version and are retried on the next run
+            with self.db.transaction() as conn:
+                restamped = conn.execute(
+                    f'UPDATE emails SET evaluated_rules_hash = ? WHERE {VERSION_SCOPE} '
+                    'AND message_id NOT IN (SELECT value FROM json_each(?))',
+                    (current.rules_hash, stamp, json.dumps(sorted(failed)))
+                ).rowcount
+            self.logger.info(
+                f"Rules version {version}: {len(added)} new or changed rules "
+                f"{[rule.name for rule in added]} matched {matches} times among earlier evaluated "
+                f"emails, {restamped} emails restamped, {len(failed)} left for retry"
+            )
+
+    def reset_evaluations(self) -> None:
+        """Forget which emails were evaluated so the next run processes all of them"""
+        with self.db.transaction() as conn:
+            conn.execute('UPDATE emails SET evaluated_rules_hash = NULL')
+
+    def _process_batch(self, first_id: int, last_id: int) -> None:
+        """Evaluate the unevaluated emails with ids in [first_id, last_id] and apply their actions"""
+        planner = ActionPlanner()
+        for message_id, rule in self.evaluator.matches(first_id, last_id, datetime.now(timezone.utc)):
+            planner.add(message_id, rule)
 
+        self._apply_and_mark(planner.plan(), [(first_id, last_id)])
+
+    def _apply_and_mark(self, pending: Dict[Delta, List[str]],
+                        ranges: List[Tuple[int, int]]) -> None:
+        """
+        Apply planned changes, then stamp the evaluated id ranges in a short
+        transaction; the Gmail calls hold no lock on the shared connection
+        """
+        failed = json.dumps(sorted(self._apply_pending(pending)))
+        # Emails whose actions failed stay unevaluated and are retried on the next run
+        with self.db.transaction() as conn:
+            conn.executemany(f"""
+                UPDATE emails SET evaluated_rules_hash = ?
+                WHERE {BATCH_SCOPE}
+                AND message_id NOT IN (SELECT value FROM json_each(?))
+            """, ((self.rules_hash, first_id, last_id, failed) for first_id, last_id in ranges))
+
+    def _mark_evaluated_ids(self, ids: List[int], failed: Set[str]) -> None:
+        """Stamp emails by row id as evaluated, except those whose actions failed"""
+        with self.db.transaction() as conn:
+            conn.execute(
+                f'UPDATE emails SET evaluated_rules_hash = ? WHERE {ID_SCOPE} '
+                'AND message_id NOT IN (SELECT value FROM json_each(?))',
+                (self.rules_hash, json.dumps(list(ids)), json.dumps(sorted(failed)))
+            )
+
+    def _unevaluated_ranges(self, batch_size: int,
+                            max_emails: Optional[int] = None) -> Iterator[Tuple[int, int, int]]:
+        """Yield (first_id, last_id, count) for id-ordered batches of unevaluated emails"""
+        processed = 0
+        after_id = 0
+        while max_emails is None or processed < max_emails:
+            size = batch_size if max_emails is None else min(batch_size, max_emails - processed)
+            first_id, last_id, count = self.db.query("""
+                SELECT MIN(id), MAX(id), COUNT(*) FROM (
+                    SELECT id FROM emails
+                    WHERE evaluated_rules_hash IS NULL AND id > ?
+                    ORDER BY id
+                    LIMIT ?
+                )
+            """, (after_id, size))[0]
+            if not count:
+                return
+
+            yield first_id, last_id, count
+            processed += count
+            after_id = last_id
+
+    def process_emails(self, batch_size: int = 500, max_emails: Optional[int] = None,
+                       workers: int = 1) -> int:
+        """
+        Process every email not yet evaluated under the current rules,
+        new or changed, in id-ordered batches
+        With workers > 1 the batches are evaluated in a process pool
+        Returns the number of emails processed
+        """
+        self._reconcile_rule_versions()
+        self._fetch_missing_bodies()
+
+        if workers > 1:
+            processed = ParallelRuleEvaluation(self, workers).run(batch_size, max_emails)
+        else:
+            processed = 0
+            for first_id, last_id, count in self._unevaluated_ranges(batch_size, max_emails):
+                self._process_batch(first_id, last_id)
+                processed += count
+
+        self.logger.info(f"Processed {processed} new or changed emails")
+        return processed
+
+    def plan_emails(self, batch_size: int = 500, max_emails: Optional[int] = None,
+                    all_emails: bool = False) -> Dict[Delta, List[str]]:
+        """
+        Plan what process_emails would change, without calling Gmail or
+        changing the database
+        With all_emails, plan for every email as after reset_evaluations
+        """
+        planner = ActionPlanner()
+        now = datetime.now(timezone.utc)
+        # Rolled back, so resetting evaluations only affects the plan
+        with self.db.transaction(rollback_only=True):
+            if all_emails:
+                self.reset_evaluations()
+            self._reconcile_rule_versions(planner)
+            if self.compiled_rules.needs_body:
+                missing = self.db.query(
+                    'SELECT COUNT(*) FROM emails WHERE body_fetched = 0 AND evaluated_rules_hash IS NULL'
+                )[0][0]
+                if missing:
+                    self.logger.warning(
+                        f"{missing} emails have no body yet, the plan treats their message text as empty"
+                    )
+            for first_id, last_id, _ in self._unevaluated_ranges(batch_size, max_emails):
+                for message_id, rule in self.evaluator.matches(first_id, last_id, now):
+                    planner.add(message_id, rule)
+        return planner.plan()
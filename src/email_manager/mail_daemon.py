@@ -0,0 +1,243 @@
+import base64
+import binascii
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlparse
+from gmail.gmail_manager import GmailManager
+from email_manager.mailbox_sync import MailboxSync
+from email_manager.email_rule_executor import EmailRuleExecutor
+from email_manager.rule_set import file_stamp
+
+# Gmail expects users.watch to be renewed at least every 7 days, daily is recommended
+WATCH_RENEW_SECONDS = 24 * 60 * 60
+
+DEFAULT_WEBHOOK_PORT = 8085
+
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    """
+    Accepts change notifications over HTTP: Cloud Pub/Sub push deliveries
+    of a Gmail watch, or a bare POST from anything that knows mail arrived.
+    Only wakes the daemon; the sync itself runs on the daemon's thread.
+    """
+
+    def do_POST(self):
+        daemon = self.server.mail_daemon
+        if daemon.webhook_token:
+            token = parse_qs(urlparse(self.path).query).get('token', [''])[0]
+            if token != daemon.webhook_token:
+                self.send_response(403)
+                self.end_headers()
+                return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        daemon.notify(self._source(self.rfile.read(length) if length else b''))
+        # Pub/Sub treats any 2xx as acknowledged
+        self.send_response(204)
+        self.end_headers()
+
+    @staticmethod
+    def _source(body: bytes) -> str:
+        """Describe a notification, reading the historyId out of a Pub/Sub envelope"""
+        try:
+            message = json.loads(body)['message']
+            data = json.loads(base64.b64decode(message['data']))
+            return f"push for {data.get('emailAddress')} at history {data.get('historyId')}"
+        except (ValueError, KeyError, TypeError, binascii.Error):
+            return 'webhook'
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(f"Webhook {self.address_string()}: {format % args}")
+
+
+class MailDaemon:
+    """
+    Keeps the Gmail session, database connection and compiled rules warm
+    and runs sync -> evaluate -> apply whenever something may have changed.
+
+    A cycle is triggered by a notification on the local webhook (where a
+    Gmail watch's Pub/Sub subscription pushes to), or by the interval
+    timer when nothing was pushed. Notifications arriving during the
+    debounce window or a running cycle are folded into one more cycle.
+
+    rules.json is watched too: an edit triggers a cycle that swaps in the
+    new rules between cycles, if they validate, and re-checks emails
+    against the new or changed rules only.
+    """
+
+    def __init__(self, gmail: Optional[GmailManager] = None,
+                 db_path: str = 'database/email.db', rules_path: str = 'rules.json',
+                 interval_seconds: Optional[float] = None,
+                 webhook_port: Optional[int] = None,
+                 workers: int = 1, batch_size: int = 500, chunk_size: int = 100):
+        self.logger = logging.getLogger(__name__)
+        self.gmail = gmail or GmailManager()
+        config = self.gmail.authenticator.config.get('daemon', {})
+        webhook_config = config.get('webhook', {})
+        watch_config = config.get('watch', {})
+
+        self.sync = MailboxSync(gmail=self.gmail, db_path=db_path, rules_path=rules_path)
+        self.executor = EmailRuleExecutor(db_path, rules_path, gmail=self.gmail)
+
+        self.interval_seconds = (config.get('interval_seconds', 300)
+                                 if interval_seconds is None else interval_seconds)
+        self.debounce_seconds = config.get('debounce_seconds', 2)
+        self.rules_poll_seconds = config.get('rules_poll_seconds', 2)
+        self.rules_path = rules_path
+        self.workers = workers
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+
+        self.webhook_host = webhook_config.get('host', 'localhost')
+        self.webhook_port = (webhook_config.get('port', DEFAULT_WEBHOOK_PORT)
+                             if webhook_port is None else webhook_port)
+        self.webhook_enabled = webhook_config.get('enabled', True) and self.webhook_port > 0
+        self.webhook_token = webhook_config.get('token') or None
+        self.watch_topic = watch_config.get('topic') or None
+        self.watch_label_ids = watch_config.get('label_ids', ['INBOX'])
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._watch_renew_at = 0.0
+        self._last_cycle = 0.0
+        self.cycles = 0
+
+    def notify(self, source: str = 'notification') -> None:
+        """Request a sync cycle; safe to call from any thread"""
+        self.logger.info(f"Change notification: {source}")
+        self._wake.set()
+
+    def stop(self) -> None:
+        """Ask the daemon to finish its current cycle and exit; safe from signal handlers"""
+        self._stop.set()
+        self._wake.set()
+
+    def run(self) -> None:
+        """Run cycles until stop() is called or the process is interrupted"""
+        self._start_webhook()
+        self._renew_watch()
+        if self.rules_poll_seconds:
+            threading.Thread(target=self._watch_rules, name='rules-watch', daemon=True).start()
+        self.logger.info(
+            f"Daemon running: interval {self.interval_seconds or 'off'}s, "
+            f"webhook {'on port ' + str(self.webhook_port) if self._server else 'off'}, "
+            f"watch {self.watch_topic or 'off'}"
+        )
+        if not self.interval_seconds and self._server is None:
+            self.logger.warning("No interval and no webhook, only the startup cycle will run")
+        # Catch up on whatever changed while the daemon wasn't running
+        self._wake.set()
+        try:
+            while not self._stop.is_set():
+                self._wake.wait(self._wait_timeout())
+                if self._stop.is_set():
+                    break
+                if time.monotonic() >= self._watch_renew_at:
+                    self._renew_watch()
+                if not self._wake.is_set() and not self._interval_due():
+                    continue
+
+                # Let a burst of notifications settle into a single cycle
+                self._stop.wait(self.debounce_seconds)
+                self._wake.clear()
+                self.run_cycle()
+        except KeyboardInterrupt:
+            self.logger.info("Interrupted")
+        finally:
+            self.close()
+
+    def run_cycle(self) -> Optional[Dict[str, int]]:
+        """One sync -> evaluate -> apply pass; errors are logged and the daemon carries on"""
+        started = time.monotonic()
+        self._last_cycle = started
+        try:
+            self.executor.reload_rules()
+            synced = self.sync.sync(chunk_size=self.chunk_size)
+            processed = self.executor.process_emails(batch_size=self.batch_size, workers=self.workers)
+        except Exception as e:
+            self.logger.error(f"Sync cycle failed: {e}")
+            return None
+
+        self.cycles += 1
+        result = dict(synced, processed=processed)
+        self.logger.info(
+            f"Cycle {self.cycles} in {time.monotonic() - started:.2f}s: "
+            f"{result['added']} added, {result['deleted']} deleted, "
+            f"{result['updated']} updated, {processed} evaluated"
+        )
+        return result
+
+    def close(self) -> None:
+        """Stop the webhook and the Gmail watch and close the Gmail session"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self.watch_topic:
+            try:
+                self.gmail.stop_watch()
+            except Exception as e:
+                self.logger.warning(f"Could not stop the Gmail watch: {e}")
+        self.gmail.close()
+
+    def _interval_due(self) -> bool:
+        return bool(self.interval_seconds) and (
+            time.monotonic() - self._last_cycle >= self.interval_seconds
+        )
+
+    def _wait_timeout(self) -> Optional[float]:
+        """Seconds until the timer or the watch renewal needs the loop, None to wait for a push"""
+        deadlines = []
+        if self.interval_seconds:
+            deadlines.append(self._last_cycle + self.interval_seconds)
+        if self.watch_topic:
+            deadlines.append(self._watch_renew_at)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def _watch_rules(self) -> None:
+        """Poll the rules file and request a cycle when it is saved"""
+        last = file_stamp(self.rules_path)
+        while not self._stop.wait(self.rules_poll_seconds):
+            stamp = file_stamp(self.rules_path)
+            if stamp != last:
+                last = stamp
+                self.notify(f"{self.rules_path} changed")
+
+    def _start_webhook(self) -> None:
+        if not self.webhook_enabled:
+            return
+        self._server = ThreadingHTTPServer((self.webhook_host, self.webhook_port), NotificationHandler)
+        self._server.mail_daemon = self
+        self.webhook_port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name='webhook', daemon=True).start()
+
+    def _renew_watch(self) -> None:
+        """(Re)start the Gmail watch; its Pub/Sub subscription should push to the webhook"""
+        if not self.watch_topic:
+            self._watch_renew_at = float('inf')
+            return
+        try:
+            response = self.gmail.watch(self.watch_topic, self.watch_label_ids)
+            self.logger.info(
+                f"Gmail watch on {self.watch_topic} from history {response.get('historyId')}"
+            )
+            self._watch_renew_at = time.monotonic() + WATCH_RENEW_SECONDS
+        except Exception as e:
+            # The interval timer keeps mail flowing; try again in a minute
+            self.logger.error(f"Could not start the Gmail watch: {e}")
+            self._watch_renew_at = time.monotonic() + 60
@@ -0,0 +1,153 @@
+from typing import Dict, Iterable, List, Optional, Set
+import json
+import logging
+from database.email_repository import EmailDatabase
+from database.sync_state_repository import SyncStateRepository
+from gmail.gmail_manager import GmailManager, HistoryExpiredError
+from email_manager.rule_compiler import RuleCompiler
+from utils.chunking import chunked
+
+HISTORY_ID_KEY = 'gmail_history_id'
+
+# Messages a sync listed or saw added but could not fetch, fetched again by the next incremental sync
+UNFETCHED_IDS_KEY = 'gmail_unfetched_ids'
+
+# Gmail system labels that don't correspond to a local folder
+SYSTEM_LABELS = {'UNREAD', 'IMPORTANT', 'STARRED', 'SENT', 'DRAFT', 'SPAM', 'TRASH'}
+
+class MailboxSync:
+    """
+    Keeps the local database in step with Gmail.
+
+    A full sync backfills the mailbox. An incremental sync replays
+    users.history.list from the historyId checkpoint saved by the previous
+    run, so its cost is proportional to the changes rather than the mailbox.
+    Messages that could not be fetched are kept with the checkpoint and
+    fetched again by the next incremental sync, so moving the checkpoint
+    past them loses nothing.
+
+    Bodies are only downloaded when some rule in rules.json reads the
+    message text; otherwise messages are fetched with format=metadata and
+    the rule executor fetches missing bodies once such a rule is added.
+    """
+
+    def __init__(self, gmail: Optional[GmailManager] = None,
+                 db: Optional[EmailDatabase] = None,
+                 db_path: str = 'database/email.db',
+                 rules_path: str = 'rules.json'):
+        self.gmail = gmail or GmailManager()
+        self.db = db or EmailDatabase(db_path)
+        self.state = SyncStateRepository(self.db.db_path)
+        self.rules_path = rules_path
+        self.logger = logging.getLogger(__name__)
+
+    def fetch_format(self) -> str:
+        """'metadata' when no rule reads message bodies, 'full' otherwise"""
+        try:
+            with open(self.rules_path, 'r') as f:
+                rules = RuleCompiler().compile_valid(json.load(f))
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Can't read rules ({e}), fetching full messages")
+            return 'full'
+        return 'full' if rules.needs_body else 'metadata'
+
+    def sync(self, query: str = '', page_size: int = 500,
+             max_messages: Optional[int] = None, chunk_size: int = 100) -> Dict[str, int]:
+        """Run an incremental sync, falling back to a full sync without a usable checkpoint"""
+        history_id = self.state.get(HISTORY_ID_KEY)
+        if history_id:
+            try:
+                return self.incremental_sync(history_id, chunk_size)
+            except HistoryExpiredError as e:
+                self.logger.warning(f"{e}, running a full resync")
+        if query or max_messages:
+            self.logger.warning(
+                "No usable history checkpoint and the full sync is limited by a query or "
+                "max_messages, so it saves none and the next sync will be a full one again"
+            )
+        return self.full_sync(query, page_size, max_messages, chunk_size)
+
+    def full_sync(self, query: str = '', page_size: int = 500,
+                  max_messages: Optional[int] = None, chunk_size: int = 100) -> Dict[str, int]:
+        """
+        Backfill the mailbox and checkpoint the historyId it started from
+        A backfill limited by query or max_messages leaves older mail out,
+        so it sets no checkpoint and the next sync is a full one again
+        """
+        # Take the checkpoint first so changes made during the backfill are replayed next time
+        complete = not query and not max_messages
+        history_id = self.gmail.get_history_id() if complete else None
+
+        # Stored emails are taken out again, leaving the IDs that could not be fetched
+        unfetched: Set[str] = set()
+        chunks = self.gmail.backfill(
+            query=query,
+            page_size=page_size,
+            max_messages=max_messages,
+            chunk_size=chunk_size,
+            format=self.fetch_format(),
+            listed=unfetched
+        )
+        stored = self._store(chunks, unfetched)
+
+        if history_id is not None:
+            self.checkpoint(history_id, unfetched)
+        return {'added': stored['inserted'], 'deleted': 0, 'updated': stored['updated']}
+
+    def incremental_sync(self, history_id: str, chunk_size: int = 100) -> Dict[str, int]:
+        """Apply only the messages added, deleted and relabelled since history_id"""
+        changes = self.gmail.get_history_changes(history_id)
+
+        deleted = self.db.delete_emails(changes['deleted']) if changes['deleted'] else 0
+
+        # Messages an earlier sync could not fetch are tried again, unless they are gone
+        unfetched = set(json.loads(self.state.get(UNFETCHED_IDS_KEY) or '[]'))
+        unfetched = (unfetched | set(changes['added'])) - set(changes['deleted'])
+        added = 0
+        if unfetched:
+            emails = self.gmail.fetch_messages(sorted(unfetched), format=self.fetch_format())
+            added = self._store(chunked(emails, chunk_size), unfetched)['inserted']
+
+        states = [
+            (message_id, int('UNREAD' in label_ids), self._local_label(label_ids))
+            for message_id, label_ids in changes['labels'].items()
+            if message_id not in changes['added']
+        ]
+        updated = self.db.update_label_state(states) if states else 0
+
+        self.checkpoint(changes['history_id'], unfetched)
+        self.logger.info(
+            f"Incremental sync from history {history_id}: "
+            f"{added} added, {deleted} deleted, {updated} relabelled"
+        )
+        return {'added': added, 'deleted': deleted, 'updated': updated}
+
+    def _store(self, chunks: Iterable[List[Dict]], unfetched: Set[str]) -> Dict[str, int]:
+        """Store emails chunk by chunk, taking each chunk's IDs out of unfetched once it is stored"""
+        def stored_chunks():
+            for chunk in chunks:
+                yield chunk
+                unfetched.difference_update(email['message_id'] for email in chunk)
+        return self.db.insert_email_chunks(stored_chunks())
+
+    def checkpoint(self, history_id: str, unfetched: Set[str]) -> None:
+        """Save the historyId together with the messages still to be fetched"""
+        if unfetched:
+            self.logger.warning(
+                f"{len(unfetched)} messages could not be fetched, the next incremental sync retries them"
+            )
+        with self.db.db.transaction():
+            self.state.set(UNFETCHED_IDS_KEY, json.dumps(sorted(unfetched)))
+            self.state.set(HISTORY_ID_KEY, history_id)
+
+    def _local_label(self, label_ids: List[str]) -> Optional[str]:
+        """Map Gmail label IDs to the local label column, None if it can't be told"""
+        for label_id in label_ids:
+            if label_id in SYSTEM_LABELS or label_id == 'INBOX' or label_id.startswith('CATEGORY_'):
+                continue
+            name = self.gmail.get_label_name(label_id)
+            if name:
+                return name.lower()
+        if 'INBOX' in label_ids:
+            return 'inbox'
+        return None
@@ -0,0 +1,118 @@
+import sqlite3
+import logging
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from database.body_store import register_functions
+from email_manager.action_planner import ActionPlanner
+from email_manager.rule_compiler import RuleCompiler
+from email_manager.rule_evaluator import RuleEvaluator
+from utils.metrics import metrics
+
+# Emails planned before the coordinator applies them, matching one batchModify call
+APPLY_BATCH_SIZE = 1000
+
+# Set up once per worker process by _init_worker
+_evaluator: Optional[RuleEvaluator] = None
+
+
+def _init_worker(db_path: str, rules: Dict) -> None:
+    """Give the worker its own read-only connection and compiled rules"""
+    global _evaluator
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    register_functions(conn)
+    compiled = RuleCompiler().compile_valid(rules)
+    _evaluator = RuleEvaluator(
+        lambda sql, params=(): conn.execute(sql, tuple(params)).fetchall(),
+        compiled
+    )
+
+
+def _evaluate_range(first_id: int, last_id: int,
+                    now: datetime) -> Tuple[int, int, List[Tuple[str, int]]]:
+    """Evaluate one id range in a worker, returning only (message_id, rule position) matches"""
+    matches = [
+        (message_id, rule.position)
+        for message_id, rule in _evaluator.matches(first_id, last_id, now)
+    ]
+    return first_id, last_id, matches
+
+
+class ParallelRuleEvaluation:
+    """
+    Splits the unevaluated emails into id ranges and evaluates them in a
+    process pool, for reprocessing large archives on every core.
+
+    Workers only read from SQLite. The coordinator, running in the
+    executor's process, is the single writer: it plans the returned
+    matches, applies them to Gmail and the DB in batches and stamps the
+    ranges as evaluated.
+    """
+
+    def __init__(self, executor, workers: int):
+        self.executor = executor
+        self.workers = workers
+        self.logger = logging.getLogger(__name__)
+
+    def run(self, batch_size: int, max_emails: Optional[int] = None) -> int:
+        now = datetime.now(timezone.utc)
+        processed = 0
+        planner = ActionPlanner()
+        done_ranges: List[Tuple[int, int]] = []
+        counts: Dict[Tuple[int, int], int] = {}
+
+        # spawn: don't fork a process holding an open SQLite connection
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self.executor.db_path, self.executor.rules)
+        ) as pool:
+            ranges = self.executor._unevaluated_ranges(batch_size, max_emails)
+            in_flight = set()
+            exhausted = False
+
+            while in_flight or not exhausted:
+                # Keep a bounded number of ranges queued ahead of the workers
+                while not exhausted and len(in_flight) < self.workers * 2:
+                    next_range = next(ranges, None)
+                    if next_range is None:
+                        exhausted = True
+                        break
+                    first_id, last_id, count = next_range
+                    counts[(first_id, last_id)] = count
+                    in_flight.add(pool.submit(_evaluate_range, first_id, last_id, now))
+
+                if not in_flight:
+                    break
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        first_id, last_id, matches = future.result()
+                    except Exception as e:
+                        # The range stays unevaluated and is picked up by the next run
+                        self.logger.error(f"Error evaluating rules in a worker: {e}")
+                        continue
+
+                    for message_id, position in matches:
+                        planner.add(message_id, self.executor.rules_by_position[position])
+                    done_ranges.append((first_id, last_id))
+                    count = counts.pop((first_id, last_id))
+                    processed += count
+                    # Workers keep no metrics, so their evaluations are counted here
+                    if metrics.enabled:
+                        for rule in self.executor.compiled_rules:
+                            metrics.inc('rule_evaluations_total', count, rule=rule.name)
+                        for _, position in matches:
+                            metrics.inc('rule_matches_total',
+                                        rule=self.executor.rules_by_position[position].name)
+
+                if len(planner) >= APPLY_BATCH_SIZE:
+                    self.executor._apply_and_mark(planner.plan(), done_ranges)
+                    planner, done_ranges = ActionPlanner(), []
+
+        if done_ranges:
+            self.executor._apply_and_mark(planner.plan(), done_ranges)
+        return processed
@@ -0,0 +1,382 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+from database.body_store import register_functions
+from database.email_repository import EmailDatabase
+from email_manager.action_planner import ActionPlanner
+from email_manager.email_rule_executor import EmailRuleExecutor
+from email_manager.mailbox_sync import MailboxSync
+from email_manager.rule_evaluator import RuleEvaluator
+from gmail.gmail_manager import GmailManager, LIST_PAGE_LIMIT
+from utils.chunking import chunked
+
+# Marks the end of a queue's input, one per downstream worker
+_DONE = object()
+
+# How often a worker blocked on a queue checks whether the pipeline was aborted
+POLL_SECONDS = 0.1
+
+
+class PipelineAborted(Exception):
+    """A stage could not run, so the pipeline stopped before finishing its input"""
+
+
+def put_unless_aborted(target: queue.Queue, item: Any, abort: threading.Event) -> bool:
+    """Put item on a bounded queue, giving up once abort is set; returns whether it was put"""
+    while not abort.is_set():
+        try:
+            target.put(item, timeout=POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class PipelineItem:
+    """A batch moving between stages, stamped for latency accounting"""
+    __slots__ = ('payload', 'created', 'enqueued')
+
+    def __init__(self, payload: Any, created: float):
+        self.payload = payload
+        self.created = created
+        self.enqueued = time.monotonic()
+
+
+class StageMetrics:
+    """Counters of one stage, updated by its workers under a lock"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.batches = 0
+        self.items = 0
+        self.errors = 0
+        self.dropped = 0
+        self.busy_seconds = 0.0
+        self.max_batch_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.depth_samples = 0
+        self.depth_total = 0
+        self.max_depth = 0
+        self._lock = threading.Lock()
+
+    def record(self, items: int, busy: float, waited: float, depth: int) -> None:
+        with self._lock:
+            self.batches += 1
+            self.items += items
+            self.busy_seconds += busy
+            self.max_batch_seconds = max(self.max_batch_seconds, busy)
+            self.wait_seconds += waited
+            self.depth_samples += 1
+            self.depth_total += depth
+            self.max_depth = max(self.max_depth, depth)
+
+    def error(self, items: int) -> None:
+        with self._lock:
+            self.errors += 1
+            self.dropped += items
+
+    def as_dict(self, elapsed: float) -> Dict[str, Any]:
+        batches = self.batches or 1
+        return {
+            'workers': self.workers,
+            'batches': self.batches,
+            'items': self.items,
+            'errors': self.errors,
+            'dropped_items': self.dropped,
+            'items_per_second': round(self.items / elapsed, 1) if elapsed else 0.0,
+            'avg_batch_ms': round(1000 * self.busy_seconds / batches, 2),
+            'max_batch_ms': round(1000 * self.max_batch_seconds, 2),
+            'avg_queue_wait_ms': round(1000 * self.wait_seconds / batches, 2),
+            'avg_queue_depth': round(self.depth_total / (self.depth_samples or 1), 2),
+            'max_queue_depth': self.max_depth,
+            # Share of the stage's worker time spent working rather than waiting for input
+            'utilization': round(self.busy_seconds / (elapsed * self.workers), 3) if elapsed else 0.0
+        }
+
+
+class Stage:
+    """
+    A pool of worker threads taking batches from a bounded inbox and
+    putting what handle returns on the next stage's bounded inbox.
+
+    A full outbox blocks the workers, so a slow stage holds back every
+    stage before it instead of letting batches pile up in memory.
+
+    A worker that fails to start (on_start raises) sets the shared abort
+    event: every stage then stops taking and putting batches, so no worker
+    is left blocked on a queue nobody reads.
+    """
+
+    def __init__(self, name: str, handle: Callable[[Any], Iterable[Any]], workers: int,
+                 inbox: queue.Queue, abort: threading.Event,
+                 outbox: Optional[queue.Queue] = None,
+                 size: Callable[[Any], int] = len,
+                 on_start: Optional[Callable[[], None]] = None,
+                 on_item: Optional[Callable[[PipelineItem], None]] = None):
+        self.name = name
+        self.handle = handle
+        self.workers = max(1, workers)
+        self.inbox = inbox
+        self.outbox = outbox
+        self.abort = abort
+        self.failure: Optional[Exception] = None
+        self.size = size
+        self.on_start = on_start
+        self.on_item = on_item
+        self.downstream_workers = 0
+        self.metrics = StageMetrics(name, self.workers)
+        self.logger = logging.getLogger(__name__)
+        self._running = self.workers
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'{self.name}-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self) -> None:
+        for thread in self._threads:
+            thread.join()
+
+    def _take(self) -> Any:
+        """The next item of the inbox, or _DONE once the pipeline is aborted"""
+        while not self.abort.is_set():
+            try:
+                return self.inbox.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _work(self) -> None:
+        try:
+            if self.on_start:
+                try:
+                    self.on_start()
+                except Exception as e:
+                    self.failure = e
+                    self.abort.set()
+                    self.logger.error(f"Pipeline stage {self.name} failed to start, aborting: {e}")
+                    return
+            while True:
+                depth = self.inbox.qsize()
+                item = self._take()
+                if item is _DONE or self.abort.is_set():
+                    break
+                started = time.monotonic()
+                try:
+                    results = list(self.handle(item.payload))
+                except Exception as e:
+                    # The batch is dropped; its emails stay unevaluated for the next run
+                    size = self.size(item.payload)
+                    self.metrics.error(size)
+                    self.logger.error(f"Pipeline stage {self.name} dropped a batch of {size}: {e}")
+                    continue
+                finished = time.monotonic()
+                self.metrics.record(self.size(item.payload), finished - started,
+                                    started - item.enqueued, depth)
+                if self.on_item:
+                    self.on_item(item)
+                for result in results:
+                    put_unless_aborted(self.outbox, PipelineItem(result, item.created), self.abort)
+        finally:
+            with self._lock:
+                self._running -= 1
+                last = self._running == 0
+            if last and self.outbox is not None:
+                for _ in range(self.downstream_workers):
+                    put_unless_aborted(self.outbox, _DONE, self.abort)
+
+
+class EmailPipeline:
+    """
+    Fetches, stores, evaluates and applies rules in one run, with each
+    step a concurrent stage linked to the next by a bounded queue:
+
+        list IDs -> fetch (N threads) -> store (1 writer) -> evaluate (N) -> apply (N)
+
+    Emails are filed while later pages are still downloading, and
+    evaluation reads the rows the writer just committed by id, so no
+    separate process_emails.py pass is needed. Evaluation workers use
+    their own read-only connections; the single writer and the appliers
+    share the process connection.
+    """
+
+    def __init__(self, gmail: Optional[GmailManager] = None,
+                 db_path: str = 'database/email.db', rules_path: str = 'rules.json',
+                 fetch_workers: Optional[int] = None, evaluate_workers: Optional[int] = None,
+                 apply_workers: Optional[int] = None, queue_size: Optional[int] = None,
+                 chunk_size: int = 100):
+        self.logger = logging.getLogger(__name__)
+        self.gmail = gmail or GmailManager()
+        config = self.gmail.authenticator.config.get('pipeline', {})
+        self.db_path = db_path
+        self.db = EmailDatabase(db_path)
+        self.executor = EmailRuleExecutor(db_path, rules_path, gmail=self.gmail)
+
+        self.fetch_workers = fetch_workers or config.get('fetch_workers', 4)
+        self.evaluate_workers = evaluate_workers or config.get('evaluate_workers', 2)
+        self.apply_workers = apply_workers or config.get('apply_workers', 2)
+        self.queue_size = queue_size or config.get('queue_size', 8)
+        self.chunk_size = chunk_size
+        self.format = 'full' if self.executor.compiled_rules.needs_body else 'metadata'
+
+        self.now = datetime.now(timezone.utc)
+        self.totals: Dict[str, int] = {}
+        self._totals_lock = threading.Lock()
+        self._local = threading.local()
+        self._latency_lock = threading.Lock()
+        self._latencies: List[float] = []
+        self._unfetched: Set[str] = set()
+
+    def run(self, query: str = '', page_size: int = LIST_PAGE_LIMIT,
+            max_messages: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Run the pipeline over the messages matching query and return its
+        metrics: totals, end-to-end throughput and per-stage queue depth
+        and latency
+        Raises PipelineAborted when a stage could not start
+        """
+        self.executor._reconcile_rule_versions()
+        # Checkpoint first, as a full sync does, so later changes are replayed incrementally
+        history_id = self.gmail.get_history_id() if not query and not max_messages else None
+        self.now = datetime.now(timezone.utc)
+        self.totals = {'fetched': 0, 'inserted': 0, 'updated': 0, 'evaluated': 0,
+                       'matched': 0, 'applied': 0, 'failed': 0}
+
+        # Listed IDs leave this set once stored; those left are retried by the next incremental sync
+        self._unfetched = set()
+        abort = threading.Event()
+        ids_queue = queue.Queue(self.queue_size)
+        stages = [
+            Stage('fetch', self._fetch, self.fetch_workers, ids_queue, abort, queue.Queue(self.queue_size)),
+        ]
+        stages.append(Stage('store', self._store, 1, stages[-1].outbox, abort, queue.Queue(self.queue_size)))
+        stages.append(Stage('evaluate', self._evaluate, self.evaluate_workers, stages[-1].outbox, abort,
+                            queue.Queue(self.queue_size), on_start=self._open_reader))
+        stages.append(Stage('apply', self._apply, self.apply_workers, stages[-1].outbox, abort,
+                            size=lambda payload: len(payload[1]), on_item=self._record_latency))
+        for stage, downstream in zip(stages, stages[1:]):
+            stage.downstream_workers = downstream.workers
+
+        started = time.monotonic()
+        for stage in stages:
+            stage.start()
+
+        # The ID listing is the producer; a full queue pauses paging through messages.list
+        listed = 0
+        try:
+            message_ids = self.gmail.iter_message_ids(query, page_size, max_messages, self._unfetched)
+            for ids in chunked(message_ids, self.chunk_size):
+                if not put_unless_aborted(ids_queue, PipelineItem(ids, time.monotonic()), abort):
+                    break
+                listed += len(ids)
+        except Exception as e:
+            # Messages that were never listed can't be retried, so no checkpoint is saved
+            history_id = None
+            self.logger.error(f"Error listing messages: {e}")
+        finally:
+            for _ in range(stages[0].workers):
+                put_unless_aborted(ids_queue, _DONE, abort)
+
+        for stage in stages:
+            stage.join()
+        elapsed = time.monotonic() - started
+
+        failed = [stage for stage in stages if stage.failure is not None]
+        if failed:
+            raise PipelineAborted(
+                f"Pipeline stage {failed[0].name} failed to start: {failed[0].failure}"
+            ) from failed[0].failure
+        if history_id is not None:
+            MailboxSync(self.gmail, self.db).checkpoint(history_id, self._unfetched)
+        return self._report(listed, elapsed, stages)
+
+    def _fetch(self, ids: List[str]) -> Iterable[List[Dict]]:
+        emails = list(self.gmail.fetch_messages(ids, format=self.format))
+        return [emails] if emails else []
+
+    def _store(self, emails: List[Dict]) -> Iterable[List[int]]:
+        stored = self.db.insert_emails(emails)
+        # Row ids of the new or changed emails, for evaluation by id rather than id range
+        rows = self.executor.db.query(f'''
+            SELECT id FROM emails
+            WHERE message_id IN (SELECT value FROM json_each(?)) AND evaluated_rules_hash IS NULL
+            ORDER BY id
+        ''', (json.dumps([email['message_id'] for email in emails]),))
+        self._add(fetched=len(emails), inserted=stored['inserted'], updated=stored['updated'])
+        self._unfetched.difference_update([email['message_id'] for email in emails])
+        return [[row[0] for row in rows]] if rows else []
+
+    def _open_reader(self) -> None:
+        """Give an evaluation worker its own read-only connection"""
+        conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+        register_functions(conn)
+        self._local.evaluator = RuleEvaluator(
+            lambda sql, params=(): conn.execute(sql, tuple(params)).fetchall(),
+            self.executor.compiled_rules
+        )
+
+    def _evaluate(self, ids: List[int]) -> Iterable[tuple]:
+        planner = ActionPlanner()
+        for message_id, rule in self._local.evaluator.matches_ids(ids, self.now):
+            planner.add(message_id, rule)
+        plan = planner.plan()
+        self._add(evaluated=len(ids), matched=sum(len(message_ids) for message_ids in plan.values()))
+        return [(plan, ids)]
+
+    def _apply(self, planned: tuple) -> Iterable:
+        plan, ids = planned
+        failed = self.executor._apply_pending(plan)
+        self.executor._mark_evaluated_ids(ids, failed)
+        applied = sum(len(message_ids) for message_ids in plan.values())
+        self._add(applied=applied - len(failed), failed=len(failed))
+        return []
+
+    def _add(self, **counts: int) -> None:
+        with self._totals_lock:
+            for key, count in counts.items():
+                self.totals[key] += count
+
+    def _record_latency(self, item: PipelineItem) -> None:
+        with self._latency_lock:
+            self._latencies.append(time.monotonic() - item.created)
+
+    def _report(self, listed: int, elapsed: float, stages: List[Stage]) -> Dict[str, Any]:
+        latencies = sorted(self._latencies)
+        self._latencies = []
+
+        def percentile(fraction: float) -> float:
+            if not latencies:
+                return 0.0
+            return round(1000 * latencies[min(len(latencies) - 1, int(fraction * len(latencies)))], 1)
+
+        report = {
+            'listed': listed,
+            **self.totals,
+            # Items of batches a stage failed on, left for the next run
+            'dropped': sum(stage.metrics.dropped for stage in stages),
+            'elapsed_seconds': round(elapsed, 3),
+            'emails_per_second': round(self.totals['fetched'] / elapsed, 1) if elapsed else 0.0,
+            # From a chunk of IDs being listed to its emails' labels being applied
+            'batch_latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95),
+                                 'max': percentile(1.0)},
+            'stages': {stage.name: stage.metrics.as_dict(elapsed) for stage in stages}
+        }
+        self.logger.info(
+            f"Pipeline: {report['fetched']} emails in {report['elapsed_seconds']}s "
+            f"({report['emails_per_second']}/s), {report['applied']} changed in Gmail"
+        )
+        if report['dropped']:
+            self.logger.error(
+                f"Pipeline: {report['dropped']} items dropped by failed batches "
+                f"({', '.join(f'{stage.name}: {stage.metrics.errors}' for stage in stages if stage.metrics.errors)})"
+            )
+        return report
@@ -0,0 +1,287 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Set, Tuple
+from utils.dates import subtract_months
+from utils.multi_pattern import MultiPatternMatcher
+
+# Rule field name -> column in the emails table
+FIELD_COLUMNS = {
+    'from': 'from_address',
+    'to': 'to_address',
+    'subject': 'subject',
+    'message': 'message',
+    'received': 'received_at',
+    'received_at': 'received_at'
+}
+
+# Units of received values such as '3_day'; months are calendar months
+TIME_UNITS = ('day', 'month')
+
+# Predicates answered by the per-field multi-pattern index
+INDEXED_PREDICATES = ('contains', 'does_not_contain')
+
+
+class RuleCompileError(ValueError):
+    """Raised when a rule in rules.json cannot be compiled"""
+
+
+class CompiledCondition:
+    """A single rule condition with its value pre-processed for evaluation"""
+
+    def __init__(self, field: str, predicate: str, value: str,
+                 test: Callable[['PreparedEmail', datetime], bool]):
+        self.field = field
+        self.column = FIELD_COLUMNS[field]
+        self.predicate = predicate
+        self.value = value
+        self.needle = str(value).lower()
+        self.test = test
+
+    @property
+    def indexed(self) -> bool:
+        return (self.predicate in INDEXED_PREDICATES and bool(self.needle)
+                and self.column != 'received_at')
+
+
+class PreparedEmail:
+    """
+    An email's referenced fields read once: text lowercased, the received
+    epoch kept as is, and the contains-needles found in each text field
+    """
+    __slots__ = ('values', 'hits')
+
+    def __init__(self, values: Dict, hits: Dict[str, Set[str]]):
+        self.values = values
+        self.hits = hits
+
+
+class CompiledRule:
+    """A rule whose conditions have been compiled into predicates"""
+
+    def __init__(self, name: str, match_type: str,
+                 conditions: List[CompiledCondition], actions: List[Dict],
+                 position: int = 0):
+        self.name = name
+        # Index in rules.json; earlier rules take precedence when actions conflict
+        self.position = position
+        self.match_type = match_type
+        self.conditions = conditions
+        self.actions = actions
+        tests = tuple(condition.test for condition in conditions)
+
+        if match_type == 'all':
+            self._match = lambda email, now: all(test(email, now) for test in tests)
+        else:
+            self._match = lambda email, now: any(test(email, now) for test in tests)
+
+    def matches(self, email: PreparedEmail, now: datetime) -> bool:
+        """
+        Evaluate the rule against an email prepared by CompiledRuleSet.prepare,
+        short-circuiting on the first decisive condition
+        """
+        return self._match(email, now)
+
+
+class CompiledRuleSet:
+    """
+    All compiled rules plus the per-field accessors they need.
+
+    Every contains/does_not_contain needle is loaded into one multi-pattern
+    matcher per field, so a single pass over each field finds all matching
+    needles whatever the number of rules. Rules that cannot match without a
+    particular needle are only evaluated when that needle was found.
+    """
+
+    def __init__(self, rules: List[CompiledRule]):
+        self.rules = rules
+        self.columns = sorted({
+            condition.column for rule in rules for condition in rule.conditions
+        })
+
+        needles: Dict[str, Set[str]] = {}
+        for rule in rules:
+            for condition in rule.conditions:
+                if condition.indexed:
+                    needles.setdefault(condition.column, set()).add(condition.needle)
+        self.matchers = {
+            column: MultiPatternMatcher(column_needles)
+            for column, column_needles in needles.items()
+        }
+
+        self._build_candidate_index()
+
+    @property
+    def needs_body(self) -> bool:
+        """Whether any rule reads the message text, so emails must be fetched with bodies"""
+        return 'message' in self.columns
+
+    def _build_candidate_index(self):
+        # (column, needle) -> positions of rules that can only fire when it is found
+        self._rules_by_needle: Dict[tuple, List[int]] = {}
+        self._always_candidates: List[int] = []
+
+        for position, rule in enumerate(self.rules):
+            contains = [c for c in rule.conditions if c.predicate == 'contains' and c.indexed]
+            if rule.match_type == 'all' and contains:
+                required = [max(contains, key=lambda c: len(c.needle))]
+            elif rule.match_type == 'any' and contains and len(contains) == len(rule.conditions):
+                required = contains
+            else:
+                self._always_candidates.append(position)
+                continue
+
+            for condition in required:
+                self._rules_by_needle.setdefault(
+                    (condition.column, condition.needle), []
+                ).append(position)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def prepare(self, email: Dict) -> PreparedEmail:
+        """
+        Read each referenced field once: text fields are lowercased and
+        scanned for needles, so conditions only compare pre-processed values.
+        received_at is already a UTC epoch integer in the database.
+        """
+        values = {}
+        hits = {}
+        for column in self.columns:
+            value = email.get(column)
+            if column == 'received_at':
+                values[column] = value if isinstance(value, int) else None
+            elif not value:
+                values[column] = None
+            else:
+                values[column] = value.lower()
+
+            matcher = self.matchers.get(column)
+            if matcher is not None:
+                hits[column] = matcher.find_all(values[column]) if values[column] else set()
+        return PreparedEmail(values, hits)
+
+    def candidate_rules(self, email: PreparedEmail) -> List[CompiledRule]:
+        """Rules that can still match given the needles found in the email, in rules.json order"""
+        positions = set(self._always_candidates)
+        for column, found in email.hits.items():
+            for needle in found:
+                positions.update(self._rules_by_needle.get((column, needle), ()))
+        return [self.rules[position] for position in sorted(positions)]
+
+    def matching_rules(self, email: Dict, now: datetime) -> List[CompiledRule]:
+        """Return the rules that match an email, in rules.json order"""
+        prepared = self.prepare(email)
+        return [rule for rule in self.candidate_rules(prepared) if rule.matches(prepared, now)]
+
+
+class RuleCompiler:
+    """Compiles the rules.json structure into CompiledRule objects once at load time"""
+
+    def compile(self, rules: Dict) -> CompiledRuleSet:
+        """Compile every rule in the loaded rules document"""
+        return CompiledRuleSet([
+            self.compile_rule(rule, position) for position, rule in enumerate(rules.get('rules', []))
+        ])
+
+    def compile_valid(self, rules: Dict, logger=None) -> CompiledRuleSet:
+        """Compile the rules that are valid, logging and skipping the others"""
+        compiled = []
+        for position, rule in enumerate(rules.get('rules', [])):
+            try:
+                compiled.append(self.compile_rule(rule, position))
+            except (RuleCompileError, KeyError) as e:
+                if logger:
+                    logger.error(f"Skipping rule '{rule.get('name')}': {e}")
+        return CompiledRuleSet(compiled)
+
+    def compile_rule(self, rule: Dict, position: int = 0) -> CompiledRule:
+        match_type = rule.get('match_type', 'all')
+        if match_type not in ('all', 'any'):
+            raise RuleCompileError(
+                f"Rule '{rule.get('name')}' has unknown match_type '{match_type}'"
+            )
+
+        conditions = [self.compile_condition(condition) for condition in rule['conditions']]
+        return CompiledRule(rule['name'], match_type, conditions, rule.get('actions', []), position)
+
+    def compile_condition(self, condition: Dict) -> CompiledCondition:
+        field = condition['field']
+        predicate = condition['predicate']
+        value = condition['value']
+
+        if field not in FIELD_COLUMNS:
+            raise RuleCompileError(f"Unknown condition field '{field}'")
+
+        column = FIELD_COLUMNS[field]
+        if column == 'received_at':
+            test = self._compile_received(column, predicate, value)
+        else:
+            test = self._compile_text(column, predicate, value)
+
+        return CompiledCondition(field, predicate, value, test)
+
+    @staticmethod
+    def parse_age(value: str) -> Tuple[int, str]:
+        """Parse a received value such as '1_day' or '2_month' into (number, unit)"""
+        try:
+            number, unit = str(value).split('_', 1)
+            number = int(number)
+        except ValueError:
+            raise RuleCompileError(f"Invalid received value '{value}'")
+        if unit not in TIME_UNITS:
+            raise RuleCompileError(f"Invalid received value '{value}'")
+        return number, unit
+
+    @classmethod
+    def received_cutoff(cls, value: str, now: datetime) -> int:
+        """
+        The UTC epoch a received value reaches back to from now;
+        '1_month' on March 31st is February 28th/29th, not 30 days ago
+        """
+        number, unit = cls.parse_age(value)
+        if unit == 'month':
+            return int(subtract_months(now, number).timestamp())
+        return int((now - timedelta(days=number)).timestamp())
+
+    def _compile_received(self, column: str, predicate: str,
+                          value: str) -> Callable[[PreparedEmail, datetime], bool]:
+        self.parse_age(value)
+        # now is the same for a whole run, so the cutoff is computed once per run
+        cutoff = lru_cache(maxsize=1)(lambda now: self.received_cutoff(value, now))
+
+        # Newer than the cutoff is 'received less than N ago'
+        if predicate == 'less_than':
+            return lambda email, now: (email.values[column] is not None
+                                       and email.values[column] > cutoff(now))
+        if predicate == 'greater_than':
+            return lambda email, now: (email.values[column] is not None
+                                       and email.values[column] < cutoff(now))
+
+        raise RuleCompileError(f"Unknown predicate '{predicate}' for received")
+
+    @staticmethod
+    def _compile_text(column: str, predicate: str,
+                      value: Any) -> Callable[[PreparedEmail, datetime], bool]:
+        needle = str(value).lower()
+
+        if not needle and predicate in INDEXED_PREDICATES:
+            # The empty string is in every non-empty field
+            is_contains = predicate == 'contains'
+            return lambda email, now: email.values[column] is not None and is_contains
+
+        # contains/does_not_contain read the needles found by the rule set's matcher
+        if predicate == 'contains':
+            return lambda email, now: needle in email.hits[column]
+        if predicate == 'does_not_contain':
+            return lambda email, now: (email.values[column] is not None
+                                       and needle not in email.hits[column])
+        if predicate == 'equals':
+            return lambda email, now: needle == email.values[column]
+        if predicate == 'does_not_equal':
+            return lambda email, now: (email.values[column] is not None
+                                       and needle != email.values[column])
+
+        raise RuleCompileError(f"Unknown predicate '{predicate}' for {column}")
@@ -0,0 +1,166 @@
+import sqlite3
+import json
+import logging
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, List, Tuple
+from database.body_store import column_sql
+from email_manager.rule_compiler import CompiledRule, CompiledRuleSet
+from email_manager.rule_sql import RuleSqlTranslator
+from utils.chunking import chunked
+from utils.metrics import metrics
+
+# Unevaluated emails within a batch's id range
+BATCH_SCOPE = 'id BETWEEN ? AND ? AND evaluated_rules_hash IS NULL'
+
+# Unevaluated emails among an explicit list of row ids, passed as one JSON array
+ID_SCOPE = 'id IN (SELECT value FROM json_each(?)) AND evaluated_rules_hash IS NULL'
+
+# Emails last evaluated under a given rule set version
+VERSION_SCOPE = 'evaluated_rules_hash = ?'
+
+# Rules evaluated per SQL statement, one result column each
+SQL_RULES_PER_QUERY = 100
+
+class RuleEvaluator:
+    """
+    Finds which rules match which emails in an id range.
+
+    Rules SQL can express run inside SQLite, grouped into one statement
+    per SQL_RULES_PER_QUERY rules with a match flag column per rule. The
+    rest fall back to the compiled Python evaluation, which reads only the
+    columns those rules reference.
+
+    query is any callable running a read query and returning its rows, so
+    the same evaluator works on the shared connection and on a worker's
+    own read-only connection.
+    """
+
+    def __init__(self, query: Callable[[str, Iterable], List[Tuple]],
+                 rules: CompiledRuleSet,
+                 translator: RuleSqlTranslator = None):
+        self.query = query
+        self.rules = rules
+        self.translator = translator or RuleSqlTranslator()
+        self.logger = logging.getLogger(__name__)
+
+    def matches(self, first_id: int, last_id: int,
+                now: datetime) -> Iterator[Tuple[str, CompiledRule]]:
+        """Yield (message_id, rule) for every match among the unevaluated emails in the range"""
+        return self._matches(BATCH_SCOPE, [first_id, last_id], now)
+
+    def matches_ids(self, ids: List[int],
+                    now: datetime) -> Iterator[Tuple[str, CompiledRule]]:
+        """Yield (message_id, rule) for every match among the unevaluated emails with these row ids"""
+        return self._matches(ID_SCOPE, [json.dumps(list(ids))], now)
+
+    def matches_version(self, rules_hash: str,
+                        now: datetime) -> Iterator[Tuple[str, CompiledRule]]:
+        """Yield (message_id, rule) for every match among the emails evaluated under rules_hash"""
+        return self._matches(VERSION_SCOPE, [rules_hash], now)
+
+    def _matches(self, scope: str, scope_params: List,
+                 now: datetime) -> Iterator[Tuple[str, CompiledRule]]:
+        if metrics.enabled:
+            # Every rule is checked against every email in scope, however it is evaluated
+            checked = self.query(f'SELECT COUNT(*) FROM emails WHERE {scope}', scope_params)[0][0]
+            for rule in self.rules:
+                metrics.inc('rule_evaluations_total', checked, rule=rule.name)
+
+        sql_rules = []
+        python_rules = []
+        for rule in self.rules:
+            translated = self.translator.translate_rule(rule, now)
+            if translated is None:
+                python_rules.append(rule)
+            else:
+                sql_rules.append((rule, *translated))
+
+        # One summary line per call; thousands of rules would otherwise log a line each
+        matches = 0
+        matched_rules = set()
+        found = []
+        if sql_rules:
+            found.append(self._match_in_sql(sql_rules, scope, scope_params))
+        if python_rules:
+            found.append(self._match_in_python(CompiledRuleSet(python_rules), scope, scope_params, now))
+        for matching in found:
+            for message_id, rule in matching:
+                matches += 1
+                matched_rules.add(rule.position)
+                yield message_id, rule
+        self.logger.info(f"{matches} matches for {len(matched_rules)} of {len(self.rules)} rules")
+
+    def _match_in_sql(self, rules: List[Tuple[CompiledRule, str, List]],
+                      scope: str, scope_params: List) -> Iterator[Tuple[str, CompiledRule]]:
+        """
+        Let SQLite find the rules' matches among the batch's emails in one
+        pass per group of rules, reading only the IDs of matching emails
+        and a match flag per rule
+        """
+        for group in chunked(rules, SQL_RULES_PER_QUERY):
+            flags = ', '.join(where for _, where, _ in group)
+            any_match = ' OR '.join(where for _, where, _ in group)
+            params = [p for _, _, rule_params in group for p in rule_params]
+
+            try:
+                with metrics.timer('rule_query_seconds', path='sql'):
+                    rows = self.query(f"""
+                        SELECT message_id, {flags} FROM emails
+                        WHERE {scope}
+                        AND ({any_match})
+                    """, params + scope_params + params)
+            except sqlite3.Error as e:
+                self.logger.error(
+                    f"Error processing rules {[rule.name for rule, _, _ in group]} in SQL: {e}"
+                )
+                continue
+
+            matched = [0] * len(group)
+            for message_id, *rule_flags in rows:
+                for position, flag in enumerate(rule_flags):
+                    if flag:
+                        matched[position] += 1
+                        yield message_id, group[position][0]
+
+            for (rule, _, _), count in zip(group, matched):
+                metrics.inc('rule_matches_total', count, rule=rule.name)
+                if count:
+                    self.logger.debug(f"Rule '{rule.name}' matched {count} emails")
+
+    def _match_in_python(self, rules: CompiledRuleSet, scope: str, scope_params: List,
+                         now: datetime) -> Iterator[Tuple[str, CompiledRule]]:
+        """Evaluate rules SQL can't express, reading only the columns they need"""
+        columns = ['id', 'message_id', 'subject'] + [c for c in rules.columns if c != 'subject']
+        try:
+            with metrics.timer('rule_query_seconds', path='python'):
+                rows = self.query(f"""
+                    SELECT {', '.join(column_sql(c) for c in columns)} FROM emails
+                    WHERE {scope}
+                    ORDER BY id
+                """, scope_params)
+        except sqlite3.Error as e:
+            self.logger.error(f"Database error: {e}")
+            return
+
+        for row in rows:
+            email = dict(zip(columns, row))
+            try:
+                prepared = rules.prepare(email)
+            except Exception as e:
+                self.logger.error(f"Error reading fields of email {email['message_id']}: {e}")
+                continue
+
+            for rule in rules.candidate_rules(prepared):
+                try:
+                    if rule.matches(prepared, now):
+                        metrics.inc('rule_matches_total', rule=rule.name)
+                        self.logger.debug(
+                            f"Rule '{rule.name}' matched for email: "
+                            f"{email['subject']}"
+                        )
+                        yield email['message_id'], rule
+                except Exception as e:
+                    self.logger.error(
+                        f"Error processing rule '{rule.name}' "
+                        f"for email {email['message_id']}: {e}"
+                    )
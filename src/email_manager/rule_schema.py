@@ -0,0 +1,109 @@
+from typing import Any, List
+from email_manager.rule_compiler import FIELD_COLUMNS, RuleCompileError, RuleCompiler
+
+# Predicates accepted per kind of field
+TEXT_PREDICATES = ('contains', 'does_not_contain', 'equals', 'does_not_equal')
+RECEIVED_PREDICATES = ('less_than', 'greater_than')
+
+MATCH_TYPES = ('all', 'any')
+
+# Action type -> accepted values, None for any non-empty label name
+ACTION_VALUES = {
+    'move': None,
+    'mark_as': ('read', 'unread')
+}
+
+
+class RuleValidationError(ValueError):
+    """rules.json doesn't follow the rule schema; errors lists every problem found"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def validate_rules(document: Any) -> None:
+    """
+    Check a loaded rules.json against the rule schema, raising
+    RuleValidationError listing every problem rather than the first
+    """
+    errors: List[str] = []
+    if not isinstance(document, dict) or not isinstance(document.get('rules'), list):
+        raise RuleValidationError(["expected an object with a 'rules' list"])
+
+    names = set()
+    for position, rule in enumerate(document['rules']):
+        where = f"rules[{position}]"
+        if not isinstance(rule, dict):
+            errors.append(f"{where}: expected an object")
+            continue
+
+        name = rule.get('name')
+        if not isinstance(name, str) or not name.strip():
+            errors.append(f"{where}: 'name' must be a non-empty string")
+        elif name in names:
+            errors.append(f"{where}: duplicate rule name '{name}'")
+        else:
+            names.add(name)
+            where = f"rule '{name}'"
+
+        if rule.get('match_type', 'all') not in MATCH_TYPES:
+            errors.append(f"{where}: 'match_type' must be one of {list(MATCH_TYPES)}")
+
+        conditions = rule.get('conditions')
+        if not isinstance(conditions, list) or not conditions:
+            errors.append(f"{where}: 'conditions' must be a non-empty list")
+        else:
+            for number, condition in enumerate(conditions):
+                errors.extend(_condition_errors(f"{where} condition {number}", condition))
+
+        actions = rule.get('actions', [])
+        if not isinstance(actions, list):
+            errors.append(f"{where}: 'actions' must be a list")
+        else:
+            for number, action in enumerate(actions):
+                errors.extend(_action_errors(f"{where} action {number}", action))
+
+    if errors:
+        raise RuleValidationError(errors)
+
+
+def _condition_errors(where: str, condition: Any) -> List[str]:
+    if not isinstance(condition, dict):
+        return [f"{where}: expected an object"]
+
+    field = condition.get('field')
+    if field not in FIELD_COLUMNS:
+        return [f"{where}: unknown field {field!r}, expected one of {sorted(FIELD_COLUMNS)}"]
+    if not isinstance(condition.get('value'), str):
+        return [f"{where}: 'value' must be a string"]
+
+    predicate = condition.get('predicate')
+    if FIELD_COLUMNS[field] == 'received_at':
+        if predicate not in RECEIVED_PREDICATES:
+            return [f"{where}: predicate {predicate!r} must be one of {list(RECEIVED_PREDICATES)}"]
+        try:
+            RuleCompiler.parse_age(condition['value'])
+        except RuleCompileError as e:
+            return [f"{where}: {e}, expected e.g. '3_day' or '2_month'"]
+    elif predicate not in TEXT_PREDICATES:
+        return [f"{where}: predicate {predicate!r} must be one of {list(TEXT_PREDICATES)}"]
+    return []
+
+
+def _action_errors(where: str, action: Any) -> List[str]:
+    if not isinstance(action, dict):
+        return [f"{where}: expected an object"]
+
+    kind = action.get('type')
+    if kind not in ACTION_VALUES:
+        return [f"{where}: unknown type {kind!r}, expected one of {sorted(ACTION_VALUES)}"]
+
+    value = action.get('value')
+    allowed = ACTION_VALUES[kind]
+    if allowed is None:
+        if not isinstance(value, str) or not value.strip():
+            return [f"{where}: '{kind}' needs a non-empty label name"]
+    elif value not in allowed:
+        return [f"{where}: '{kind}' value must be one of {list(allowed)}"]
+    return []
@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+from email_manager.rule_compiler import CompiledRule, CompiledRuleSet, RuleCompiler
+from email_manager.rule_schema import validate_rules
+
+# (mtime in ns, size) of the rules file a RuleSet was loaded from
+FileStamp = Tuple[int, int]
+
+
+def hash_rules(document: Dict) -> str:
+    """Content hash of a rules document; formatting-only edits keep the same hash"""
+    canonical = json.dumps(document, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def file_stamp(path: str) -> Optional[FileStamp]:
+    """What changes when the rules file is saved, None if it is missing"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class RuleSet:
+    """
+    One validated and compiled version of rules.json.
+
+    A RuleSet is never modified, so swapping the executor's reference to
+    a newly loaded one is atomic. Besides the compiled rules it records a
+    content hash per rule, to tell which rules a new version added or
+    changed.
+    """
+
+    def __init__(self, document: Dict, stamp: Optional[FileStamp] = None):
+        validate_rules(document)
+        self.document = document
+        self.stamp = stamp
+        self.compiled: CompiledRuleSet = RuleCompiler().compile(document)
+        self.rules_hash = hash_rules(document)
+        # Rules are identified by content, so reordering rules.json changes no rule
+        self.rule_hashes: List[str] = [hash_rules(rule) for rule in document['rules']]
+        self.by_position: Dict[int, CompiledRule] = {rule.position: rule for rule in self.compiled}
+
+    @classmethod
+    def load(cls, path: str) -> 'RuleSet':
+        """
+        Read, validate and compile a rules file
+        Raises OSError, ValueError (bad JSON) or RuleValidationError
+        """
+        stamp = file_stamp(path)
+        with open(path, 'r') as f:
+            return cls(json.load(f), stamp)
+
+    def added_since(self, previous_hashes: Iterable[str]) -> List[CompiledRule]:
+        """Rules that are new or changed compared to a version with these rule hashes"""
+        previous = set(previous_hashes)
+        return [
+            self.by_position[position]
+            for position, rule_hash in enumerate(self.rule_hashes)
+            if rule_hash not in previous
+        ]
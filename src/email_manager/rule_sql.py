@@ -0,0 +1,105 @@
+from datetime import datetime
+from typing import List, Optional, Tuple
+from database.body_store import ASCII_LOWERINGS, column_sql
+from email_manager.rule_compiler import CompiledCondition, CompiledRule, RuleCompiler
+
+
+def escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def can_lower_into(needle: str, equality: bool) -> bool:
+    """
+    Whether text with a character of ASCII_LOWERINGS could match an ASCII
+    needle once lowercased by Python. The needle must hold the ASCII letter
+    the character lowers to, and an equality also fails on the combining
+    dot U+0130 leaves behind.
+    """
+    return any(
+        lowered[0] in needle and (lowered.isascii() or not equality)
+        for lowered in ASCII_LOWERINGS.values()
+    )
+
+
+def folded_match(column: str, test: str, params: List, computed: bool) -> Tuple[str, List]:
+    """
+    test (SQL over {}) on column, also matching once the characters of
+    ASCII_LOWERINGS are lowercased as Python would; folding only adds
+    matches for an ASCII needle. A plain column only goes through
+    fold_lowerings() when it holds one of them, as the function call costs
+    several times the match, while a computed one is folded outright
+    rather than evaluated twice.
+    """
+    folded = test.format(f"fold_lowerings({column})")
+    if computed:
+        return folded, params
+    holds = ' OR '.join(f"instr({column}, '{char}')" for char in ASCII_LOWERINGS)
+    return f"({test.format(column)} OR (({holds}) AND {folded}))", params * 2
+
+
+class RuleSqlTranslator:
+    """
+    Translates compiled rules into SQL WHERE clauses over the emails table,
+    so matching happens inside SQLite and only matching rows are read.
+
+    A condition is only pushed down when SQLite gives exactly the same
+    answer as the Python predicate. SQLite's LIKE and lower() only fold
+    ASCII case, so needles with other characters stay in Python, as does
+    any rule containing such a condition. The two non-ASCII characters
+    Python lowercases to ASCII are also folded by fold_lowerings() when
+    they could make a difference.
+    """
+
+    def translate_rule(self, rule: CompiledRule, now: datetime) -> Optional[Tuple[str, List]]:
+        """Return (where_clause, params) for the rule, or None if it must run in Python"""
+        clauses = []
+        params: List = []
+        for condition in rule.conditions:
+            translated = self.translate_condition(condition, now)
+            if translated is None:
+                return None
+            clause, condition_params = translated
+            clauses.append(clause)
+            params.extend(condition_params)
+
+        if not clauses:
+            return None
+
+        joiner = ' AND ' if rule.match_type == 'all' else ' OR '
+        return '(' + joiner.join(clauses) + ')', params
+
+    def translate_condition(self, condition: CompiledCondition,
+                            now: datetime) -> Optional[Tuple[str, List]]:
+        # Bodies are read from email_bodies, decompressed only for rows that get that far
+        column = column_sql(condition.column)
+
+        if condition.column == 'received_at':
+            # An integer range on idx_received_at; NULL (unknown) dates never match,
+            # and typeof() keeps out any legacy text value Python would skip too
+            cutoff = RuleCompiler.received_cutoff(condition.value, now)
+            operator = '>' if condition.predicate == 'less_than' else '<'
+            return (
+                f"({column} {operator} ? AND typeof({column}) = 'integer')",
+                [cutoff]
+            )
+
+        needle = condition.needle
+        if not needle or not needle.isascii():
+            return None
+
+        # Python treats an empty field as not matching any condition
+        present = f"COALESCE({column}, '') != ''"
+        equality = condition.predicate in ('equals', 'does_not_equal')
+        if equality:
+            test, params = "lower({}) = ?", [needle]
+        elif condition.predicate in ('contains', 'does_not_contain'):
+            test, params = "{} LIKE ? ESCAPE '\\'", [f"%{escape_like(needle)}%"]
+        else:
+            return None
+        if can_lower_into(needle, equality):
+            matched, params = folded_match(column, test, params, column != condition.column)
+        else:
+            matched = test.format(column)
+        if condition.predicate in ('contains', 'equals'):
+            return matched, params
+        return f"({present} AND NOT {matched})", params
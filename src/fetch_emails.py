@@ -1,20 +1,52 @@
-from database.email_repository import EmailDatabase
-from gmail.gmail_manager import GmailManager
+import argparse
+from email_manager.mailbox_sync import MailboxSync
+from gmail.gmail_manager import GmailManager, CLIENT_MODES
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Download Gmail messages into the local database')
+    parser.add_argument('--query', default='',
+                        help="Gmail search query, e.g. 'after:2024/11/24' (default: whole mailbox)")
+    parser.add_argument('--page-size', type=int, default=500,
+                        help='message IDs requested per messages.list page (max 500)')
+    parser.add_argument('--max-messages', type=int,
+                        help='total number of messages to fetch, 0 for no cap '
+                             '(default: 5, no cap with --incremental)')
+    parser.add_argument('--chunk-size', type=int, default=100,
+                        help='emails written to the database per transaction')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only fetch changes since the last run via the Gmail history API, '
+                             'falling back to a full sync when there is no usable checkpoint')
+    parser.add_argument('--client', choices=CLIENT_MODES,
+                        help='Gmail client to fetch with (default: gmail.client in config.yaml)')
+    return parser.parse_args()
 
 def main():
-    gmail = GmailManager()
-    db = EmailDatabase()
+    args = parse_args()
+    gmail = GmailManager(client=args.client)
+    sync = MailboxSync(gmail=gmail)
+    # A capped fallback full sync would save no checkpoint, and every run would fall back again
+    if args.max_messages is None:
+        args.max_messages = 0 if args.incremental else 5
+    options = dict(
+        query=args.query,
+        page_size=args.page_size,
+        max_messages=args.max_messages or None,
+        chunk_size=args.chunk_size
+    )
+
+    # Stream the mailbox page by page and store each chunk as it arrives
+    try:
+        if args.incremental:
+            result = sync.sync(**options)
+        else:
+            result = sync.full_sync(**options)
+    finally:
+        gmail.close()
 
-    emails = gmail.get_messages(
-        max_results=5,
-        query='after:2024/11/24'
+    print(
+        f"Successfully synced the database: {result['added']} added, "
+        f"{result['deleted']} deleted, {result['updated']} updated."
     )
-    
-    # Insert emails into database
-    inserted_count = db.insert_emails(emails)
-    print(f"Successfully inserted {inserted_count} emails into the database.")
-    
-    print(emails[0].keys())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
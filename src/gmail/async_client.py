@@ -0,0 +1,402 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any, AsyncIterable, AsyncIterator, Awaitable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+)
+import requests
+from google.auth.transport.requests import Request
+from requests.adapters import HTTPAdapter
+from gmail.message_fetcher import (
+    METADATA_HEADERS, RETRYABLE_STATUSES, RATE_LIMIT_REASONS, backoff_delay, record_error
+)
+from utils.email_parser import EmailParser
+from utils.metrics import metrics
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover - optional dependency
+    aiohttp = None
+
+GMAIL_API_URL = 'https://gmail.googleapis.com/gmail/v1/users'
+
+# Gmail's per-user limit is 250 quota units per second, spent per method
+USER_QUOTA_UNITS_PER_SECOND = 250
+QUOTA_UNITS = {
+    'labels.list': 1,
+    'labels.create': 5,
+    'messages.get': 5,
+    'messages.list': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50
+}
+
+# users.messages.batchModify accepts at most 1000 message IDs per request
+BATCH_MODIFY_LIMIT = 1000
+
+
+class AsyncHttpError(Exception):
+    """A Gmail REST call returned an error status"""
+
+    def __init__(self, status: int, body: Any, method: str):
+        super().__init__(f"{method} returned {status}: {body}")
+        self.status = status
+        self.body = body
+
+    @property
+    def retryable(self) -> bool:
+        if self.status in RETRYABLE_STATUSES:
+            return True
+        return self.status == 403 and any(reason in str(self.body) for reason in RATE_LIMIT_REASONS)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: tokens refill continuously at rate per
+    second up to capacity, and acquire() waits until enough are available
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: float = 1) -> None:
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class _AiohttpTransport:
+    """Pooled keep-alive connections through one aiohttp session"""
+
+    def __init__(self, max_connections: int, timeout: float):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._session = None
+
+    async def request(self, method: str, url: str, headers: Dict,
+                      params: List[Tuple[str, Any]], body: Optional[Dict]) -> Tuple[int, Any]:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        async with self._session.request(method, url, headers=headers,
+                                         params=params, json=body) as response:
+            if response.content_type == 'application/json':
+                return response.status, await response.json()
+            return response.status, await response.text()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class _RequestsTransport:
+    """
+    Fallback without aiohttp: a pooled requests session driven from a
+    thread pool, one thread per connection
+    """
+
+    def __init__(self, max_connections: int, timeout: float):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._threads = ThreadPoolExecutor(max_workers=max_connections)
+
+    def _send(self, method: str, url: str, headers: Dict,
+              params: List[Tuple[str, Any]], body: Optional[Dict]) -> Tuple[int, Any]:
+        response = self.session.request(method, url, headers=headers, params=params,
+                                        json=body, timeout=self.timeout)
+        if response.headers.get('Content-Type', '').startswith('application/json'):
+            return response.status_code, response.json()
+        return response.status_code, response.text
+
+    async def request(self, method: str, url: str, headers: Dict,
+                      params: List[Tuple[str, Any]], body: Optional[Dict]) -> Tuple[int, Any]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._threads, self._send, method, url, headers, params, body
+        )
+
+    async def close(self) -> None:
+        self._threads.shutdown(wait=False)
+        self.session.close()
+
+
+class AsyncGmailClient:
+    """
+    Gmail REST client keeping many requests in flight over a pooled HTTP
+    session (aiohttp when installed, otherwise a pooled requests session
+    on a thread pool).
+
+    At most max_concurrency requests run at once, and a token bucket
+    spends Gmail's per-user quota units so bursts don't end in 429s.
+    Messages are parsed with the same EmailParser as the blocking
+    fetcher, so both paths produce identical emails.
+    """
+
+    def __init__(self,
+                 credentials,
+                 parser: Optional[EmailParser] = None,
+                 max_concurrency: int = 20,
+                 quota_units_per_second: float = USER_QUOTA_UNITS_PER_SECOND,
+                 max_retries: int = 5,
+                 timeout: float = 60,
+                 user_id: str = 'me'):
+        self.credentials = credentials
+        self.parser = parser or EmailParser()
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.user_id = user_id
+        self.logger = logging.getLogger(__name__)
+        self.quota = TokenBucket(quota_units_per_second)
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._refresh_lock = asyncio.Lock()
+        transport = _AiohttpTransport if aiohttp is not None else _RequestsTransport
+        self.transport = transport(self.max_concurrency, timeout)
+
+    async def __aenter__(self) -> 'AsyncGmailClient':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        await self.transport.close()
+
+    async def _token(self, force_refresh: bool = False) -> str:
+        """Bearer token, refreshed off the event loop when it has expired"""
+        async with self._refresh_lock:
+            if force_refresh or not self.credentials.valid:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.credentials.refresh, Request())
+            return self.credentials.token
+
+    async def _call(self, api_method: str, http_method: str, path: str,
+                    params: Optional[Dict] = None, body: Optional[Dict] = None) -> Any:
+        """Send one rate-limited request, retrying rate limits and transient errors"""
+        url = f"{GMAIL_API_URL}/{self.user_id}/{path}"
+        # Repeated query parameters (e.g. metadataHeaders) are passed as lists
+        query = [
+            (key, item)
+            for key, value in (params or {}).items() if value is not None
+            for item in (value if isinstance(value, (list, tuple)) else [value])
+        ]
+        refreshed = False
+
+        for attempt in range(self.max_retries + 1):
+            await self.quota.acquire(QUOTA_UNITS.get(api_method, 5))
+            headers = {'Authorization': f"Bearer {await self._token()}"}
+            metrics.inc('gmail_calls_total', method=api_method)
+            async with self._slots:
+                with metrics.timer('gmail_request_seconds', method=api_method):
+                    status, data = await self.transport.request(http_method, url, headers, query, body)
+
+            if status < 300:
+                return data
+            if status == 401 and not refreshed:
+                # The token was revoked or expired early, refresh once
+                refreshed = True
+                await self._token(force_refresh=True)
+                continue
+
+            error = AsyncHttpError(status, data, api_method)
+            retrying = attempt < self.max_retries and error.retryable
+            record_error(api_method, error, retrying)
+            if retrying:
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+            raise error
+
+    async def get_message(self, message_id: str, format: str = 'full') -> Dict:
+        """users.messages.get, returning the raw message resource"""
+        params = {'format': format}
+        if format == 'metadata':
+            params['metadataHeaders'] = METADATA_HEADERS
+        return await self._call('messages.get', 'GET', f"messages/{message_id}", params=params)
+
+    async def _fetch_one(self, message_id: str, format: str) -> Optional[Dict]:
+        try:
+            msg = await self.get_message(message_id, format)
+        except Exception as e:
+            self.logger.error(f"Error fetching message {message_id}: {e}")
+            return None
+        try:
+            return self.parser.parse_message(msg, format)
+        except Exception as e:
+            self.logger.error(f"Error parsing message {message_id}: {e}")
+            return None
+
+    async def fetch_messages(self, message_ids: Union[Iterable[str], AsyncIterable[str]],
+                             format: str = 'full') -> AsyncIterator[Dict]:
+        """
+        Yield parsed emails as they arrive, keeping a bounded number of requests queued
+        message_ids is read on the event loop: an in-memory iterable, or an
+        async iterator such as list_message_ids for IDs still being listed
+        """
+        max_in_flight = self.max_concurrency * 2
+        in_flight = set()
+        if isinstance(message_ids, AsyncIterable):
+            async_ids, ids = aiter(message_ids), None
+        else:
+            async_ids, ids = None, iter(message_ids)
+        exhausted = False
+
+        try:
+            while in_flight or not exhausted:
+                while not exhausted and len(in_flight) < max_in_flight:
+                    if ids is None:
+                        message_id = await anext(async_ids, None)
+                    else:
+                        message_id = next(ids, None)
+                    if message_id is None:
+                        exhausted = True
+                        break
+                    in_flight.add(asyncio.ensure_future(self._fetch_one(message_id, format)))
+
+                if not in_flight:
+                    break
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result():
+                        yield task.result()
+        finally:
+            for task in in_flight:
+                task.cancel()
+            if async_ids is not None and hasattr(async_ids, 'aclose'):
+                await async_ids.aclose()
+
+    async def list_message_ids(self, query: str = '', page_size: int = 500,
+                               max_messages: Optional[int] = None,
+                               listed: Optional[Set[str]] = None) -> AsyncIterator[str]:
+        """
+        Yield the IDs of every message matching the query, following nextPageToken
+        Each ID is also added to listed when it is given
+        """
+        page_token = None
+        yielded = 0
+        while True:
+            if max_messages:
+                page_size = min(page_size, max_messages - yielded)
+            results = await self._call('messages.list', 'GET', 'messages', params={
+                'q': query, 'maxResults': page_size, 'pageToken': page_token
+            })
+            for message in results.get('messages', []):
+                if listed is not None:
+                    listed.add(message['id'])
+                yield message['id']
+                yielded += 1
+                if max_messages and yielded >= max_messages:
+                    return
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return
+
+    async def list_labels(self) -> List[Dict]:
+        results = await self._call('labels.list', 'GET', 'labels')
+        return results.get('labels', [])
+
+    async def create_label(self, name: str) -> Dict:
+        return await self._call('labels.create', 'POST', 'labels', body={
+            'name': name,
+            'labelListVisibility': 'labelShow',
+            'messageListVisibility': 'show'
+        })
+
+    async def _modify_chunk(self, chunk: List[str], add_label_ids: List[str],
+                            remove_label_ids: List[str]) -> bool:
+        try:
+            await self._call('messages.batchModify', 'POST', 'messages/batchModify', body={
+                'ids': chunk,
+                'addLabelIds': add_label_ids,
+                'removeLabelIds': remove_label_ids
+            })
+            return True
+        except Exception as e:
+            self.logger.error(
+                f"Error modifying chunk of {len(chunk)} messages starting at {chunk[0]}: {e}"
+            )
+            return False
+
+    async def batch_modify(self, message_ids: List[str], add_label_ids: List[str],
+                           remove_label_ids: List[str]) -> Dict[str, List[str]]:
+        """
+        users.messages.batchModify with up to BATCH_MODIFY_LIMIT IDs per
+        request, sending the chunks concurrently
+
+        Returns:
+            dict: 'succeeded' and 'failed' lists of message IDs. A chunk
+            either succeeds or fails as a whole.
+        """
+        chunks = [message_ids[start:start + BATCH_MODIFY_LIMIT]
+                  for start in range(0, len(message_ids), BATCH_MODIFY_LIMIT)]
+        outcomes = await asyncio.gather(*(
+            self._modify_chunk(chunk, add_label_ids, remove_label_ids) for chunk in chunks
+        ))
+
+        result = {'succeeded': [], 'failed': []}
+        for chunk, ok in zip(chunks, outcomes):
+            result['succeeded' if ok else 'failed'].extend(chunk)
+        return result
+
+
+async def _await(awaitable: Awaitable) -> Any:
+    return await awaitable
+
+
+class EventLoopRunner:
+    """
+    Drives coroutines and async generators from blocking code on one
+    long-lived event loop, so the client's pooled connections are reused
+    across calls
+
+    The loop runs on its own thread and callers hand it work with
+    run_coroutine_threadsafe, so any number of threads (the pipeline's
+    fetch and apply workers) can share one runner and client at once.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='gmail-event-loop',
+                                         daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine: Awaitable) -> Any:
+        """Run an awaitable on the loop thread and wait for its result"""
+        if self.loop.is_closed():
+            raise RuntimeError("The event loop runner is closed")
+        return asyncio.run_coroutine_threadsafe(_await(coroutine), self.loop).result()
+
+    def iterate(self, generator: AsyncIterator) -> Iterator:
+        """Consume an async generator as a regular iterator"""
+        try:
+            while True:
+                try:
+                    yield self.run(generator.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(generator.aclose())
+
+    def close(self) -> None:
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
@@ -1,7 +1,14 @@
 import logging
-from typing import List, Dict, Optional, Union
+import threading
+from typing import Iterable, Iterator, List, Dict, Optional, Set, Tuple, Union
+from googleapiclient.errors import HttpError
 from auth.authenticator import GmailAuthenticator
-from utils.email_parser import EmailParser
+from database.label_cache_repository import LabelCacheRepository
+from utils.email_parser import EmailParser, DEFAULT_MAX_BODY_BYTES
+from utils.chunking import chunked
+from gmail.message_fetcher import MessageFetcher, record_error
+from utils.metrics import metrics
+from gmail.async_client import AsyncGmailClient, EventLoopRunner, BATCH_MODIFY_LIMIT
 
 logging.basicConfig(
     level=logging.INFO,
@@ -12,71 +19,341 @@ logging.basicConfig(
     ]
 )
 
+# users.messages.list returns at most 500 IDs per page
+LIST_PAGE_LIMIT = 500
+
+# blocking: googleapiclient calls, async: AsyncGmailClient on a pooled HTTP session
+CLIENT_MODES = ('blocking', 'async')
+
+class HistoryExpiredError(Exception):
+    """The stored historyId is too old for users.history.list, a full sync is needed"""
+
 class GmailManager:
-    def __init__(self, config_path: str = 'configs/config.yaml'):
+    def __init__(self, config_path: str = 'configs/config.yaml', client: Optional[str] = None):
         self.logger = logging.getLogger(__name__)
         self.authenticator = GmailAuthenticator(config_path)
         self.user_id = 'me'
-        self.email_parser = EmailParser()
+        email_config = self.authenticator.config.get('email', {})
+        self.email_parser = EmailParser(
+            max_body_bytes=email_config.get('max_body_bytes', DEFAULT_MAX_BODY_BYTES),
+            default_charset=email_config.get('charset', 'utf-8')
+        )
+        gmail_config = self.authenticator.config.get('gmail', {})
+        self.fetch_config = gmail_config.get('fetch', {})
+        self.async_config = gmail_config.get('async', {})
+
+        # Fetching and label changes go through the blocking or the async client
+        self.client = client or gmail_config.get('client', 'blocking')
+        if self.client not in CLIENT_MODES:
+            raise ValueError(f"Unknown Gmail client '{self.client}'")
+        self._async_client: Optional[AsyncGmailClient] = None
+        self._runner: Optional[EventLoopRunner] = None
+        # Concurrent pipeline workers must not each start a client
+        self._async_lock = threading.Lock()
+        metrics.configure(self.authenticator.config.get('metrics', {}))
+
+        # Label name -> ID, filled by a single labels.list per run
+        self._label_ids: Optional[Dict[str, str]] = None
+        # Concurrent appliers must not both create a missing label
+        self._label_lock = threading.RLock()
+        cache_config = gmail_config.get('label_cache', {})
+        self.label_cache_store = None
+        if cache_config.get('persist'):
+            self.label_cache_store = LabelCacheRepository(
+                db_path=cache_config.get('db_path', 'database/email.db'),
+                ttl_seconds=cache_config.get('ttl_seconds', 3600)
+            )
 
-    def get_messages(self, max_results: int = 10, query: str = '') -> List[Dict[str, str]]:
+    def get_messages(self, max_results: int = 10, query: str = '',
+                     fetch_mode: Optional[str] = None) -> List[Dict[str, str]]:
         """Fetches emails from Gmail based on the search query."""
+        return list(self.iter_messages(max_results, query, fetch_mode))
+
+    def iter_messages(self, max_results: int = 10, query: str = '',
+                      fetch_mode: Optional[str] = None) -> Iterator[Dict[str, str]]:
+        """
+        Fetches emails from Gmail based on the search query, yielding each
+        parsed email as soon as its batch (or thread) returns it
+        """
         try:
-            service = self.authenticator.authenticate()
-            
-            results = service.users().messages().list(
-                userId='me',
-                maxResults=max_results,
-                q=query
-            ).execute()
-
-            messages = results.get('messages', [])
-            emails = []
-
-            for message in messages:
-                msg = service.users().messages().get(
-                    userId='me',
-                    id=message['id'],
-                    format='full'
-                ).execute()
-                
-                parsed_email = self.email_parser.parse_message(msg)
-                print(parsed_email['message_id'])
-                emails.append(parsed_email)
-
-            return emails
+            yield from self._list_and_fetch(query, min(max_results, LIST_PAGE_LIMIT), max_results,
+                                            fetch_mode)
 
         except Exception as e:
             self.logger.error(f"Error fetching messages: {str(e)}")
-            return []
+
+    def iter_message_ids(self, query: str = '', page_size: int = LIST_PAGE_LIMIT,
+                         max_messages: Optional[int] = None,
+                         listed: Optional[Set[str]] = None) -> Iterator[str]:
+        """
+        Yield the IDs of every message matching the query, following nextPageToken
+        Each ID is also added to listed when it is given
+        """
+        service = self.authenticator.authenticate()
+        page_size = max(1, min(page_size, LIST_PAGE_LIMIT))
+        page_token = None
+        yielded = 0
+
+        while True:
+            if max_messages:
+                page_size = min(page_size, max_messages - yielded)
+
+            results = self._execute(service.users().messages().list(
+                userId=self.user_id,
+                maxResults=page_size,
+                q=query,
+                pageToken=page_token
+            ), 'messages.list')
+
+            for message in results.get('messages', []):
+                if listed is not None:
+                    listed.add(message['id'])
+                yield message['id']
+                yielded += 1
+                if max_messages and yielded >= max_messages:
+                    return
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return
+
+    def backfill(self, query: str = '', page_size: int = LIST_PAGE_LIMIT,
+                 max_messages: Optional[int] = None, chunk_size: int = 100,
+                 fetch_mode: Optional[str] = None,
+                 format: str = 'full',
+                 listed: Optional[Set[str]] = None) -> Iterator[List[Dict[str, str]]]:
+        """
+        Walk the whole mailbox (or everything matching the query) and yield
+        parsed emails in chunks of at most chunk_size, so callers can persist
+        each chunk and memory stays flat whatever the mailbox size
+        The listed IDs are added to listed when it is given, so a caller
+        can tell which messages could not be fetched
+        """
+        emails = self._list_and_fetch(query, page_size, max_messages, fetch_mode, format, listed)
+        yield from chunked(emails, chunk_size)
+
+    def _list_and_fetch(self, query: str, page_size: int, max_messages: Optional[int],
+                        fetch_mode: Optional[str] = None,
+                        format: str = 'full',
+                        listed: Optional[Set[str]] = None) -> Iterator[Dict[str, str]]:
+        """
+        Fetch the messages matching the query while their IDs are listed
+        The async client lists them with its own messages.list calls, a
+        blocking page request would stall every request on its event loop
+        """
+        if self.client == 'async':
+            client, runner = self._async()
+            page_size = max(1, min(page_size, LIST_PAGE_LIMIT))
+            message_ids = client.list_message_ids(query, page_size, max_messages, listed)
+            return runner.iterate(client.fetch_messages(message_ids, format))
+        message_ids = self.iter_message_ids(query, page_size, max_messages, listed)
+        return self.fetch_messages(message_ids, fetch_mode, format)
+
+    def fetch_messages(self, message_ids: Iterable[str],
+                       fetch_mode: Optional[str] = None,
+                       format: str = 'full') -> Iterator[Dict[str, str]]:
+        """
+        Fetch and parse the given messages, yielding them as they arrive
+        format='metadata' fetches headers only, leaving bodies for later
+        With the async client message_ids is read on its event loop, so it
+        must not block: pass a list, not IDs still being listed
+        """
+        if self.client == 'async':
+            client, runner = self._async()
+            return runner.iterate(client.fetch_messages(message_ids, format))
+        return self._fetcher(fetch_mode).fetch(message_ids, format)
+
+    def get_history_id(self) -> str:
+        """Get the mailbox's current historyId from the user's profile"""
+        service = self.authenticator.authenticate()
+        profile = self._execute(service.users().getProfile(userId=self.user_id), 'getProfile')
+        return profile['historyId']
+
+    def watch(self, topic_name: str, label_ids: Optional[List[str]] = None) -> Dict:
+        """
+        Ask Gmail to publish mailbox changes to a Cloud Pub/Sub topic
+        Returns the historyId and expiration (epoch ms); a watch lapses
+        after 7 days unless it is renewed
+        """
+        service = self.authenticator.authenticate()
+        body = {'topicName': topic_name}
+        if label_ids:
+            body['labelIds'] = label_ids
+            body['labelFilterBehavior'] = 'include'
+        return self._execute(service.users().watch(userId=self.user_id, body=body), 'watch')
+
+    def stop_watch(self) -> None:
+        """Stop the Pub/Sub notifications started by watch"""
+        service = self.authenticator.authenticate()
+        self._execute(service.users().stop(userId=self.user_id), 'stop')
+
+    def get_history_changes(self, start_history_id: str) -> Dict:
+        """
+        List everything that changed since start_history_id with users.history.list
         
+        Returns:
+            dict: 'added' and 'deleted' sets of message IDs, 'labels' mapping
+            message IDs to their label IDs after the change, and 'history_id',
+            the checkpoint to resume from next time
+            
+        Raises:
+            HistoryExpiredError: if Gmail no longer has history that far back
+        """
+        service = self.authenticator.authenticate()
+        changes = {'added': set(), 'deleted': set(), 'labels': {}, 'history_id': start_history_id}
+        page_token = None
+
+        while True:
+            try:
+                results = self._execute(service.users().history().list(
+                    userId=self.user_id,
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+                    maxResults=LIST_PAGE_LIMIT,
+                    pageToken=page_token
+                ), 'history.list')
+            except HttpError as e:
+                if e.resp.status == 404:
+                    raise HistoryExpiredError(
+                        f"History since {start_history_id} is no longer available"
+                    ) from e
+                raise
+
+            # Records are in chronological order, so later entries win
+            for record in results.get('history', []):
+                for item in record.get('messagesAdded', []):
+                    message_id = item['message']['id']
+                    changes['added'].add(message_id)
+                    changes['deleted'].discard(message_id)
+                for item in record.get('messagesDeleted', []):
+                    message_id = item['message']['id']
+                    changes['deleted'].add(message_id)
+                    changes['added'].discard(message_id)
+                    changes['labels'].pop(message_id, None)
+                for item in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                    message = item['message']
+                    if message['id'] not in changes['deleted']:
+                        changes['labels'][message['id']] = message.get('labelIds', [])
+
+            changes['history_id'] = results.get('historyId', changes['history_id'])
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return changes
+
+    def get_label_name(self, label_id: str) -> Optional[str]:
+        """Reverse lookup of a label ID in the label cache"""
+        if self._label_ids is None:
+            self._refresh_label_cache()
+        for name, cached_id in self._label_ids.items():
+            if cached_id == label_id:
+                return name
+        return None
+
+    @staticmethod
+    def _execute(request, method: str):
+        """Execute a googleapiclient request, counted and timed per API method"""
+        metrics.inc('gmail_calls_total', method=method)
+        try:
+            with metrics.timer('gmail_request_seconds', method=method):
+                return request.execute()
+        except Exception as e:
+            record_error(method, e, retrying=False)
+            raise
+
+    def _fetcher(self, fetch_mode: Optional[str] = None) -> MessageFetcher:
+        return MessageFetcher(
+            service_factory=self.authenticator.authenticate,
+            parser=self.email_parser,
+            mode=fetch_mode or self.fetch_config.get('mode', 'batch'),
+            batch_size=self.fetch_config.get('batch_size', 100),
+            max_workers=self.fetch_config.get('max_workers', 8),
+            max_retries=self.fetch_config.get('max_retries', 5),
+            user_id=self.user_id
+        )
+
+    def _async(self) -> Tuple[AsyncGmailClient, EventLoopRunner]:
+        """The async client and the event loop driving it, created on first use"""
+        with self._async_lock:
+            if self._async_client is None:
+                self._runner = EventLoopRunner()
+                self._async_client = AsyncGmailClient(
+                    credentials=self.authenticator.get_credentials(),
+                    parser=self.email_parser,
+                    max_concurrency=self.async_config.get('max_concurrency', 20),
+                    quota_units_per_second=self.async_config.get('quota_units_per_second', 250),
+                    max_retries=self.fetch_config.get('max_retries', 5),
+                    user_id=self.user_id
+                )
+            return self._async_client, self._runner
+
+    def close(self) -> None:
+        """Close the async client's HTTP session, if one was opened, and report the auth cache"""
+        avoided = self.authenticator.avoided_calls()
+        self.logger.info(
+            f"Gmail session reused: {avoided['token_loads_avoided']} token loads and "
+            f"{avoided['service_builds_avoided']} service builds avoided"
+        )
+        if self._async_client is not None:
+            self._runner.run(self._async_client.close())
+            self._runner.close()
+            self._async_client = None
+            self._runner = None
+
+    def _refresh_label_cache(self) -> Dict[str, str]:
+        """List all labels once and cache them by upper-cased name"""
+        if self.client == 'async':
+            client, runner = self._async()
+            labels = runner.run(client.list_labels())
+        else:
+            service = self.authenticator.authenticate()
+            labels = self._execute(
+                service.users().labels().list(userId=self.user_id), 'labels.list'
+            ).get('labels', [])
+        self._label_ids = {label['name'].upper(): label['id'] for label in labels}
+        if self.label_cache_store:
+            self.label_cache_store.save(self._label_ids)
+        return self._label_ids
+
     def _get_label_id(self, label_name: str) -> str:
         """
         Get Gmail label ID from label name
         Creates the label if it doesn't exist
         """
-        try:
-            # List all labels
-            service = self.authenticator.authenticate()
-            results = service.users().labels().list(userId=self.user_id).execute()
-            labels = results.get('labels', [])
+        with self._label_lock:
+            return self._resolve_label_id(label_name.upper())
 
-            # Search for existing label
-            for label in labels:
-                if label['name'].upper() == label_name.upper():
-                    return label['id']
+    def _resolve_label_id(self, name: str) -> str:
+        # Try the cache loaded once per run (or persisted by an earlier run)
+        if self._label_ids is None and self.label_cache_store:
+            self._label_ids = self.label_cache_store.load()
+        if self._label_ids and name in self._label_ids:
+            return self._label_ids[name]
+
+        try:
+            # Cache miss: the label may have been created since the cache was filled
+            label_ids = self._refresh_label_cache()
+            if name in label_ids:
+                return label_ids[name]
 
             # Create new label if it doesn't exist
-            label_object = {
-                'name': label_name.upper(),
-                'labelListVisibility': 'labelShow',
-                'messageListVisibility': 'show'
-            }
-            created_label = self.service.users().labels().create(
-                userId=self.user_id,
-                body=label_object
-            ).execute()
-            
+            if self.client == 'async':
+                client, runner = self._async()
+                created_label = runner.run(client.create_label(name))
+            else:
+                label_object = {
+                    'name': name,
+                    'labelListVisibility': 'labelShow',
+                    'messageListVisibility': 'show'
+                }
+                service = self.authenticator.authenticate()
+                created_label = self._execute(service.users().labels().create(
+                    userId=self.user_id,
+                    body=label_object
+                ), 'labels.create')
+
+            self._label_ids[name] = created_label['id']
+            if self.label_cache_store:
+                self.label_cache_store.put(name, created_label['id'])
             return created_label['id']
 
         except Exception as e:
@@ -88,7 +365,7 @@ class GmailManager:
                    add_labels: List[str] = None,
                    remove_labels: List[str] = None) -> bool:
         """
-        Modify Gmail messages one by one by adding or removing labels
+        Modify Gmail messages by adding or removing labels
         
         Args:
             message_ids: Single message ID or list of message IDs
@@ -100,58 +377,89 @@ class GmailManager:
         """
         if isinstance(message_ids, str):
             message_ids = [message_ids]
+
+        result = self.batch_modify_messages(message_ids, add_labels, remove_labels)
+        return len(result['succeeded']) == len(message_ids)
+
+    def batch_modify_messages(self,
+                              message_ids: List[str],
+                              add_labels: List[str] = None,
+                              remove_labels: List[str] = None) -> Dict[str, List[str]]:
+        """
+        Modify Gmail messages with users.messages.batchModify, sending
+        up to BATCH_MODIFY_LIMIT message IDs per request
+        
+        Args:
+            message_ids: List of message IDs
+            add_labels: List of label names to add
+            remove_labels: List of label names to remove
             
-        if not add_labels:
-            add_labels = []
-        if not remove_labels:
-            remove_labels = []
+        Returns:
+            dict: 'succeeded' and 'failed' lists of message IDs. A chunk
+            either succeeds or fails as a whole.
+        """
+        result = {'succeeded': [], 'failed': []}
+        message_ids = list(message_ids)
+        if not message_ids:
+            return result
+
+        add_labels = add_labels or []
+        remove_labels = remove_labels or []
 
         try:
             # Convert label names to label IDs
             add_label_ids = [self._get_label_id(label) for label in add_labels]
             remove_label_ids = [self._get_label_id(label) for label in remove_labels]
+            if self.client == 'async':
+                client, runner = self._async()
+            else:
+                service = self.authenticator.authenticate()
+        except Exception as e:
+            self.logger.error(f"Error in batch_modify_messages: {str(e)}")
+            result['failed'] = message_ids
+            return result
 
-            service = self.authenticator.authenticate()
-            success_count = 0
+        if self.client == 'async':
+            # Chunks are sent concurrently over the pooled session
+            result = runner.run(client.batch_modify(message_ids, add_label_ids, remove_label_ids))
+            self.logger.info(
+                f"Successfully modified {len(result['succeeded'])} messages: "
+                f"Added labels {add_labels}, Removed labels {remove_labels}"
+            )
+            return result
 
-            # Process each message individually
-            for message_id in message_ids:
-                try:
-                    # Prepare modification body
-                    modify_body = {
+        for start in range(0, len(message_ids), BATCH_MODIFY_LIMIT):
+            chunk = message_ids[start:start + BATCH_MODIFY_LIMIT]
+            try:
+                self._execute(service.users().messages().batchModify(
+                    userId=self.user_id,
+                    body={
+                        'ids': chunk,
                         'addLabelIds': add_label_ids,
                         'removeLabelIds': remove_label_ids
                     }
+                ), 'messages.batchModify')
 
-                    # Modify message
-                    service.users().messages().modify(
-                        userId=self.user_id,
-                        id=message_id,
-                        body=modify_body
-                    ).execute()
-
-                    success_count += 1
-                    self.logger.info(
-                        f"Successfully modified message {message_id}: "
-                        f"Added labels {add_labels}, Removed labels {remove_labels}"
-                    )
-
-                except HttpError as e:
-                    self.logger.error(
-                        f"Error modifying message {message_id}: {str(e)}"
-                    )
-                    continue
-                except Exception as e:
-                    self.logger.error(
-                        f"Unexpected error modifying message {message_id}: {str(e)}"
-                    )
-                    continue
-
-            return success_count == len(message_ids)
+                result['succeeded'].extend(chunk)
+                self.logger.info(
+                    f"Successfully modified {len(chunk)} messages: "
+                    f"Added labels {add_labels}, Removed labels {remove_labels}"
+                )
 
-        except Exception as e:
-            self.logger.error(f"Error in modify_messages: {str(e)}")
-            return False
+            except HttpError as e:
+                result['failed'].extend(chunk)
+                self.logger.error(
+                    f"Error modifying chunk of {len(chunk)} messages "
+                    f"starting at {chunk[0]}: {str(e)}"
+                )
+            except Exception as e:
+                result['failed'].extend(chunk)
+                self.logger.error(
+                    f"Unexpected error modifying chunk of {len(chunk)} messages "
+                    f"starting at {chunk[0]}: {str(e)}"
+                )
+
+        return result
         
     # def modify_messages(self, 
     #                 message_ids: Union[str, List[str]], 
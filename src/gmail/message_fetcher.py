@@ -0,0 +1,227 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+from googleapiclient.errors import HttpError
+from utils.email_parser import EmailParser
+from utils.metrics import metrics
+
+# Gmail accepts at most 100 calls per HTTP batch request
+MAX_BATCH_SIZE = 100
+
+# Headers requested with format=metadata, the ones stored in the emails table
+METADATA_HEADERS = ['From', 'To', 'Subject', 'Date']
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limit and transient server errors are worth retrying"""
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    if status in RETRYABLE_STATUSES:
+        return True
+    return status == 403 and any(reason in str(error) for reason in RATE_LIMIT_REASONS)
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """A 429, or a 403 whose reason is a rate limit"""
+    status = error.resp.status if isinstance(error, HttpError) else getattr(error, 'status', None)
+    return status == 429 or (status == 403 and any(reason in str(error) for reason in RATE_LIMIT_REASONS))
+
+
+def record_error(method: str, error: Exception, retrying: bool) -> None:
+    """Count a failed Gmail call, and whether it was rate limited and will be retried"""
+    if not metrics.enabled:
+        return
+    metrics.inc('gmail_errors_total', method=method)
+    if is_rate_limited(error):
+        metrics.inc('gmail_rate_limited_total', method=method)
+    if retrying:
+        metrics.inc('gmail_retries_total', method=method)
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 32.0) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class MessageFetcher:
+    """
+    Fetches and parses many Gmail messages concurrently.
+
+    Modes:
+        batch   - groups messages.get calls into HTTP batch requests
+        threads - runs messages.get calls on a bounded thread pool, one
+                  service object per thread since httplib2 isn't thread-safe
+        serial  - one messages.get call at a time
+
+    Parsed emails are yielded as soon as they arrive. Rate-limited calls
+    are retried with exponential backoff.
+    """
+
+    def __init__(self,
+                 service_factory: Callable[[], Any],
+                 parser: Optional[EmailParser] = None,
+                 mode: str = 'batch',
+                 batch_size: int = MAX_BATCH_SIZE,
+                 max_workers: int = 8,
+                 max_retries: int = 5,
+                 user_id: str = 'me'):
+        if mode not in ('batch', 'threads', 'serial'):
+            raise ValueError(f"Unknown fetch mode '{mode}'")
+
+        self.service_factory = service_factory
+        self.parser = parser or EmailParser()
+        self.mode = mode
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max_retries
+        self.user_id = user_id
+        self.logger = logging.getLogger(__name__)
+        self._local = threading.local()
+
+    def fetch(self, message_ids: Iterable[str], format: str = 'full') -> Iterator[Dict]:
+        """
+        Yield parsed emails for the given message IDs as they are fetched
+        format='metadata' downloads only METADATA_HEADERS, no bodies
+        """
+        if self.mode == 'batch':
+            return self._fetch_batched(message_ids, format)
+        if self.mode == 'threads':
+            return self._fetch_threaded(message_ids, format)
+        return self._fetch_serial(message_ids, format)
+
+    def _parse(self, msg: Dict, format: str) -> Optional[Dict]:
+        try:
+            return self.parser.parse_message(msg, format)
+        except Exception as e:
+            self.logger.error(f"Error parsing message {msg.get('id')}: {e}")
+            return None
+
+    def _get_request(self, service, message_id: str, format: str):
+        if format == 'metadata':
+            return service.users().messages().get(
+                userId=self.user_id,
+                id=message_id,
+                format=format,
+                metadataHeaders=METADATA_HEADERS
+            )
+        return service.users().messages().get(
+            userId=self.user_id,
+            id=message_id,
+            format=format
+        )
+
+    def _get_with_retry(self, service, message_id: str, format: str) -> Optional[Dict]:
+        for attempt in range(self.max_retries + 1):
+            metrics.inc('gmail_calls_total', method='messages.get')
+            try:
+                with metrics.timer('gmail_request_seconds', method='messages.get'):
+                    return self._get_request(service, message_id, format).execute()
+            except Exception as e:
+                retrying = attempt < self.max_retries and is_retryable(e)
+                record_error('messages.get', e, retrying)
+                if retrying:
+                    time.sleep(backoff_delay(attempt))
+                    continue
+                self.logger.error(f"Error fetching message {message_id}: {e}")
+                return None
+
+    def _fetch_serial(self, message_ids: Iterable[str], format: str) -> Iterator[Dict]:
+        service = self.service_factory()
+        for message_id in message_ids:
+            msg = self._get_with_retry(service, message_id, format)
+            parsed = self._parse(msg, format) if msg else None
+            if parsed:
+                yield parsed
+
+    def _fetch_batched(self, message_ids: Iterable[str], format: str) -> Iterator[Dict]:
+        service = self.service_factory()
+        chunk: List[str] = []
+        for message_id in message_ids:
+            chunk.append(message_id)
+            if len(chunk) == self.batch_size:
+                yield from self._execute_batch(service, chunk, format)
+                chunk = []
+        if chunk:
+            yield from self._execute_batch(service, chunk, format)
+
+    def _execute_batch(self, service, message_ids: List[str], format: str) -> Iterator[Dict]:
+        pending = list(message_ids)
+
+        for attempt in range(self.max_retries + 1):
+            responses: Dict[str, Dict] = {}
+            retry: List[str] = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    responses[request_id] = response
+                    return
+                retrying = attempt < self.max_retries and is_retryable(exception)
+                record_error('messages.get', exception, retrying)
+                if retrying:
+                    retry.append(request_id)
+                else:
+                    self.logger.error(f"Error fetching message {request_id}: {exception}")
+
+            batch = service.new_batch_http_request(callback=callback)
+            for message_id in pending:
+                batch.add(self._get_request(service, message_id, format), request_id=message_id)
+
+            # Each call in the batch counts, the HTTP round trip is timed as one 'batch' request
+            metrics.inc('gmail_calls_total', len(pending), method='messages.get')
+            try:
+                with metrics.timer('gmail_request_seconds', method='batch'):
+                    batch.execute()
+            except Exception as e:
+                retrying = attempt < self.max_retries and is_retryable(e)
+                record_error('batch', e, retrying)
+                if retrying:
+                    time.sleep(backoff_delay(attempt))
+                    continue
+                self.logger.error(f"Error executing batch of {len(pending)} messages: {e}")
+                return
+
+            # Keep the order the IDs were listed in
+            for message_id in pending:
+                if message_id in responses:
+                    parsed = self._parse(responses[message_id], format)
+                    if parsed:
+                        yield parsed
+
+            if not retry:
+                return
+            self.logger.warning(f"Retrying {len(retry)} rate-limited messages")
+            pending = retry
+            time.sleep(backoff_delay(attempt))
+
+    def _thread_service(self):
+        if not hasattr(self._local, 'service'):
+            self._local.service = self.service_factory()
+        return self._local.service
+
+    def _fetch_one(self, message_id: str, format: str) -> Optional[Dict]:
+        msg = self._get_with_retry(self._thread_service(), message_id, format)
+        return self._parse(msg, format) if msg else None
+
+    def _fetch_threaded(self, message_ids: Iterable[str], format: str) -> Iterator[Dict]:
+        # Bound the number of in-flight requests so a huge ID stream isn't queued at once
+        max_in_flight = self.max_workers * 2
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = set()
+            for message_id in message_ids:
+                in_flight.add(executor.submit(self._fetch_one, message_id, format))
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future.result():
+                            yield future.result()
+
+            for future in wait(in_flight).done:
+                if future.result():
+                    yield future.result()
@@ -1,12 +1,54 @@
+import argparse
 from email_manager.email_rule_executor import EmailRuleExecutor
+from email_manager.action_planner import ActionPlanner
+from gmail.gmail_manager import GmailManager, CLIENT_MODES
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Apply rules.json to emails stored in the local database')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='emails evaluated and applied per transaction')
+    parser.add_argument('--max-emails', type=int, default=0,
+                        help='stop after this many emails, 0 for no cap')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes evaluating rules in parallel')
+    parser.add_argument('--all', action='store_true',
+                        help='re-evaluate every email, not only new or changed ones')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the planned label changes without calling Gmail or changing the database')
+    parser.add_argument('--client', choices=CLIENT_MODES,
+                        help='Gmail client to apply label changes with (default: gmail.client in config.yaml)')
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+
     # Initialize the executor
-    executor = EmailRuleExecutor()
-    
-    # Process the 5 most recent emails
-    executor.process_emails(limit=5)
+    gmail = GmailManager(client=args.client)
+    try:
+        executor = EmailRuleExecutor(gmail=gmail)
+        if args.dry_run:
+            plan = executor.plan_emails(
+                batch_size=args.batch_size,
+                max_emails=args.max_emails or None,
+                all_emails=args.all
+            )
+            for line in ActionPlanner.describe(plan):
+                print(line)
+            print(f"Planned changes for {sum(len(ids) for ids in plan.values())} emails")
+            return
+
+        if args.all:
+            executor.reset_evaluations()
+
+        # Process emails that are new or changed since they were last evaluated
+        executor.process_emails(
+            batch_size=args.batch_size,
+            max_emails=args.max_emails or None,
+            workers=args.workers
+        )
+    finally:
+        gmail.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
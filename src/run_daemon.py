@@ -0,0 +1,40 @@
+import argparse
+import signal
+from email_manager.mail_daemon import MailDaemon
+from gmail.gmail_manager import GmailManager, CLIENT_MODES
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Keep the local database synced and rules applied as new mail arrives'
+    )
+    parser.add_argument('--interval', type=float,
+                        help='seconds between syncs without a notification, 0 to only sync on '
+                             'notifications (default: daemon.interval_seconds in config.yaml)')
+    parser.add_argument('--webhook-port', type=int,
+                        help='local port accepting change notifications, 0 to disable '
+                             '(default: daemon.webhook.port in config.yaml)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes evaluating rules in parallel')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='emails evaluated and applied per transaction')
+    parser.add_argument('--chunk-size', type=int, default=100,
+                        help='emails written to the database per transaction')
+    parser.add_argument('--client', choices=CLIENT_MODES,
+                        help='Gmail client to use (default: gmail.client in config.yaml)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    daemon = MailDaemon(
+        gmail=GmailManager(client=args.client),
+        interval_seconds=args.interval,
+        webhook_port=args.webhook_port,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        chunk_size=args.chunk_size
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    daemon.run()
+
+if __name__ == "__main__":
+    main()
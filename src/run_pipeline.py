@@ -0,0 +1,70 @@
+import argparse
+import json
+from email_manager.pipeline import EmailPipeline
+from gmail.gmail_manager import GmailManager, CLIENT_MODES
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Fetch, store, evaluate and apply rules in one concurrent pipeline'
+    )
+    parser.add_argument('--query', default='',
+                        help="Gmail search query, e.g. 'after:2024/11/24' (default: whole mailbox)")
+    parser.add_argument('--page-size', type=int, default=500,
+                        help='message IDs requested per messages.list page (max 500)')
+    parser.add_argument('--max-messages', type=int, default=0,
+                        help='total number of messages to fetch, 0 for no cap')
+    parser.add_argument('--chunk-size', type=int, default=100,
+                        help='emails per batch passed between stages')
+    parser.add_argument('--fetch-workers', type=int,
+                        help='threads fetching message batches (default: pipeline.fetch_workers)')
+    parser.add_argument('--evaluate-workers', type=int,
+                        help='threads evaluating rules (default: pipeline.evaluate_workers)')
+    parser.add_argument('--apply-workers', type=int,
+                        help='threads applying label changes (default: pipeline.apply_workers)')
+    parser.add_argument('--queue-size', type=int,
+                        help='batches buffered between two stages (default: pipeline.queue_size)')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='also write the run metrics as JSON to this file')
+    parser.add_argument('--client', choices=CLIENT_MODES,
+                        help='Gmail client to use (default: gmail.client in config.yaml)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    gmail = GmailManager(client=args.client)
+    try:
+        pipeline = EmailPipeline(
+            gmail=gmail,
+            fetch_workers=args.fetch_workers,
+            evaluate_workers=args.evaluate_workers,
+            apply_workers=args.apply_workers,
+            queue_size=args.queue_size,
+            chunk_size=args.chunk_size
+        )
+        report = pipeline.run(
+            query=args.query,
+            page_size=args.page_size,
+            max_messages=args.max_messages or None
+        )
+    finally:
+        gmail.close()
+
+    print(
+        f"Processed {report['fetched']} emails in {report['elapsed_seconds']}s "
+        f"({report['emails_per_second']} emails/s): {report['inserted']} new, "
+        f"{report['updated']} updated, {report['applied']} changed in Gmail, {report['failed']} failed, "
+        f"{report['dropped']} dropped by failed batches"
+    )
+    for name, stage in report['stages'].items():
+        print(
+            f"  {name:<9} {stage['workers']} workers  {stage['items_per_second']:>9}/s  "
+            f"batch {stage['avg_batch_ms']}ms  queue wait {stage['avg_queue_wait_ms']}ms  "
+            f"depth avg {stage['avg_queue_depth']} max {stage['max_queue_depth']}  "
+            f"busy {stage['utilization']:.0%}  errors {stage['errors']}"
+        )
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
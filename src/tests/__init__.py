@@ -0,0 +1,4 @@
+import os
+
+# gmail.gmail_manager logs to logs/gmail_fetcher.log from the working directory (src) on import
+os.makedirs('logs', exist_ok=True)
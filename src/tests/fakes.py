@@ -0,0 +1,64 @@
+"""Test doubles and fixtures shared by the tests"""
+import json
+import os
+from typing import Dict, Iterable, Iterator, List, Optional
+from database.email_repository import EmailDatabase
+from database.migration import create_email_schema
+
+
+class FakeGmail:
+    """
+    Stands in for GmailManager where the rule executor calls it, recording
+    every batchModify and serving bodies for the emails it was given
+    """
+
+    def __init__(self, emails: Iterable[Dict] = ()):
+        self.emails = {email['message_id']: email for email in emails}
+        self.modified: List[Dict] = []
+        self.fetched: List[str] = []
+
+    def batch_modify_messages(self, message_ids: List[str], add_labels: List[str],
+                              remove_labels: List[str]) -> Dict[str, List[str]]:
+        self.modified.append({'ids': sorted(message_ids), 'add': sorted(add_labels),
+                              'remove': sorted(remove_labels)})
+        return {'succeeded': list(message_ids), 'failed': []}
+
+    def fetch_messages(self, message_ids: Iterable[str], fetch_mode: Optional[str] = None,
+                       format: str = 'full') -> Iterator[Dict]:
+        for message_id in message_ids:
+            self.fetched.append(message_id)
+            yield self.emails[message_id]
+
+
+def make_email(number: int, subject: str, sender: str, body: str = '',
+               body_fetched: bool = True) -> Dict:
+    """An email as EmailParser returns it"""
+    return {
+        'message_id': f'm{number:03d}',
+        'subject': subject,
+        'sender': sender,
+        'recipient': 'me@example.com',
+        'date': '',
+        'internal_date': str(1700000000000 + number * 1000),
+        'body': body if body_fetched else '',
+        'body_fetched': body_fetched
+    }
+
+
+def rule(name: str, field: str, predicate: str, value: str, action: Dict) -> Dict:
+    return {'name': name, 'match_type': 'all',
+            'conditions': [{'field': field, 'predicate': predicate, 'value': value}],
+            'actions': [action]}
+
+
+def write_rules(path: str, rules: List[Dict]) -> None:
+    with open(path, 'w') as f:
+        json.dump({'rules': rules}, f)
+
+
+def create_database(workdir: str, emails: Iterable[Dict]) -> str:
+    """A fresh email database in workdir holding the given emails"""
+    db_path = os.path.join(workdir, 'email.db')
+    create_email_schema(db_path)
+    EmailDatabase(db_path).insert_emails(emails)
+    return db_path
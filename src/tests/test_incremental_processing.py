@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+from database.connection import Database
+from database.email_repository import EmailDatabase
+from email_manager.email_rule_executor import EmailRuleExecutor
+from tests.fakes import FakeGmail, create_database, make_email, rule, write_rules
+
+MOVE_TO_BILLS = rule('bills', 'subject', 'contains', 'invoice', {'type': 'move', 'value': 'Bills'})
+READ_SHOP = rule('shop', 'from', 'contains', 'shop.example', {'type': 'mark_as', 'value': 'read'})
+
+
+class IncrementalProcessingTest(unittest.TestCase):
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.rules_path = os.path.join(workdir.name, 'rules.json')
+        self.emails = [
+            make_email(1, 'Invoice 1', 'billing@shop.example'),
+            make_email(2, 'Invoice 2', 'billing@power.example'),
+            make_email(3, 'Hello', 'friend@mail.example'),
+        ]
+        self.db_path = create_database(workdir.name, self.emails)
+        write_rules(self.rules_path, [MOVE_TO_BILLS, READ_SHOP])
+        self.gmail = FakeGmail(self.emails)
+        self.executor = EmailRuleExecutor(self.db_path, self.rules_path, gmail=self.gmail)
+
+    def pending(self):
+        return [row[0] for row in Database.shared(self.db_path).query(
+            'SELECT message_id FROM emails WHERE evaluated_rules_hash IS NULL ORDER BY id')]
+
+    def test_second_run_evaluates_nothing(self):
+        self.assertEqual(self.executor.process_emails(), 3)
+        self.gmail.modified.clear()
+
+        self.assertEqual(self.executor.process_emails(), 0)
+        self.assertEqual(self.gmail.modified, [])
+        self.assertEqual(self.pending(), [])
+
+    def test_only_new_emails_are_evaluated(self):
+        self.executor.process_emails()
+        self.gmail.modified.clear()
+
+        EmailDatabase(self.db_path).insert_emails([make_email(4, 'Invoice 4', 'a@mail.example')])
+        self.assertEqual(self.pending(), ['m004'])
+        self.assertEqual(self.executor.process_emails(), 1)
+        self.assertEqual(self.gmail.modified, [{'ids': ['m004'], 'add': ['BILLS'], 'remove': ['INBOX']}])
+
+    def test_changed_email_is_queued_again(self):
+        self.executor.process_emails()
+
+        database = EmailDatabase(self.db_path)
+        counts = database.insert_emails([self.emails[0], make_email(3, 'Invoice 3', 'friend@mail.example')])
+        self.assertEqual(counts, {'inserted': 0, 'updated': 1, 'unchanged': 1})
+        self.assertEqual(self.pending(), ['m003'])
+        self.assertEqual(self.executor.process_emails(), 1)
+
+    def test_batches_cover_every_pending_email_once(self):
+        EmailDatabase(self.db_path).insert_emails(
+            [make_email(number, f'Invoice {number}', 'a@mail.example') for number in range(4, 12)]
+        )
+        self.assertEqual(self.executor.process_emails(batch_size=3), 11)
+        self.assertEqual(sum(len(call['ids']) for call in self.gmail.modified), 10)
+        self.assertEqual(self.pending(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
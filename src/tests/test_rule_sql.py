@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from database.connection import Database
+from email_manager.rule_compiler import RuleCompiler
+from email_manager.rule_evaluator import RuleEvaluator
+from email_manager.rule_sql import RuleSqlTranslator
+from tests.fakes import create_database, make_email, rule
+
+MARK_READ = {'type': 'mark_as', 'value': 'read'}
+
+
+class PythonOnlyTranslator(RuleSqlTranslator):
+    """Pushes nothing down, so every rule is evaluated in Python"""
+
+    def translate_rule(self, rule, now):
+        return None
+
+
+class RuleSqlParityTest(unittest.TestCase):
+    """Rules pushed down to SQLite must match exactly the emails the Python evaluation matches"""
+
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        emails = [
+            make_email(1, 'Café au lait', 'Zoë <zoe@café.example>', 'Grüße aus München'),
+            make_email(2, 'CAFÉ', 'ZOE@CAFE.EXAMPLE', 'GRÜSSE'),
+            make_email(3, 'Invoice 50% off_now', 'billing@shop.example', '请查收发票 invoice'),
+            make_email(4, '', 'nobody@example.com', ''),
+            make_email(5, 'invoice', 'Billing@Shop.Example', 'see attached'),
+            make_email(6, 'Re: invoice', '', 'a\\b path'),
+            make_email(7, 'Subject only', 'x@example.com', body_fetched=False),
+            make_email(8, '\u212aey ring', 'x@example.com', 'from \u0130stanbul'),
+            make_email(9, 'Key', 'y@example.com', 'istanbul'),
+        ]
+        self.db_path = create_database(workdir.name, emails)
+        self.now = datetime.now(timezone.utc)
+
+    def matches(self, rules, translator=None):
+        compiled = RuleCompiler().compile({'rules': rules})
+        evaluator = RuleEvaluator(Database.shared(self.db_path).query, compiled, translator)
+        return sorted((message_id, rule.name) for message_id, rule in evaluator.matches(1, 100, self.now))
+
+    def assert_same_matches(self, field, predicate, values):
+        rules = [rule(f'{predicate} {value!r}', field, predicate, value, MARK_READ) for value in values]
+        pushed = [r for r in RuleCompiler().compile({'rules': rules})
+                  if RuleSqlTranslator().translate_rule(r, self.now) is not None]
+        self.assertTrue(pushed, 'no rule was pushed down to SQL')
+        self.assertEqual(self.matches(rules), self.matches(rules, PythonOnlyTranslator()))
+
+    def test_contains(self):
+        self.assert_same_matches('subject', 'contains', ['invoice', 'INVOICE', 'café', '50%', '_now', ''])
+
+    def test_does_not_contain(self):
+        self.assert_same_matches('subject', 'does_not_contain', ['invoice', 'CAFÉ', 'au', '%', ''])
+
+    def test_equals(self):
+        self.assert_same_matches('subject', 'equals', ['invoice', 'Invoice', 'café', 'CAFÉ', ''])
+
+    def test_does_not_equal(self):
+        self.assert_same_matches('subject', 'does_not_equal', ['invoice', 'café', 'cafÉ', ''])
+
+    def test_non_ascii_sender_and_body(self):
+        self.assert_same_matches('from', 'contains', ['zoe', 'zoë', 'CAFE.example', 'shop'])
+        self.assert_same_matches('message', 'contains', ['invoice', 'grüße', '发票', 'a\\b', 'see'])
+        self.assert_same_matches('message', 'does_not_contain', ['invoice', 'GRÜSSE', 'path'])
+
+    def test_characters_lowered_to_ascii(self):
+        # str.lower() turns the Kelvin sign into 'k' and 'İ' into 'i' plus a combining dot
+        for predicate in ('contains', 'does_not_contain', 'equals', 'does_not_equal'):
+            self.assert_same_matches('subject', predicate, ['key', 'key ring', 'k'])
+            self.assert_same_matches('message', predicate, ['istanbul', 'i\u0307stanbul', 'from i'])
+
+    def test_any_of_mixed_conditions(self):
+        mixed = {'name': 'mixed', 'match_type': 'any', 'actions': [MARK_READ], 'conditions': [
+            {'field': 'subject', 'predicate': 'equals', 'value': 'invoice'},
+            {'field': 'from', 'predicate': 'does_not_contain', 'value': 'example'}
+        ]}
+        self.assertEqual(self.matches([mixed]), self.matches([mixed], PythonOnlyTranslator()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from database.connection import Database
+from email_manager.email_rule_executor import EmailRuleExecutor
+from tests.fakes import FakeGmail, create_database, make_email, rule, write_rules
+
+MOVE_TO_BILLS = rule('bills', 'subject', 'contains', 'invoice', {'type': 'move', 'value': 'Bills'})
+READ_SHOP = rule('shop', 'from', 'contains', 'shop.example', {'type': 'mark_as', 'value': 'read'})
+READ_BODY = rule('body', 'message', 'contains', 'tracking', {'type': 'mark_as', 'value': 'read'})
+
+
+class RuleVersionTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.rules_path = os.path.join(self.workdir.name, 'rules.json')
+        self.emails = [
+            make_email(1, 'Invoice 1', 'billing@shop.example', 'your tracking number'),
+            make_email(2, 'Invoice 2', 'billing@power.example', 'due soon'),
+            make_email(3, 'Hello', 'friend@mail.example', 'tracking the trip'),
+            make_email(4, 'Sale', 'news@shop.example', 'new arrivals'),
+        ]
+
+    def executor(self, rules, stored_emails=None, gmail=None):
+        write_rules(self.rules_path, rules)
+        if stored_emails is not None:
+            self.db_path = create_database(self.workdir.name, stored_emails)
+        return EmailRuleExecutor(self.db_path, self.rules_path, gmail=gmail or FakeGmail(self.emails))
+
+    def evaluated_hashes(self):
+        return {row[0] for row in Database.shared(self.db_path).query(
+            'SELECT evaluated_rules_hash FROM emails')}
+
+    def test_added_rule_sends_no_actions_of_older_rules(self):
+        self.executor([MOVE_TO_BILLS], self.emails).process_emails()
+
+        gmail = FakeGmail(self.emails)
+        executor = self.executor([MOVE_TO_BILLS, READ_SHOP], gmail=gmail)
+        self.assertEqual(executor.process_emails(), 0)
+
+        self.assertEqual(gmail.modified, [{'ids': ['m001', 'm004'], 'add': [], 'remove': ['UNREAD']}])
+        self.assertEqual(self.evaluated_hashes(), {executor.rules_hash})
+
+    def test_changed_rule_is_applied_to_exactly_its_matches(self):
+        self.executor([MOVE_TO_BILLS, READ_SHOP], self.emails).process_emails()
+
+        gmail = FakeGmail(self.emails)
+        changed = rule('shop', 'from', 'contains', 'power.example', {'type': 'mark_as', 'value': 'read'})
+        executor = self.executor([MOVE_TO_BILLS, changed], gmail=gmail)
+        executor.process_emails()
+
+        self.assertEqual(gmail.modified, [{'ids': ['m002'], 'add': [], 'remove': ['UNREAD']}])
+        self.assertEqual(self.evaluated_hashes(), {executor.rules_hash})
+
+    def test_body_rule_fetches_bodies_without_requeueing_emails(self):
+        headers_only = [make_email(number, email['subject'], email['sender'], body_fetched=False)
+                        for number, email in enumerate(self.emails, start=1)]
+        self.executor([MOVE_TO_BILLS], headers_only).process_emails()
+
+        gmail = FakeGmail(self.emails)
+        executor = self.executor([MOVE_TO_BILLS, READ_BODY], gmail=gmail)
+        self.assertEqual(executor.process_emails(), 0)
+
+        self.assertEqual(sorted(gmail.fetched), ['m001', 'm002', 'm003', 'm004'])
+        self.assertEqual(gmail.modified, [{'ids': ['m001', 'm003'], 'add': [], 'remove': ['UNREAD']}])
+        self.assertEqual(self.evaluated_hashes(), {executor.rules_hash})
+
+    def test_plan_includes_new_rules_without_applying_them(self):
+        self.executor([MOVE_TO_BILLS], self.emails).process_emails()
+
+        gmail = FakeGmail(self.emails)
+        executor = self.executor([MOVE_TO_BILLS, READ_SHOP], gmail=gmail)
+        plan = executor.plan_emails()
+
+        self.assertEqual(plan, {((), ('UNREAD',), (('is_read', 1),)): ['m001', 'm004']})
+        self.assertEqual(gmail.modified, [])
+        self.assertNotIn(executor.rules_hash, self.evaluated_hashes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,14 @@
+from typing import Iterable, Iterator, List, TypeVar
+
+T = TypeVar('T')
+
+def chunked(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    """Yield lists of at most size items, consuming items lazily"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,45 @@
+import calendar
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Optional
+
+# The format SQLite's CURRENT_TIMESTAMP and older databases stored, in UTC
+SQL_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def to_epoch(value: Any) -> Optional[int]:
+    """
+    Normalize a received date to UTC epoch seconds.
+    Accepts epoch numbers, RFC 2822 Date headers and SQL timestamps;
+    dates without a zone are taken as UTC. Returns None when unparseable.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+
+    text = str(value).strip()
+    if not text:
+        return None
+    if text.isdigit():
+        return int(text)
+
+    try:
+        parsed = datetime.strptime(text, SQL_TIMESTAMP_FORMAT)
+    except ValueError:
+        try:
+            parsed = parsedate_to_datetime(text)
+        except (TypeError, ValueError, IndexError):
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def subtract_months(moment: datetime, months: int) -> datetime:
+    """The same day and time months earlier, clamped to the end of shorter months"""
+    index = moment.year * 12 + moment.month - 1 - months
+    year, month = divmod(index, 12)
+    month += 1
+    day = min(moment.day, calendar.monthrange(year, month)[1])
+    return moment.replace(year=year, month=month, day=day)
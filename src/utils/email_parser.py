@@ -1,34 +1,162 @@
 import base64
-import email
-from typing import Dict, Any
+import codecs
+import html
+import logging
+import re
+from typing import Dict, Any, Iterator, List, Tuple
+
+# Decoded body bytes kept per message; newsletters and pasted logs are cut here
+DEFAULT_MAX_BODY_BYTES = 256 * 1024
+
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*"?([^";\s]+)"?', re.IGNORECASE)
+SCRIPT_STYLE_PATTERN = re.compile(r'<(script|style)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+TAG_PATTERN = re.compile(r'<[^>]*(>|$)')  # a tag cut off by the byte cap has no '>'
 
 class EmailParser:
-    @staticmethod
-    def parse_message(msg: Dict[str, Any]) -> Dict[str, str]:
-        """Parse Gmail API message into a structured format."""
-        # print(msg.keys())
-        # print(msg['id'])
-        # print(msg['threadId'])
-        # print(msg['labelIds'])
-        message_id = msg['id']
-        headers = msg['payload']['headers']
-        subject = next(h['value'] for h in headers if h['name'].lower() == 'subject')
-        sender = next(h['value'] for h in headers if h['name'].lower() == 'from')
-        date = next(h['value'] for h in headers if h['name'].lower() == 'date')
-
-        # Get email body
-        if 'parts' in msg['payload']:
-            parts = msg['payload']['parts']
-            data = parts[0]['body'].get('data', '')
-        else:
-            data = msg['payload']['body'].get('data', '')
+    """
+    Parses Gmail API messages into the flat dict stored in the database.
+
+    The MIME tree is walked instead of reading only the first part.
+    text/plain parts make up the body, with text/html parts (tags
+    stripped) used only when a message has no plain text. Each part is
+    decoded with its own charset, and only as much base64 as the byte cap
+    needs is decoded. Attachment bodies are skipped unless
+    include_attachments is set; their metadata is always listed.
+    """
+
+    def __init__(self, max_body_bytes: int = DEFAULT_MAX_BODY_BYTES,
+                 default_charset: str = 'utf-8',
+                 include_attachments: bool = False):
+        self.max_body_bytes = max_body_bytes
+        self.default_charset = default_charset
+        self.include_attachments = include_attachments
+        self.logger = logging.getLogger(__name__)
+
+    def parse_message(self, msg: Dict[str, Any], format: str = 'full') -> Dict[str, Any]:
+        """
+        Parse Gmail API message into a structured format.
+        A message fetched with format='metadata' has headers only, its
+        body is left empty with body_fetched False.
+        """
+        payload = msg.get('payload', {})
+        headers = self._headers(payload)
 
-        body = base64.urlsafe_b64decode(data).decode('utf-8') if data else "No content"
+        if format == 'metadata':
+            return {
+                'message_id': msg['id'],
+                'subject': headers.get('subject', ''),
+                'sender': headers.get('from', ''),
+                'recipient': headers.get('to', ''),
+                'date': headers.get('date', ''),
+                'internal_date': msg.get('internalDate'),
+                'body': '',
+                'body_fetched': False,
+                'attachments': []
+            }
+
+        plain: List[str] = []
+        html_parts: List[str] = []
+        attachments: List[Dict] = []
+        budget = {'text/plain': self.max_body_bytes, 'text/html': self.max_body_bytes}
+
+        for part in self._walk(payload):
+            mime_type = part.get('mimeType', 'text/plain').lower()
+            body = part.get('body', {})
+
+            if part.get('filename') or body.get('attachmentId'):
+                attachments.append(self._attachment(part))
+                continue
+            if mime_type not in budget or budget[mime_type] <= 0:
+                continue
+
+            try:
+                text, used = self._decode(body.get('data', ''), self._charset(part), budget[mime_type])
+            except Exception as e:
+                self.logger.error(f"Skipping undecodable {mime_type} part of message {msg.get('id')}: {e}")
+                continue
+            budget[mime_type] -= used
+            (plain if mime_type == 'text/plain' else html_parts).append(text)
+
+        if plain:
+            body_text = '\n'.join(plain)
+        else:
+            body_text = '\n'.join(self._strip_html(text) for text in html_parts)
 
         return {
-            'message_id': message_id,
-            'subject': subject,
-            'sender': sender,
-            'date': date,
-            'body': body
-        }
\ No newline at end of file
+            'message_id': msg['id'],
+            'subject': headers.get('subject', ''),
+            'sender': headers.get('from', ''),
+            'recipient': headers.get('to', ''),
+            'date': headers.get('date', ''),
+            'internal_date': msg.get('internalDate'),
+            'body': body_text or "No content",
+            'body_fetched': True,
+            'attachments': attachments
+        }
+
+    @staticmethod
+    def _headers(part: Dict) -> Dict[str, str]:
+        """Header name (lower case) -> value, keeping the first of repeated headers"""
+        headers = {}
+        for header in part.get('headers', []):
+            headers.setdefault(header.get('name', '').lower(), header.get('value', ''))
+        return headers
+
+    @staticmethod
+    def _walk(payload: Dict) -> Iterator[Dict]:
+        """Yield the leaf parts of the MIME tree in document order"""
+        stack = [payload]
+        while stack:
+            part = stack.pop()
+            children = part.get('parts')
+            if children:
+                stack.extend(reversed(children))
+            else:
+                yield part
+
+    def _charset(self, part: Dict) -> str:
+        content_type = self._headers(part).get('content-type', '')
+        match = CHARSET_PATTERN.search(content_type)
+        return match.group(1) if match else self.default_charset
+
+    def _decode(self, data: str, charset: str, limit: int) -> Tuple[str, int]:
+        """
+        Decode at most limit bytes of a base64url body
+        Returns the text and the number of bytes it used
+        """
+        if not data:
+            return '', 0
+
+        # 4 base64 characters carry 3 bytes, so only decode the prefix needed
+        chars = -(-limit // 3) * 4
+        raw = base64.urlsafe_b64decode(self._pad(data[:chars]))[:limit]
+        truncated = len(data) > chars or len(raw) == limit
+
+        try:
+            decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder(self.default_charset)(errors='replace')
+        # A cut-off multibyte sequence at the end is dropped instead of garbled
+        return decoder.decode(raw, final=not truncated), len(raw)
+
+    @staticmethod
+    def _pad(data: str) -> str:
+        return data + '=' * (-len(data) % 4)
+
+    def _attachment(self, part: Dict) -> Dict:
+        body = part.get('body', {})
+        attachment = {
+            'filename': part.get('filename', ''),
+            'mime_type': part.get('mimeType', ''),
+            'size': body.get('size', 0),
+            'attachment_id': body.get('attachmentId')
+        }
+        if self.include_attachments and body.get('data'):
+            attachment['data'] = base64.urlsafe_b64decode(self._pad(body['data']))
+        return attachment
+
+    @staticmethod
+    def _strip_html(text: str) -> str:
+        text = SCRIPT_STYLE_PATTERN.sub(' ', text)
+        text = TAG_PATTERN.sub(' ', text)
+        return re.sub(r'\s+', ' ', html.unescape(text)).strip()
@@ -0,0 +1,251 @@
+import atexit
+import bisect
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+# Upper bounds in seconds of the latency histogram buckets, +Inf is implied
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Prefix of every exported metric name
+NAMESPACE = 'email_filter'
+
+# (metric name, sorted (label, value) pairs)
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class _NullTimer:
+    """What timer() returns while metrics are disabled: no clock reads, no locking"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics: 'Metrics', name: str, labels: Dict[str, str]):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'count', 'total')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+
+class Metrics:
+    """
+    Process-wide counters and latency histograms.
+
+    Disabled by default: inc() and observe() return straight away and
+    timer() hands out a shared no-op context manager, so instrumented code
+    pays one attribute check. When enabled via configure(), metrics can be
+    scraped in Prometheus text format from a local HTTP endpoint and/or
+    written as JSON when the process exits.
+
+    The worker processes of process_emails.py --workers record nothing
+    themselves; the coordinating process counts their evaluations.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._counters: Dict[MetricKey, float] = {}
+        self._histograms: Dict[MetricKey, _Histogram] = {}
+        self._started = time.time()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._json_path: Optional[str] = None
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, str]) -> MetricKey:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        """Add to a counter"""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """Record a duration in a latency histogram"""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name: str, **labels):
+        """Context manager recording the block's duration in a histogram"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def configure(self, config: Dict) -> None:
+        """
+        Apply the metrics section of config.yaml: enabled, prometheus_port
+        (0 for no endpoint), prometheus_host and json_path (written at exit)
+        """
+        if not config.get('enabled'):
+            return
+        self.enabled = True
+
+        port = config.get('prometheus_port', 0)
+        if port and self._server is None:
+            self.serve(config.get('prometheus_host', 'localhost'), port)
+
+        json_path = config.get('json_path')
+        if json_path and self._json_path is None:
+            self._json_path = json_path
+            atexit.register(self.dump_json, json_path)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._started = time.time()
+
+    def snapshot(self) -> Dict:
+        """Current values as plain data, the format of the JSON dump"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h.buckets), h.count, h.total) for key, h in self._histograms.items()}
+
+        result = {'uptime_seconds': round(time.time() - self._started, 3), 'counters': [], 'histograms': []}
+        for (name, labels), value in sorted(counters.items()):
+            result['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+        for (name, labels), (buckets, count, total) in sorted(histograms.items()):
+            result['histograms'].append({
+                'name': name,
+                'labels': dict(labels),
+                'count': count,
+                'sum_seconds': round(total, 6),
+                'avg_ms': round(1000 * total / count, 3) if count else 0.0,
+                'p50_ms': self._quantile_ms(buckets, count, 0.5),
+                'p95_ms': self._quantile_ms(buckets, count, 0.95),
+                'p99_ms': self._quantile_ms(buckets, count, 0.99)
+            })
+        return result
+
+    @staticmethod
+    def _quantile_ms(buckets: List[int], count: int, quantile: float) -> Optional[float]:
+        """Upper bound of the bucket holding the quantile, None when it is past the last bound"""
+        if not count:
+            return None
+        target = quantile * count
+        seen = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+            seen += bucket_count
+            if seen >= target:
+                return round(1000 * bound, 3)
+        return None
+
+    def render_prometheus(self) -> str:
+        """Current values in the Prometheus text exposition format"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h.buckets), h.count, h.total) for key, h in self._histograms.items()}
+
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            full_name = f'{NAMESPACE}_{name}'
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append(f'# TYPE {full_name} counter')
+            lines.append(f'{full_name}{self._labels(labels)} {value}')
+
+        for (name, labels), (buckets, count, total) in sorted(histograms.items()):
+            full_name = f'{NAMESPACE}_{name}'
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append(f'# TYPE {full_name} histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(f'{full_name}_bucket{self._labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{full_name}_bucket{self._labels(labels, le="+Inf")} {count}')
+            lines.append(f'{full_name}_sum{self._labels(labels)} {total}')
+            lines.append(f'{full_name}_count{self._labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _labels(labels: Tuple[Tuple[str, str], ...], **extra) -> str:
+        pairs = list(labels) + [(key, str(value)) for key, value in extra.items()]
+        if not pairs:
+            return ''
+        escaped = (
+            key + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for key, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def dump_json(self, path: str) -> None:
+        """Write snapshot() to a JSON file"""
+        try:
+            with open(path, 'w') as f:
+                json.dump(self.snapshot(), f, indent=2)
+        except OSError as e:
+            self.logger.error(f"Could not write metrics to {path}: {e}")
+
+    def serve(self, host: str, port: int) -> int:
+        """Serve render_prometheus() on http://host:port/metrics, returns the bound port"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+        self.logger.info(f"Serving metrics on http://{host}:{self._server.server_address[1]}/metrics")
+        return self._server.server_address[1]
+
+
+# The process-wide registry every module records to
+metrics = Metrics()
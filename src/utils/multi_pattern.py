@@ -0,0 +1,86 @@
+from collections import deque
+from typing import Dict, Iterable, List, Set
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional, fall back to the pure Python automaton
+    ahocorasick = None
+
+
+class MultiPatternMatcher:
+    """
+    Aho-Corasick automaton over a fixed set of patterns.
+    One pass over a text reports every pattern that occurs in it, so the cost
+    of a scan does not grow with the number of patterns.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns = sorted({pattern for pattern in patterns if pattern})
+
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for pattern in self.patterns:
+                self._automaton.add_word(pattern, pattern)
+            if self.patterns:
+                self._automaton.make_automaton()
+            self.find_all = self._find_all_native
+        else:
+            self._build()
+            self.find_all = self._find_all_python
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    def _find_all_native(self, text: str) -> Set[str]:
+        """Return the set of patterns that occur in text"""
+        if not self.patterns or not text:
+            return set()
+        return {pattern for _, pattern in self._automaton.iter(text)}
+
+    def _build(self):
+        # Trie as a list of transition dicts, state 0 is the root
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[str]] = [[]]
+
+        for pattern in self.patterns:
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = next_state
+            self._output[state].append(pattern)
+
+        # Breadth-first pass to compute failure links and merge outputs
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def _find_all_python(self, text: str) -> Set[str]:
+        """Return the set of patterns that occur in text"""
+        found = set()
+        if not self.patterns or not text:
+            return found
+
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found